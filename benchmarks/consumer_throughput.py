@@ -0,0 +1,88 @@
+"""
+Compares handling change_batch_quantity messages one at a time with draining,
+coalescing and applying them per product, against an in-process stand-in for
+Redis pubsub and a sqlite database.
+
+    python benchmarks/consumer_throughput.py [messages] [batches]
+"""
+import json
+import logging
+import sys
+import tempfile
+import time
+from collections import deque
+from unittest import mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation import bootstrap
+from allocation.adapters.orm import metadata
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+from allocation.service_layer import unit_of_work
+
+
+class FakePubSub:
+    def __init__(self, payloads):
+        self.messages = deque(
+            {"type": "message", "data": json.dumps(p)} for p in payloads
+        )
+
+    def get_message(self, timeout=0.0):
+        return self.messages.popleft() if self.messages else None
+
+
+def make_bus(db_path, n_batches):
+    engine = create_engine(f"sqlite:///{db_path}")
+    metadata.create_all(engine)
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    for i in range(n_batches):
+        bus.handle(commands.CreateBatch(f"batch{i}", f"sku{i % 10}", 1000, None))
+    return bus
+
+
+def bursts(n_messages, n_batches):
+    # upstream tends to send several quantities for a batch in quick succession
+    return [
+        {"batchref": f"batch{(i // 5) % n_batches}", "qty": 1000 - i % 5}
+        for i in range(n_messages)
+    ]
+
+
+def one_at_a_time(bus, pubsub):
+    while pubsub.messages:
+        redis_eventconsumer.handle_change_batch_quantity(pubsub.get_message(), bus)
+
+
+def batched(bus, pubsub):
+    while pubsub.messages:
+        messages = redis_eventconsumer.drain(pubsub, wait=0)
+        redis_eventconsumer.handle_change_batch_quantities(messages, bus)
+
+
+def run(name, consume, n_messages, n_batches):
+    with tempfile.TemporaryDirectory() as tmp:
+        bus = make_bus(f"{tmp}/bench.db", n_batches)
+        pubsub = FakePubSub(bursts(n_messages, n_batches))
+        start = time.perf_counter()
+        consume(bus, pubsub)
+        elapsed = time.perf_counter() - start
+        clear_mappers()
+    print(f"{name:>14}: {n_messages / elapsed:10.0f} messages/s")
+
+
+def main():
+    logging.disable(logging.WARNING)
+    n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_batches = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    run("one at a time", one_at_a_time, n_messages, n_batches)
+    run("batched", batched, n_messages, n_batches)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Times the message bus's own overhead per message: dispatching a command or
+an event to handlers that do nothing, and allocating end to end against the
+fake unit of work from the unit tests, with no metrics and logging at INFO.
+
+    python benchmarks/dispatch.py [messages]
+"""
+import logging
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from allocation import bootstrap
+from allocation.adapters.read_model import RedisReadModel
+from allocation.domain import commands, events
+from allocation.service_layer import messagebus
+from tests.unit.fakes import FakeNotifications, FakeRedis, FakeUnitOfWork
+
+REPEATS = 5
+
+
+def noop_command(cmd, uow):
+    pass
+
+
+def noop_event(event, uow, publish):
+    pass
+
+
+def noop_bus():
+    dependencies = dict(uow=FakeUnitOfWork(), publish=lambda *args: None)
+    return messagebus.MessageBus(
+        uow=dependencies["uow"],
+        event_handlers=bootstrap.inject_event_handlers(
+            {events.OutOfStock: [noop_event, noop_event]}, dependencies
+        ),
+        command_handlers=bootstrap.inject_command_handlers(
+            {commands.Allocate: noop_command}, dependencies
+        ),
+    )
+
+
+def allocating_bus(messages):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        read_model=RedisReadModel(FakeRedis()),
+    )
+    bus.handle(commands.CreateBatch("b1", "LAMP", messages * REPEATS, None))
+    return bus
+
+
+def per_message(bus, make_message, messages) -> float:
+    batch = [make_message(i) for i in range(messages * REPEATS)]
+    timings = [
+        timeit.timeit(
+            lambda chunk=batch[r * messages : (r + 1) * messages]: [
+                bus.handle(m) for m in chunk
+            ],
+            number=1,
+        )
+        for r in range(REPEATS)
+    ]
+    return min(timings) / messages
+
+
+def main(messages):
+    logging.basicConfig(level=logging.INFO)
+    scenarios = [
+        ("no-op command", noop_bus(), lambda i: commands.Allocate(f"o{i}", "X", 1)),
+        ("event, 2 no-op handlers", noop_bus(), lambda i: events.OutOfStock("LAMP")),
+        (
+            "allocate, fake uow",
+            allocating_bus(messages),
+            lambda i: commands.Allocate(f"o{i}", "LAMP", 1),
+        ),
+    ]
+    for name, bus, make_message in scenarios:
+        seconds = per_message(bus, make_message, messages)
+        print(f"{name:<26} {seconds * 1e6:8.2f}us per message")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
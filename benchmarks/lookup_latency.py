@@ -0,0 +1,97 @@
+"""
+Times the lookups on the hot paths (product by batchref, the allocations view
+by orderid, deleting from it by orderid and sku) as the tables grow, with and
+without the indexes declared in adapters/orm.py, against a sqlite database.
+
+    python benchmarks/lookup_latency.py [rows ...]
+"""
+import sys
+import tempfile
+import time
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation.adapters import orm, read_model, repository
+
+LOOKUPS = 200
+
+
+def make_session_factory(db_path, rows, indexed):
+    engine = create_engine(f"sqlite:///{db_path}")
+    orm.metadata.create_all(engine)
+    with engine.begin() as conn:
+        if not indexed:
+            for table in orm.metadata.tables.values():
+                for index in table.indexes:
+                    conn.execute(text(f"DROP INDEX {index.name}"))
+        conn.execute(
+            orm.products.insert(), [dict(sku=f"sku{i}") for i in range(rows // 10)]
+        )
+        batches = [
+            dict(reference=f"batch{i}", sku=f"sku{i // 10}", _purchased_quantity=100)
+            for i in range(rows)
+        ]
+        conn.execute(orm.batches.insert(), batches)
+        conn.execute(
+            orm.allocations_view.insert(),
+            [
+                dict(orderid=f"order{i}", sku=f"sku{i % 1000}", batchref=f"batch{i}")
+                for i in range(rows)
+            ],
+        )
+    return sessionmaker(bind=engine)
+
+
+def time_lookups(session_factory, rows):
+    session = session_factory()
+    repo = repository.SqlAlchemyRepository(session, load_strategy="lazy")
+    step = max(rows // LOOKUPS, 1)
+    keys = range(0, rows, step)
+    timings = {}
+
+    start = time.perf_counter()
+    for i in keys:
+        repo.get_by_batchref(f"batch{i}")
+        session.expunge_all()
+    timings["get_by_batchref"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in keys:
+        session.execute(
+            "SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid",
+            dict(orderid=f"order{i}"),
+        ).fetchall()
+    timings["view by orderid"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in keys:
+        session.execute(
+            read_model.DELETE_SQL,
+            dict(orderid=f"order{i}", sku=f"sku{i % 1000}", batchref=f"batch{i}"),
+        )
+    timings["view delete"] = time.perf_counter() - start
+    session.rollback()
+    session.close()
+    return {name: seconds / len(keys) for name, seconds in timings.items()}
+
+
+def main(row_counts):
+    orm.start_mappers()
+    try:
+        for rows in row_counts:
+            for indexed in (False, True):
+                with tempfile.NamedTemporaryFile(suffix=".db") as f:
+                    timings = time_lookups(
+                        make_session_factory(f.name, rows, indexed), rows
+                    )
+                label = "indexed" if indexed else "no indexes"
+                print(
+                    f"{rows:>8} rows, {label:<10}",
+                    "  ".join(f"{k}: {v * 1e6:8.1f}us" for k, v in timings.items()),
+                )
+    finally:
+        clear_mappers()
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1_000, 10_000, 100_000])
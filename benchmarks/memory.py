@@ -0,0 +1,91 @@
+"""
+Measures what the objects a worker holds cost in memory, with tracemalloc:
+the allocations of a product loaded from a sqlite database, and the events
+that allocating queues on a product and the commands that ask for it.
+
+    python benchmarks/memory.py [allocations]
+"""
+import gc
+import sys
+import tempfile
+import tracemalloc
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation.adapters import orm
+from allocation.domain import commands, events, model
+from allocation.service_layer import unit_of_work
+
+
+def measured(make):
+    """what make() returned, and how many bytes it still holds"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = make()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def allocated_batch(engine, n):
+    with engine.begin() as connection:
+        connection.execute(orm.products.insert(), dict(sku="LAMP"))
+        connection.execute(
+            orm.batches.insert(),
+            dict(id=1, reference="b1", sku="LAMP", _purchased_quantity=n),
+        )
+        connection.execute(
+            orm.order_lines.insert(),
+            [dict(id=i, orderid=f"order{i}", sku="LAMP", qty=1) for i in range(n)],
+        )
+        connection.execute(
+            orm.allocations.insert(),
+            [dict(orderline_id=i, batch_id=1) for i in range(n)],
+        )
+
+
+def loaded_allocations(engine, n) -> float:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+    with uow:
+        # the session keeps only weak references, so hold on to the product
+        product, size = measured(lambda: uow.products.get("LAMP"))
+        assert len(product.batches[0]._allocations) == n
+    return size / n
+
+
+def queued_events(n) -> float:
+    orderids = [f"order{i}" for i in range(n)]
+    product = model.Product("LAMP", [])
+
+    def queue():
+        product.events.extend(events.Allocated(o, "LAMP", 1, "b1") for o in orderids)
+
+    _, size = measured(queue)
+    return size / n
+
+
+def allocate_commands(n) -> float:
+    orderids = [f"order{i}" for i in range(n)]
+    _, size = measured(lambda: [commands.Allocate(o, "LAMP", 1) for o in orderids])
+    return size / n
+
+
+def main(n):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{tmp}/memory.db")
+        orm.metadata.create_all(engine)
+        orm.start_mappers()
+        try:
+            allocated_batch(engine, n)
+            print(f"loaded allocation  {loaded_allocations(engine, n):7.0f} bytes")
+        finally:
+            clear_mappers()
+            engine.dispose()
+    print(f"queued Allocated   {queued_events(n):7.0f} bytes")
+    print(f"Allocate command   {allocate_commands(n):7.0f} bytes")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
@@ -0,0 +1,78 @@
+"""
+Times starting up the flask app in a fresh interpreter: importing it, then
+its first few requests, with the backends stubbed out (sqlite in memory for
+postgres, a do-nothing redis), so that only our own start-up work is timed.
+
+    python benchmarks/startup.py [runs]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+from allocation.entrypoints import flask_app
+imported = time.perf_counter()
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation.adapters import orm, redis_eventpublisher
+from allocation.service_layer import unit_of_work
+
+class FakeRedis:
+    def pipeline(self, transaction=True):
+        return self
+    def publish(self, channel, message):
+        pass
+    def execute(self):
+        return []
+
+engine = create_engine("sqlite://")
+orm.metadata.create_all(engine)
+unit_of_work.default_session_factory = lambda: sessionmaker(bind=engine)
+redis_eventpublisher.get_client = FakeRedis
+stubbed = time.perf_counter()
+
+client = flask_app.app.test_client()
+timings = dict(imports=imported - start)
+for i, (name, method, url, body) in enumerate([
+    ("first add_batch", "post", "/add_batch",
+     dict(ref="b1", sku="LAMP", qty=100, eta=None)),
+    ("first allocate", "post", "/allocate", dict(orderid="o1", sku="LAMP", qty=1)),
+    ("first view", "get", "/allocations/o1", None),
+    ("next allocate", "post", "/allocate", dict(orderid="o2", sku="LAMP", qty=1)),
+]):
+    before = time.perf_counter()
+    response = getattr(client, method)(url, json=body)
+    assert response.status_code < 300, response.data
+    timings[name] = time.perf_counter() - before
+print(json.dumps(timings))
+"""
+
+
+def run_once(src: Path) -> dict:
+    env = dict(os.environ, PYTHONPATH=str(src))
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main(runs):
+    src = Path(__file__).resolve().parent.parent / "src"
+    results = [run_once(src) for _ in range(runs)]
+    for name in results[0]:
+        median = statistics.median(r[name] for r in results)
+        print(f"{name:<16} {median * 1e3:8.1f}ms  (median of {runs})")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
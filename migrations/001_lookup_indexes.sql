@@ -0,0 +1,31 @@
+-- Indexes and unique constraints for the lookup hot paths, for databases
+-- created before they were declared in adapters/orm.py.
+--
+-- CREATE INDEX CONCURRENTLY can't run inside a transaction, so run this file
+-- statement by statement, eg with `make migrate` or psql in autocommit mode.
+-- It is safe to run again. If a unique index fails to build because of
+-- duplicates, psql leaves an INVALID index behind: drop it, clean up the
+-- data and run the file again.
+
+-- the read model had no key, so an order could end up with several rows for
+-- a sku; keep the newest one
+DELETE FROM allocations_view AS older
+USING allocations_view AS newer
+WHERE older.orderid = newer.orderid
+  AND older.sku = newer.sku
+  AND older.ctid < newer.ctid;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_batches_reference
+    ON batches (reference);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_batches_sku
+    ON batches (sku);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_allocations_batch_id
+    ON allocations (batch_id);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_allocations_orderline_id
+    ON allocations (orderline_id);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_allocations_view_orderid_sku
+    ON allocations_view (orderid, sku);
@@ -0,0 +1,5 @@
+-- Lets the read model CLI verify and reconcile allocations_view one sku at a
+-- time. Like 001, run it outside a transaction; it is safe to run again.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_allocations_view_sku
+    ON allocations_view (sku);
@@ -0,0 +1,14 @@
+-- Keys allocations_view on (orderid, sku, batchref) rather than (orderid,
+-- sku), as an order's lines of one sku may be allocated to different batches
+-- and each needs its row. Like 001, run it outside a transaction; it is safe
+-- to run again.
+--
+-- Rows lost to the old key aren't brought back by this; afterwards, run
+--     python -m allocation.entrypoints.read_model_cli reconcile
+-- A Redis read model's layout has changed too: rebuild it rather than
+-- reconcile it.
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_allocations_view_orderid_sku_batchref
+    ON allocations_view (orderid, sku, batchref);
+
+DROP INDEX CONCURRENTLY IF EXISTS ix_allocations_view_orderid_sku;
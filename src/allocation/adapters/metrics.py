@@ -0,0 +1,49 @@
+# pylint: disable=too-few-public-methods
+import abc
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+
+class AbstractMetrics(abc.ABC):
+    # False for sinks that drop everything, so callers needn't measure at all
+    enabled = True
+
+    @abc.abstractmethod
+    def observe(self, name: str, value: float, **labels: str):
+        """record one sample of a histogram-style metric"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def increment(self, name: str, amount: int = 1, **labels: str):
+        """add to a counter"""
+        raise NotImplementedError
+
+
+class NoMetrics(AbstractMetrics):
+    enabled = False
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def increment(self, name, amount=1, **labels):
+        pass
+
+
+class InMemoryMetrics(AbstractMetrics):
+    """keeps every sample, for tests and for poking at from a shell"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)  # type: Dict[Tuple, List[float]]
+        self.counters = defaultdict(int)  # type: Dict[Tuple, int]
+
+    def observe(self, name, value, **labels):
+        self.samples[(name, tuple(sorted(labels.items())))].append(value)
+
+    def increment(self, name, amount=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def values(self, name, **labels) -> List[float]:
+        return self.samples[(name, tuple(sorted(labels.items())))]
+
+    def count(self, name, **labels) -> int:
+        return self.counters[(name, tuple(sorted(labels.items())))]
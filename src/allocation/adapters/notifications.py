@@ -1,28 +1,218 @@
-# pylint: disable=too-few-public-methods
+# pylint: disable=too-few-public-methods, broad-except
+from __future__ import annotations
 import abc
+import logging
+import queue
 import smtplib
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from allocation import config
 
+logger = logging.getLogger(__name__)
+
 
 class AbstractNotifications(abc.ABC):
     @abc.abstractmethod
     def send(self, destination, message):
         raise NotImplementedError
 
+    def close(self):
+        pass
+
+
+class SMTPConnectionPool:
+    """
+    Up to size SMTP connections, shared between threads. Each is opened when
+    first needed and kept open between sends; one used by a send that fails,
+    however it fails, is closed, so the next send opens a new one. host and
+    port default to the configured ones, looked up when connecting.
+    """
+
+    def __init__(
+        self,
+        host: str = None,
+        port: int = None,
+        size: int = 2,
+        timeout: float = 10.0,
+        connect: Callable[..., smtplib.SMTP] = smtplib.SMTP,
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._connect = connect
+        self._idle = queue.LifoQueue()  # type: queue.LifoQueue
+        self._slots = threading.BoundedSemaphore(size)
 
-DEFAULT_HOST = config.get_email_host_and_port()["host"]
-DEFAULT_PORT = config.get_email_host_and_port()["port"]
+    @contextmanager
+    def connection(self) -> Iterator[smtplib.SMTP]:
+        with self._slots:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                server = self._open()
+            try:
+                yield server
+            except BaseException:
+                # whatever went wrong, the connection may be mid-conversation
+                _close(server)
+                raise
+            self._idle.put(server)
+
+    def close(self):
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _close(server)
+
+    def _open(self) -> smtplib.SMTP:
+        configured = config.get_email_host_and_port()
+        return self._connect(
+            self.host or configured["host"],
+            port=self.port or configured["port"],
+            timeout=self.timeout,
+        )
 
 
 class EmailNotifications(AbstractNotifications):
-    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-        self.server = smtplib.SMTP(smtp_host, port=port)
-        self.server.noop()
+    def __init__(
+        self,
+        smtp_host=None,
+        port=None,
+        pool: SMTPConnectionPool = None,
+    ):
+        self.pool = pool if pool is not None else SMTPConnectionPool(smtp_host, port)
 
     def send(self, destination, message):
         msg = f"Subject: allocation service notification\n{message}"
-        self.server.sendmail(
-            from_addr="allocations@example.com",
-            to_addrs=[destination],
-            msg=msg,
+        try:
+            self._sendmail(destination, msg)
+        except smtplib.SMTPServerDisconnected:
+            # most likely an idle connection that the server has since closed
+            self._sendmail(destination, msg)
+
+    def close(self):
+        self.pool.close()
+
+    def _sendmail(self, destination, msg):
+        with self.pool.connection() as server:
+            server.sendmail(
+                from_addr="allocations@example.com",
+                to_addrs=[destination],
+                msg=msg,
+            )
+
+
+class _Digest:
+    def __init__(self, due: float):
+        self.due = due
+        # how many times each message was sent, in the order first sent
+        self.messages = Counter()  # type: Counter[str]
+
+    def text(self) -> str:
+        return "\n".join(
+            message if count == 1 else f"{message} ({count} times)"
+            for message, count in self.messages.items()
         )
+
+
+class DigestingNotifications(AbstractNotifications):
+    """
+    Collects each destination's messages for window seconds and then sends
+    them on as one digest, each distinct message once, from a background
+    thread: send() never waits for SMTP, and a burst of OutOfStock for a sku
+    becomes a single line of a single email.
+
+    close() sends whatever is still pending; call it before exiting.
+    """
+
+    def __init__(
+        self,
+        notifications: AbstractNotifications,
+        window: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.notifications = notifications
+        self.window = window
+        self.clock = clock
+        self._pending = {}  # type: Dict[str, _Digest]
+        self._condition = threading.Condition()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._closed = False
+
+    def send(self, destination, message):
+        with self._condition:
+            if self._closed:
+                self.notifications.send(destination, message)
+                return
+            digest = self._pending.get(destination)
+            if digest is None:
+                digest = _Digest(self.clock() + self.window)
+                self._pending[destination] = digest
+                self._condition.notify()
+            digest.messages[message] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="notification-digests", daemon=True
+                )
+                self._thread.start()
+
+    def flush(self):
+        """sends everything pending now, without waiting for its window"""
+        with self._condition:
+            due = self._take(everything=True)
+        self._send(due)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.notifications.close()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due = self._take(everything=self._closed)
+                while not due and not self._closed:
+                    self._condition.wait(self._seconds_to_next())
+                    due = self._take(everything=self._closed)
+                closed = self._closed
+            self._send(due)
+            if closed:
+                return
+
+    def _take(self, everything: bool) -> List[Tuple[str, _Digest]]:
+        now = self.clock()
+        due = [
+            (destination, digest)
+            for destination, digest in self._pending.items()
+            if everything or digest.due <= now
+        ]
+        for destination, _ in due:
+            del self._pending[destination]
+        return due
+
+    def _seconds_to_next(self) -> Optional[float]:
+        if not self._pending:
+            return None  # until send() or close() notifies us
+        return max(0.0, min(d.due for d in self._pending.values()) - self.clock())
+
+    def _send(self, due: List[Tuple[str, _Digest]]):
+        for destination, digest in due:
+            try:
+                self.notifications.send(destination, digest.text())
+            except Exception:
+                logger.exception("Couldn't send a digest to %s", destination)
+
+
+def _close(server: smtplib.SMTP):
+    try:
+        server.quit()
+    except Exception:
+        server.close()
@@ -5,11 +5,15 @@ from sqlalchemy import (
     Column,
     Integer,
     String,
+    Text,
     Date,
     ForeignKey,
+    Index,
     event,
+    func,
+    select,
 )
-from sqlalchemy.orm import mapper, relationship
+from sqlalchemy.orm import column_property, mapper, relationship
 
 from allocation.domain import model
 
@@ -41,6 +45,8 @@ batches = Table(
     Column("sku", ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    Index("ix_batches_reference", "reference", unique=True),
+    Index("ix_batches_sku", "sku"),
 )
 
 allocations = Table(
@@ -49,6 +55,9 @@ allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", ForeignKey("order_lines.id")),
     Column("batch_id", ForeignKey("batches.id")),
+    Index("ix_allocations_batch_id", "batch_id"),
+    # a line is only ever allocated to one batch
+    Index("ix_allocations_orderline_id", "orderline_id", unique=True),
 )
 
 allocations_view = Table(
@@ -57,8 +66,39 @@ allocations_view = Table(
     Column("orderid", String(255)),
     Column("sku", String(255)),
     Column("batchref", String(255)),
+    # an order's lines of one sku may be allocated to different batches;
+    # also serves lookups by orderid alone
+    Index(
+        "ix_allocations_view_orderid_sku_batchref",
+        "orderid",
+        "sku",
+        "batchref",
+        unique=True,
+    ),
+    # for reconciling the read model one sku at a time
+    Index("ix_allocations_view_sku", "sku"),
 )
 
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("message", Text, nullable=False),
+)
+
+
+def allocated_quantity_of_batch():
+    """
+    Correlated subquery summing the lines allocated to the enclosing batch.
+    """
+    return (
+        select(func.coalesce(func.sum(order_lines.c.qty), 0))
+        .select_from(allocations.join(order_lines))
+        .where(allocations.c.batch_id == batches.c.id)
+        .scalar_subquery()
+    )
+
 
 def start_mappers():
     logger.info("Starting mappers")
@@ -71,16 +111,45 @@ def start_mappers():
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
-            )
+            ),
+            # only loaded when undeferred, see the batch load listener
+            "_persisted_allocated_quantity": column_property(
+                allocated_quantity_of_batch(), deferred=True
+            ),
         },
     )
     mapper(
         model.Product,
         products,
         properties={"batches": relationship(batches_mapper)},
+        # the domain bumps version_number itself, and every UPDATE checks it
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
 
 
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
     product.events = []
+    product._batch_index = None
+
+
+@event.listens_for(model.Batch, "load")
+def receive_batch_load(batch, _):
+    # when the repository loaded the allocated total from the database,
+    # _allocations may never be loaded, so that total is the one to trust
+    batch._find_unloaded_line = None
+    batch._counted_in_sql = "_persisted_allocated_quantity" in batch.__dict__
+    if batch._counted_in_sql:
+        batch._allocated_quantity = batch._persisted_allocated_quantity
+    else:
+        batch._allocated_quantity = None
+
+
+@event.listens_for(model.Batch, "expire")
+def receive_batch_expire(batch, attrs):
+    # batch is None if the instance was garbage collected before the expiry
+    if batch is None or getattr(batch, "_counted_in_sql", False):
+        return
+    if attrs is None or "_allocations" in attrs:
+        batch._allocated_quantity = None
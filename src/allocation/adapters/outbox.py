@@ -0,0 +1,34 @@
+from typing import Iterable, List
+from sqlalchemy import select
+from allocation.adapters import orm
+from allocation.adapters.redis_eventpublisher import serialize
+from allocation.domain import events
+
+CHANNELS = {
+    events.Allocated: "line_allocated",
+    events.Deallocated: "line_deallocated",
+}
+
+
+def add(session, new_events: Iterable[events.Event]):
+    rows = [
+        dict(channel=CHANNELS[type(event)], message=serialize(event))
+        for event in new_events
+        if type(event) in CHANNELS
+    ]
+    if rows:
+        session.execute(orm.outbox.insert(), rows)
+
+
+def fetch(session, limit: int) -> List:
+    # SKIP LOCKED lets several relays share the outbox without double-publishing
+    return session.execute(
+        select(orm.outbox.c.id, orm.outbox.c.channel, orm.outbox.c.message)
+        .order_by(orm.outbox.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).fetchall()
+
+
+def remove(session, ids: List[int]):
+    session.execute(orm.outbox.delete().where(orm.outbox.c.id.in_(ids)))
@@ -0,0 +1,276 @@
+from __future__ import annotations
+import abc
+import itertools
+import json
+from typing import Dict, Iterable, Iterator, List, Set, Tuple, TYPE_CHECKING
+import redis
+from sqlalchemy import text
+
+from allocation import config
+
+if TYPE_CHECKING:
+    import redis.asyncio
+    from allocation.service_layer import async_unit_of_work, unit_of_work
+
+Allocation = Dict[str, str]
+# orderid, sku, batchref
+AllocationRow = Tuple[str, str, str]
+
+# rows written per statement or pipeline when rebuilding
+CHUNK_SIZE = 10_000
+
+
+class AbstractReadModel(abc.ABC):
+    """
+    the allocations of each order, as served by views.allocations: a row per
+    order, sku and batch, as an order's lines of one sku may be allocated to
+    different batches
+    """
+
+    @abc.abstractmethod
+    def add(self, orderid: str, sku: str, batchref: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, orderid: str, sku: str, batchref: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, orderid: str) -> List[Allocation]:
+        """sorted by sku, then batchref"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def allocations_for_sku(self, sku: str) -> Set[Tuple[str, str]]:
+        """(orderid, batchref) for every allocation of sku"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def rebuild(self, rows: Iterable[AllocationRow], chunk_size: int = CHUNK_SIZE):
+        """
+        replaces everything with rows, ignoring repeats; rows are consumed
+        chunk_size at a time
+        """
+        raise NotImplementedError
+
+
+INSERT_SQL = """
+    INSERT INTO allocations_view (orderid, sku, batchref)
+    VALUES (:orderid, :sku, :batchref)
+    ON CONFLICT (orderid, sku, batchref) DO NOTHING
+"""
+DELETE_SQL = """
+    DELETE FROM allocations_view
+    WHERE orderid = :orderid AND sku = :sku AND batchref = :batchref
+"""
+SELECT_SQL = """
+    SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid
+    ORDER BY sku, batchref
+"""
+
+
+class SqlReadModel(AbstractReadModel):
+    """the allocations_view table, in the write side's database"""
+
+    def __init__(self, uow: unit_of_work.SqlAlchemyUnitOfWork):
+        self.uow = uow
+
+    def add(self, orderid, sku, batchref):
+        with self.uow:
+            self.uow.session.execute(
+                INSERT_SQL, dict(orderid=orderid, sku=sku, batchref=batchref)
+            )
+            self.uow.commit()
+
+    def remove(self, orderid, sku, batchref):
+        with self.uow:
+            self.uow.session.execute(
+                DELETE_SQL, dict(orderid=orderid, sku=sku, batchref=batchref)
+            )
+            self.uow.commit()
+
+    def get(self, orderid):
+        with self.uow:
+            results = self.uow.session.execute(SELECT_SQL, dict(orderid=orderid))
+            # read the rows while the session still has its connection
+            return [dict(r) for r in results]
+
+    def allocations_for_sku(self, sku):
+        with self.uow:
+            results = self.uow.session.execute(
+                "SELECT orderid, batchref FROM allocations_view WHERE sku = :sku",
+                dict(sku=sku),
+            )
+            return {(orderid, batchref) for orderid, batchref in results}
+
+    def rebuild(self, rows, chunk_size=CHUNK_SIZE):
+        # one transaction, so readers see the old view until it's all done
+        with self.uow:
+            self.uow.session.execute("DELETE FROM allocations_view")
+            for chunk in chunked(rows, chunk_size):
+                self.uow.session.execute(
+                    INSERT_SQL,
+                    [dict(orderid=o, sku=s, batchref=b) for o, s, b in chunk],
+                )
+            self.uow.commit()
+
+
+class RedisReadModel(AbstractReadModel):
+    """
+    A hash per order, of sku by batchref (a batch is only ever of one sku),
+    so that reads scale separately from the write side's database. A set per
+    sku of its (orderid, batchref) pairs makes per-sku reconciliation
+    possible.
+    """
+
+    KEY_PREFIX = "allocations:"
+    # named for when it held orderids alone, so that rebuild clears those too
+    SKU_KEY_PREFIX = "orders_by_sku:"
+
+    def __init__(self, client: redis.Redis = None):
+        if client is None:
+            client = redis.Redis(**config.get_redis_host_and_port())
+        self.client = client
+
+    def add(self, orderid, sku, batchref):
+        pipe = self.client.pipeline(transaction=False)
+        _add(pipe, orderid, sku, batchref)
+        pipe.execute()
+
+    def remove(self, orderid, sku, batchref):
+        pipe = self.client.pipeline(transaction=False)
+        _remove(pipe, orderid, sku, batchref)
+        pipe.execute()
+
+    def get(self, orderid):
+        return _allocations(self.client.hgetall(_key(orderid)))
+
+    def allocations_for_sku(self, sku):
+        return {_unpair(member) for member in self.client.smembers(_sku_key(sku))}
+
+    def rebuild(self, rows, chunk_size=CHUNK_SIZE):
+        # not atomic: readers may see a partly rebuilt model while this runs
+        for prefix in (self.KEY_PREFIX, self.SKU_KEY_PREFIX):
+            stale = self.client.scan_iter(match=f"{prefix}*", count=chunk_size)
+            for keys in chunked(stale, chunk_size):
+                self.client.delete(*keys)
+        for chunk in chunked(rows, chunk_size):
+            pipe = self.client.pipeline(transaction=False)
+            for orderid, sku, batchref in chunk:
+                _add(pipe, orderid, sku, batchref)
+            pipe.execute()
+
+
+class AbstractAsyncReadModel(abc.ABC):
+    """the same allocations as AbstractReadModel, for the asgi app"""
+
+    @abc.abstractmethod
+    async def add(self, orderid: str, sku: str, batchref: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove(self, orderid: str, sku: str, batchref: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get(self, orderid: str) -> List[Allocation]:
+        raise NotImplementedError
+
+
+class AsyncSqlReadModel(AbstractAsyncReadModel):
+    """SqlReadModel's allocations_view table"""
+
+    def __init__(self, uow: async_unit_of_work.AsyncSqlAlchemyUnitOfWork):
+        self.uow = uow
+
+    async def add(self, orderid, sku, batchref):
+        async with self.uow:
+            await self.uow.session.execute(
+                text(INSERT_SQL), dict(orderid=orderid, sku=sku, batchref=batchref)
+            )
+            await self.uow.commit()
+
+    async def remove(self, orderid, sku, batchref):
+        async with self.uow:
+            await self.uow.session.execute(
+                text(DELETE_SQL), dict(orderid=orderid, sku=sku, batchref=batchref)
+            )
+            await self.uow.commit()
+
+    async def get(self, orderid):
+        async with self.uow:
+            results = await self.uow.session.execute(
+                text(SELECT_SQL), dict(orderid=orderid)
+            )
+            return [dict(r) for r in results.mappings()]
+
+
+class AsyncRedisReadModel(AbstractAsyncReadModel):
+    """RedisReadModel's hashes and sets, through an asyncio client"""
+
+    def __init__(self, client: redis.asyncio.Redis):
+        self.client = client
+
+    async def add(self, orderid, sku, batchref):
+        pipe = self.client.pipeline(transaction=False)
+        _add(pipe, orderid, sku, batchref)
+        await pipe.execute()
+
+    async def remove(self, orderid, sku, batchref):
+        pipe = self.client.pipeline(transaction=False)
+        _remove(pipe, orderid, sku, batchref)
+        await pipe.execute()
+
+    async def get(self, orderid):
+        return _allocations(await self.client.hgetall(_key(orderid)))
+
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _add(pipe, orderid: str, sku: str, batchref: str):
+    pipe.hset(_key(orderid), batchref, sku)
+    pipe.sadd(_sku_key(sku), _pair(orderid, batchref))
+
+
+def _remove(pipe, orderid: str, sku: str, batchref: str):
+    pipe.hdel(_key(orderid), batchref)
+    pipe.srem(_sku_key(sku), _pair(orderid, batchref))
+
+
+def _allocations(skus_by_batchref: dict) -> List[Allocation]:
+    return sorted(
+        (
+            {"sku": _text(sku), "batchref": _text(batchref)}
+            for batchref, sku in skus_by_batchref.items()
+        ),
+        key=lambda a: (a["sku"], a["batchref"]),
+    )
+
+
+def _key(orderid: str) -> str:
+    return f"{RedisReadModel.KEY_PREFIX}{orderid}"
+
+
+def _sku_key(sku: str) -> str:
+    return f"{RedisReadModel.SKU_KEY_PREFIX}{sku}"
+
+
+def _pair(orderid: str, batchref: str) -> str:
+    # either may contain any separator we might pick
+    return json.dumps([orderid, batchref])
+
+
+def _unpair(member) -> Tuple[str, str]:
+    orderid, batchref = json.loads(_text(member))
+    return orderid, batchref
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
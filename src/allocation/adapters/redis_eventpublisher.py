@@ -1,6 +1,10 @@
+import functools
 import json
 import logging
-from dataclasses import asdict
+import threading
+import zlib
+from dataclasses import fields
+from typing import Dict, List, Optional, Tuple
 import redis
 
 from allocation import config
@@ -8,9 +12,126 @@ from allocation.domain import events
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+
+# the clients are created on first use, so that importing this is cheap
+
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> redis.Redis:
+    pool = redis.ConnectionPool(
+        max_connections=config.get_redis_pool_size(),
+        **config.get_redis_host_and_port(),
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_client():
+    # only the asgi app needs this, and so pays for importing asyncio support
+    import redis.asyncio  # pylint: disable=import-outside-toplevel
+
+    return redis.asyncio.Redis(**config.get_redis_host_and_port())
+
+# roughly how many entries to keep in each stream
+STREAM_MAXLEN = 100_000
 
 
 def publish(channel, event: events.Event):
     logging.info("publishing: channel=%s, event=%s", channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    get_client().publish(channel, serialize(event))
+
+
+async def publish_async(channel, event: events.Event):
+    logging.info("publishing: channel=%s, event=%s", channel, event)
+    await get_async_client().publish(channel, serialize(event))
+
+
+def stream_for(channel: str, key: str, partitions: int = None) -> str:
+    """
+    Streams are partitioned by key (usually the sku), so that one consumer can
+    see all of a product's messages, in order.
+    """
+    if partitions is None:
+        partitions = config.get_stream_partitions()
+    return f"{channel}:{zlib.crc32(key.encode()) % partitions}"
+
+
+_field_names = {}  # type: Dict[type, Tuple[str, ...]]
+
+
+def serialize(event: events.Event) -> str:
+    # events are flat, so there's no need for asdict() and its deep copies
+    names = _field_names.get(type(event))
+    if names is None:
+        names = _field_names[type(event)] = tuple(f.name for f in fields(event))
+    return json.dumps({name: getattr(event, name) for name in names})
+
+
+class BufferedPublisher:
+    """
+    A publish() that buffers messages and sends them in a single pipeline:
+    when max_batch messages are waiting, max_delay seconds after the first
+    one arrived, or when flush() is called, eg by the bus at the end of
+    handling a message. With streams=True, messages are added to partitioned
+    streams (see stream_for) rather than published to pubsub channels.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        max_batch=100,
+        max_delay: Optional[float] = 0.05,
+        streams: bool = False,
+    ):
+        self._client = client
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.streams = streams
+        self._buffer = []  # type: List[Tuple[str, str]]
+        self._lock = threading.Lock()
+        self._timer = None  # type: Optional[threading.Timer]
+
+    @property
+    def client(self) -> redis.Redis:
+        return self._client if self._client is not None else get_client()
+
+    def __call__(self, channel, event: events.Event):
+        logger.debug("buffering: channel=%s, event=%s", channel, event)
+        message = serialize(event)
+        if self.streams:
+            channel = stream_for(channel, event.sku)
+        with self._lock:
+            self._buffer.append((channel, message))
+            full = len(self._buffer) >= self.max_batch
+            if not full and self._timer is None and self.max_delay is not None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            buffered, self._buffer = self._buffer, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not buffered:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for channel, message in buffered:
+                if self.streams:
+                    pipe.xadd(
+                        channel,
+                        {"data": message},
+                        maxlen=STREAM_MAXLEN,
+                        approximate=True,
+                    )
+                else:
+                    pipe.publish(channel, message)
+            pipe.execute()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Exception publishing %s messages", len(buffered))
+        else:
+            logger.info("published %s messages", len(buffered))
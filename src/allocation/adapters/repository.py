@@ -1,5 +1,12 @@
 import abc
-from typing import Set
+import csv
+import io
+from collections import OrderedDict, defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, noload, selectinload, undefer
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from allocation.adapters import orm
 from allocation.domain import model
 
@@ -24,6 +31,29 @@ class AbstractRepository(abc.ABC):
             self.seen.add(product)
         return product
 
+    def get_for_allocation(self, sku) -> model.Product:
+        """
+        Like get(), but the product's batches may be limited to the ones that
+        still have room. Only use it for allocating; get() and
+        get_by_batchref() still return the whole product afterwards.
+        """
+        product = self._get_for_allocation(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
+    def add_batches(self, batches: List[model.Batch]):
+        """
+        Adds new batches, and products for any skus that don't have one yet,
+        in bulk. Products already loaded through this repository won't see
+        them.
+        """
+        self._add_batches(batches)
+
+    def existing_batchrefs(self, batchrefs: Iterable[str]) -> Set[str]:
+        """the ones among batchrefs that are already in use"""
+        return self._existing_batchrefs(batchrefs)
+
     @abc.abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
@@ -36,24 +66,390 @@ class AbstractRepository(abc.ABC):
     def _get_by_batchref(self, batchref) -> model.Product:
         raise NotImplementedError
 
+    def _get_for_allocation(self, sku) -> model.Product:
+        return self._get(sku)
+
+    def _add_batches(self, batches: List[model.Batch]):
+        for batch in batches:
+            product = self._get(batch.sku)
+            if product is None:
+                product = model.Product(batch.sku, batches=[])
+                self._add(product)
+            product.add_batch(batch)
+
+    def _existing_batchrefs(self, batchrefs: Iterable[str]) -> Set[str]:
+        return {ref for ref in batchrefs if self._get_by_batchref(ref) is not None}
+
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session):
+    """
+    load_strategy says how a product's batches and their allocations are
+    loaded: "selectin" and "joined" load the whole aggregate in a fixed number
+    of queries, "lazy" loads each collection when it is first touched.
+
+    "capacity" loads each batch's allocated total, summed in SQL, instead of
+    its lines. Allocating never loads them: new lines are just added, and
+    whether a line is allocated already is asked of the database. Elsewhere
+    a batch's lines are loaded if something touches them, eg when
+    change_batch_quantity has to deallocate.
+    """
+
+    LOAD_STRATEGIES = ("selectin", "joined", "lazy", "capacity")
+
+    def __init__(self, session, load_strategy="selectin"):
         super().__init__()
+        if load_strategy not in self.LOAD_STRATEGIES:
+            raise ValueError(f"Unknown load strategy {load_strategy!r}")
         self.session = session
+        self.load_strategy = load_strategy
+        # what get_for_allocation didn't load, see _loaded_whole
+        self._batches_not_loaded = set()  # type: Set[model.Product]
+        self._lines_not_loaded = set()  # type: Set[model.Batch]
 
     def _add(self, product):
         self.session.add(product)
 
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        return self._loaded_whole(self._query().filter_by(sku=sku).first())
 
-    def _get_by_batchref(self, batchref):
-        return (
+    def _get_for_allocation(self, sku):
+        # a product already in the session is handed back as it is
+        in_session = self.session.identity_map.get(identity_key(model.Product, sku))
+        loading = in_session is None or "batches" not in in_session.__dict__
+        # full batches can't take the line, so don't load them or their lines
+        open_batches = selectinload(model.Product.batches.and_(_has_room()))
+        if self.load_strategy == "capacity":
+            open_batches = open_batches.options(
+                undefer(model.Batch._persisted_allocated_quantity),
+                noload(model.Batch._allocations),
+            )
+        else:
+            open_batches = open_batches.selectinload(model.Batch._allocations)
+        product = (
             self.session.query(model.Product)
+            .options(open_batches)
+            .filter_by(sku=sku)
+            .first()
+        )
+        if product is None or not loading:
+            return product
+        self._batches_not_loaded.add(product)
+        if self.load_strategy == "capacity":
+            for batch in product.batches:
+                batch._find_unloaded_line = self._allocated_in_database
+                self._lines_not_loaded.add(batch)
+        return product
+
+    def _get_by_batchref(self, batchref):
+        product = (
+            self._query()
             .join(model.Batch)
             .filter(
                 orm.batches.c.reference == batchref,
             )
             .first()
         )
+        return self._loaded_whole(product)
+
+    def _loaded_whole(self, product: Optional[model.Product]):
+        """
+        product, with whatever get_for_allocation left out of it loaded too,
+        as the session hands back the product it loaded then as it is
+        """
+        if product in self._batches_not_loaded:
+            self._load_batches(product)
+        if product is not None:
+            batches = [b for b in product.batches if b in self._lines_not_loaded]
+            if batches:
+                self._load_lines(batches)
+        return product
+
+    def _load_batches(self, product: model.Product):
+        # the batches already loaded come back as they are, with any changes
+        query = self.session.query(model.Batch).filter_by(sku=product.sku)
+        if self.load_strategy == "selectin":
+            query = query.options(selectinload(model.Batch._allocations))
+        elif self.load_strategy == "joined":
+            query = query.options(joinedload(model.Batch._allocations))
+        elif self.load_strategy == "capacity":
+            query = query.options(undefer(model.Batch._persisted_allocated_quantity))
+        loaded = {b.reference for b in product.batches}
+        missing = [b for b in query.all() if b.reference not in loaded]
+        set_committed_value(product, "batches", product.batches + missing)
+        self._batches_not_loaded.discard(product)
+
+    def _load_lines(self, batches: List[model.Batch]):
+        # nothing is flushed first, so add the lines allocated to each batch
+        # since it was loaded back on top of the ones in the database, as
+        # changes, so that they're still inserted
+        batch_ids = [b.id for b in batches]
+        rows = (
+            self.session.query(orm.allocations.c.batch_id, model.OrderLine)
+            .join(orm.allocations)
+            .filter(orm.allocations.c.batch_id.in_(batch_ids))
+        )
+        lines_by_batch_id = defaultdict(set)  # type: Dict[int, Set[model.OrderLine]]
+        for batch_id, line in rows:
+            lines_by_batch_id[batch_id].add(line)
+        for batch in batches:
+            added = set(batch._allocations)
+            set_committed_value(batch, "_allocations", lines_by_batch_id[batch.id])
+            batch._allocations.update(added)
+            batch._find_unloaded_line = None
+            self._lines_not_loaded.discard(batch)
+
+    def _allocated_in_database(self, batch: model.Batch, line: model.OrderLine):
+        query = (
+            select(orm.allocations.c.id)
+            .select_from(orm.allocations.join(orm.order_lines))
+            .where(
+                orm.allocations.c.batch_id == batch.id,
+                orm.order_lines.c.orderid == line.orderid,
+                orm.order_lines.c.sku == line.sku,
+                orm.order_lines.c.qty == line.qty,
+            )
+        )
+        return self.session.execute(select(query.exists())).scalar()
+
+    def _add_batches(self, batches):
+        if not batches:
+            return
+        self.session.flush()
+        # bump existing products' versions, so that anyone holding one in
+        # memory finds out it has new batches; in sku order, so concurrent
+        # imports take the products' locks in the same order
+        self.session.execute(
+            """
+            INSERT INTO products (sku, version_number) VALUES (:sku, 0)
+            ON CONFLICT (sku) DO UPDATE
+            SET version_number = products.version_number + 1
+            """,
+            [dict(sku=sku) for sku in sorted({b.sku for b in batches})],
+        )
+        connection = self.session.connection()
+        if connection.dialect.name == "postgresql":
+            _copy_batches(connection, batches)
+        else:
+            connection.execute(
+                orm.batches.insert(),
+                [
+                    dict(
+                        reference=b.reference,
+                        sku=b.sku,
+                        _purchased_quantity=b._purchased_quantity,
+                        eta=b.eta,
+                    )
+                    for b in batches
+                ],
+            )
+
+    def _existing_batchrefs(self, batchrefs):
+        batchrefs = list(batchrefs)
+        if not batchrefs:
+            return set()
+        results = self.session.execute(
+            select(orm.batches.c.reference).where(
+                orm.batches.c.reference.in_(batchrefs)
+            )
+        )
+        return {row.reference for row in results}
+
+    def _query(self):
+        query = self.session.query(model.Product)
+        if self.load_strategy == "selectin":
+            batches = selectinload(model.Product.batches)
+            return query.options(batches.selectinload(model.Batch._allocations))
+        if self.load_strategy == "joined":
+            batches = joinedload(model.Product.batches)
+            return query.options(batches.joinedload(model.Batch._allocations))
+        if self.load_strategy == "capacity":
+            batches = selectinload(model.Product.batches)
+            allocated = model.Batch._persisted_allocated_quantity
+            return query.options(batches.undefer(allocated))
+        return query
+
+
+class CachingRepository(SqlAlchemyRepository):
+    """
+    Keeps up to max_size whole products in memory, dropping the least
+    recently used first, for a session that outlives its units of work, so
+    that a hot sku isn't loaded again for every command.
+
+    Anything else that changes a product bumps its version_number, eg the
+    Redis consumer or a batch import, so with validate (the default) a cached
+    product's version is checked with a one-row select before it's used, and
+    it's loaded again if it's out of date. Turning validate off is only safe
+    when every write to these skus goes through this process: a stale copy
+    that's only read, eg to allocate against, isn't otherwise noticed.
+    """
+
+    def __init__(
+        self, session, load_strategy="selectin", max_size=1000, validate=True
+    ):
+        super().__init__(session, load_strategy=load_strategy)
+        self.max_size = max_size
+        self.validate = validate
+        self._products = OrderedDict()  # type: OrderedDict[str, model.Product]
+        # a batch never changes product
+        self._skus_by_batchref = {}  # type: Dict[str, str]
+
+    def clear(self):
+        self._products.clear()
+        self._skus_by_batchref.clear()
+
+    def _add(self, product):
+        super()._add(product)
+        self._cache(product)
+
+    def _get(self, sku):
+        product = self._cached(sku)
+        if product is None:
+            product = super()._get(sku)
+            if product is not None:
+                self._cache(product)
+        return product
+
+    def _get_for_allocation(self, sku):
+        # only whole products are cached, so the next command can use them too
+        return self._get(sku)
+
+    def _get_by_batchref(self, batchref):
+        sku = self._skus_by_batchref.get(batchref)
+        product = self._cached(sku) if sku is not None else None
+        if product is None:
+            product = super()._get_by_batchref(batchref)
+            if product is not None:
+                self._cache(product)
+        return product
+
+    def _add_batches(self, batches):
+        super()._add_batches(batches)
+        for sku in {b.sku for b in batches}:
+            self._evict(sku)
+
+    def _cached(self, sku: str) -> Optional[model.Product]:
+        product = self._products.get(sku)
+        if product is None:
+            return None
+        # a product seen in this unit of work may have uncommitted changes
+        if self.validate and product not in self.seen:
+            version = self.session.execute(
+                select(orm.products.c.version_number).where(
+                    orm.products.c.sku == sku
+                )
+            ).scalar()
+            if version != product.version_number:
+                self._evict(sku)
+                return None
+        self._products.move_to_end(sku)
+        return product
+
+    def _cache(self, product: model.Product):
+        self._products[product.sku] = product
+        self._products.move_to_end(product.sku)
+        for batch in product.batches:
+            self._skus_by_batchref[batch.reference] = product.sku
+        while len(self._products) > self.max_size:
+            # the session only holds it weakly, so once it's flushed it's gone
+            _, evicted = self._products.popitem(last=False)
+            for batch in evicted.batches:
+                self._skus_by_batchref.pop(batch.reference, None)
+
+    def _evict(self, sku: str):
+        # out of the session too, so that loading it again doesn't just hand
+        # back the same out of date objects
+        product = self._products.pop(sku, None)
+        if product is None:
+            return
+        for instance in [*product.batches, product]:
+            if instance in self.session:
+                self.session.expunge(instance)
+        for batch in product.batches:
+            self._skus_by_batchref.pop(batch.reference, None)
+
+
+def _has_room():
+    return orm.batches.c._purchased_quantity > orm.allocated_quantity_of_batch()
+
+
+def _copy_batches(connection, batches: List[model.Batch]):
+    # COPY is postgres' fastest way in, far quicker than even multi-row INSERTs
+    rows = io.StringIO()
+    writer = csv.writer(rows)
+    for b in batches:
+        eta = b.eta.isoformat() if b.eta else ""  # an unquoted empty field is NULL
+        writer.writerow([b.reference, b.sku, b._purchased_quantity, eta])
+    rows.seek(0)
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(
+            "COPY batches (reference, sku, _purchased_quantity, eta)"
+            " FROM STDIN WITH (FORMAT csv)",
+            rows,
+        )
+
+
+class AbstractAsyncRepository(abc.ABC):
+    def __init__(self):
+        self.seen = set()  # type: Set[model.Product]
+
+    def add(self, product: model.Product):
+        self._add(product)
+        self.seen.add(product)
+
+    async def get(self, sku) -> model.Product:
+        product = await self._get(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
+    async def get_by_batchref(self, batchref) -> model.Product:
+        product = await self._get_by_batchref(batchref)
+        if product:
+            self.seen.add(product)
+        return product
+
+    @abc.abstractmethod
+    def _add(self, product: model.Product):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get(self, sku) -> model.Product:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _get_by_batchref(self, batchref) -> model.Product:
+        raise NotImplementedError
+
+
+class AsyncSqlAlchemyRepository(AbstractAsyncRepository):
+    """
+    Lazy loading can't do IO under asyncio, so the whole aggregate is loaded
+    up front.
+    """
+
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+
+    def _add(self, product):
+        self.session.add(product)
+
+    async def _get(self, sku):
+        result = await self.session.execute(
+            _select_whole_product().filter_by(sku=sku)
+        )
+        return result.scalars().first()
+
+    async def _get_by_batchref(self, batchref):
+        result = await self.session.execute(
+            _select_whole_product()
+            .join(model.Batch)
+            .filter(orm.batches.c.reference == batchref)
+        )
+        return result.scalars().first()
+
+
+def _select_whole_product():
+    return select(model.Product).options(
+        selectinload(model.Product.batches).selectinload(model.Batch._allocations)
+    )
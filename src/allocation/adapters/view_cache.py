@@ -0,0 +1,118 @@
+import abc
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Tuple
+from allocation.adapters import metrics as cache_metrics
+
+# when it expires, and the cached value
+Entry = Tuple[float, Any]
+
+
+class AbstractViewCache(abc.ABC):
+    @abc.abstractmethod
+    def get_or_load(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def invalidate(self, key: Hashable):
+        raise NotImplementedError
+
+
+class NoViewCache(AbstractViewCache):
+    def get_or_load(self, key, load):
+        return load()
+
+    def invalidate(self, key):
+        pass
+
+
+class LRUViewCache(AbstractViewCache):
+    """
+    Keeps up to max_size results, each for at most ttl seconds, dropping the
+    least recently used first. Safe to share between threads.
+
+    Invalidation only reaches this process: anything written by another
+    process can be served stale for up to ttl seconds. Empty results, eg for
+    an order that has nothing allocated yet, aren't kept, so that an order's
+    first allocation is never hidden that way.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10_000,
+        ttl: float = 30.0,
+        metrics: cache_metrics.AbstractMetrics = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.metrics = metrics if metrics is not None else cache_metrics.NoMetrics()
+        self.clock = clock
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._entries = OrderedDict()  # type: OrderedDict[Hashable, Entry]
+        self._lock = threading.Lock()
+        # for each key being loaded, how many loads are in flight and how many
+        # times it has been invalidated meanwhile, see get_or_load
+        self._loading = {}  # type: Dict[Hashable, int]
+        self._invalidations = {}  # type: Dict[Hashable, int]
+
+    def get_or_load(self, key, load):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self._count("hits")
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+                self._count("expirations")
+            self._count("misses")
+            self._loading[key] = self._loading.get(key, 0) + 1
+            invalidations = self._invalidations.get(key, 0)
+
+        try:
+            value = load()
+        except BaseException:
+            with self._lock:
+                self._done_loading(key)
+            raise
+
+        with self._lock:
+            # if the key was invalidated while we were loading, what we loaded
+            # may already be out of date, so don't keep it
+            fresh = self._invalidations.get(key, 0) == invalidations
+            self._done_loading(key)
+            if fresh and value:
+                self._entries[key] = (self.clock() + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self._count("evictions")
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            if key in self._loading:
+                self._invalidations[key] = self._invalidations.get(key, 0) + 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                size=len(self._entries),
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                expirations=self.expirations,
+            )
+
+    def _done_loading(self, key: Hashable):
+        self._loading[key] -= 1
+        if not self._loading[key]:
+            del self._loading[key]
+            self._invalidations.pop(key, None)
+
+    def _count(self, counter: str):
+        setattr(self, counter, getattr(self, counter) + 1)
+        self.metrics.increment(f"view_cache.{counter}")
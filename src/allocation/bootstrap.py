@@ -1,51 +1,289 @@
+import functools
 import inspect
-from typing import Callable
+import threading
+from typing import Any, Callable, Dict, List
+from allocation import config, views
 from allocation.adapters import orm, redis_eventpublisher
+from allocation.adapters.metrics import AbstractMetrics
 from allocation.adapters.notifications import (
     AbstractNotifications,
+    DigestingNotifications,
     EmailNotifications,
 )
-from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.adapters.read_model import (
+    AbstractAsyncReadModel,
+    AbstractReadModel,
+    AsyncRedisReadModel,
+    AsyncSqlReadModel,
+    RedisReadModel,
+    SqlReadModel,
+)
+from allocation.adapters.view_cache import AbstractViewCache, NoViewCache
+from allocation.service_layer import (
+    async_handlers,
+    async_unit_of_work,
+    background as background_dispatch,
+    handlers,
+    messagebus,
+    sharding,
+    unit_of_work,
+)
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
+    uow: unit_of_work.AbstractUnitOfWork = None,
     notifications: AbstractNotifications = None,
-    publish: Callable = redis_eventpublisher.publish,
+    publish: Callable = None,
+    metrics: AbstractMetrics = None,
+    background: background_dispatch.BackgroundEventDispatcher = None,
+    background_uow: Callable[
+        [], unit_of_work.AbstractUnitOfWork
+    ] = unit_of_work.SqlAlchemyUnitOfWork,
+    view_cache: AbstractViewCache = None,
+    read_model: AbstractReadModel = None,
 ) -> messagebus.MessageBus:
 
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+
     if notifications is None:
+        # not make_notifications(): nothing here would close a digest
         notifications = EmailNotifications()
 
+    if view_cache is None:
+        view_cache = NoViewCache()
+
+    # unless we're given one, every unit of work gets a read model of its own
+    own_read_model = read_model is None
+    if own_read_model:
+        read_model = make_read_model(uow)
+
+    if publish is None:
+        publish = redis_eventpublisher.BufferedPublisher(
+            streams=config.get_event_transport() == "streams"
+        )
+
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {"uow": uow, "notifications": notifications, "publish": publish}
-    injected_event_handlers = {
-        event_type: [
-            inject_dependencies(handler, dependencies)
-            for handler in event_handlers
-        ]
-        for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
-    }
-    injected_command_handlers = {
-        command_type: inject_dependencies(handler, dependencies)
-        for command_type, handler in handlers.COMMAND_HANDLERS.items()
+    dependencies = {
+        "uow": uow,
+        "notifications": notifications,
+        "publish": publish,
+        "view_cache": view_cache,
+        "read_model": read_model,
     }
+    event_handlers = handlers.EVENT_HANDLERS
+    if uow.uses_outbox:
+        # the outbox relay does the publishing
+        event_handlers = {
+            event_type: [h for h in hs if h is not handlers.publish_allocated_event]
+            for event_type, hs in event_handlers.items()
+        }
+    if background is not None:
+        side_effect_handlers = {
+            event_type: [h for h in hs if h in handlers.SIDE_EFFECT_HANDLERS]
+            for event_type, hs in event_handlers.items()
+        }
+        event_handlers = {
+            event_type: [h for h in hs if h not in handlers.SIDE_EFFECT_HANDLERS]
+            for event_type, hs in event_handlers.items()
+        }
+
+        def make_background_handlers():
+            # each worker gets a unit of work of its own, they can't share ours
+            worker_uow = background_uow()
+            worker_dependencies = dict(dependencies, uow=worker_uow)
+            if own_read_model:
+                worker_dependencies["read_model"] = make_read_model(worker_uow)
+            return inject_event_handlers(side_effect_handlers, worker_dependencies)
+
+        # a dispatcher that's already started is shared as it is, eg by the
+        # buses of bootstrap_sharded
+        if not background.started:
+            background.start(make_background_handlers)
+
+    flushers = []
+    if isinstance(publish, redis_eventpublisher.BufferedPublisher):
+        flushers.append(publish.flush)
 
     return messagebus.MessageBus(
         uow=uow,
-        event_handlers=injected_event_handlers,
-        command_handlers=injected_command_handlers,
+        event_handlers=inject_event_handlers(event_handlers, dependencies),
+        command_handlers=inject_command_handlers(
+            handlers.COMMAND_HANDLERS, dependencies
+        ),
+        metrics=metrics,
+        background=background,
+        flushers=flushers,
+    )
+
+
+class DeferredBus:
+    """
+    Stands in for the bus that make_bus returns, and only calls it when the
+    first message arrives, so that a process can start up, and eg serve
+    health checks, before anything is wired up.
+    """
+
+    def __init__(self, make_bus: Callable[[], Any]):
+        self._make_bus = make_bus
+        self._bus = None  # type: Any
+        self._lock = threading.Lock()
+
+    @property
+    def started(self) -> bool:
+        return self._bus is not None
+
+    @property
+    def bus(self):
+        if self._bus is None:
+            with self._lock:
+                if self._bus is None:
+                    self._bus = self._make_bus()
+        return self._bus
+
+    def handle(self, message):
+        return self.bus.handle(message)
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+
+def make_notifications() -> AbstractNotifications:
+    """call close() on what this returns before exiting"""
+    notifications = EmailNotifications()  # type: AbstractNotifications
+    window = config.get_notification_digest_window()
+    if window:
+        notifications = DigestingNotifications(notifications, window=window)
+    return notifications
+
+
+def bootstrap_sharded(
+    workers: int,
+    make_uow: Callable[
+        [], unit_of_work.SqlAlchemyUnitOfWork
+    ] = unit_of_work.SqlAlchemyUnitOfWork,
+    start_orm: bool = True,
+    make_worker_uow: Callable[[], unit_of_work.SqlAlchemyUnitOfWork] = None,
+    **kwargs,
+) -> sharding.ShardedCommandDispatcher:
+    """
+    A bus per worker, each with a unit of work from make_worker_uow, or else
+    make_uow, which the read side uses; any other arguments are passed on to
+    bootstrap(). A background dispatcher is started once, by the first
+    worker's bus, and shared by them all.
+    """
+    if start_orm:
+        orm.start_mappers()
+    if make_worker_uow is None:
+        make_worker_uow = make_uow
+
+    dispatcher = sharding.ShardedCommandDispatcher(workers=workers)
+    dispatcher.uow = make_uow()
+    dispatcher.start(
+        lambda: bootstrap(start_orm=False, uow=make_worker_uow(), **kwargs),
+        resolve_sku=lambda batchref: views.sku_for_batchref(batchref, make_uow()),
+    )
+    return dispatcher
+
+
+def bootstrap_async(
+    start_orm: bool = True,
+    uow: async_unit_of_work.AbstractAsyncUnitOfWork = None,
+    notifications: AbstractNotifications = None,
+    publish: Callable = redis_eventpublisher.publish_async,
+    metrics: AbstractMetrics = None,
+    read_model: AbstractAsyncReadModel = None,
+) -> messagebus.AsyncMessageBus:
+
+    if uow is None:
+        uow = async_unit_of_work.AsyncSqlAlchemyUnitOfWork()
+
+    if notifications is None:
+        # not make_notifications(): nothing here would close a digest
+        notifications = EmailNotifications()
+
+    if read_model is None:
+        read_model = make_async_read_model(uow)
+
+    if start_orm:
+        orm.start_mappers()
+
+    dependencies = {
+        "uow": uow,
+        "notifications": notifications,
+        "publish": publish,
+        "read_model": read_model,
+    }
+    return messagebus.AsyncMessageBus(
+        uow=uow,
+        event_handlers=inject_event_handlers(
+            async_handlers.EVENT_HANDLERS, dependencies
+        ),
+        command_handlers=inject_command_handlers(
+            async_handlers.COMMAND_HANDLERS, dependencies
+        ),
+        metrics=metrics,
     )
 
 
+def make_read_model(uow: unit_of_work.SqlAlchemyUnitOfWork) -> AbstractReadModel:
+    if config.get_read_model() == "redis":
+        return RedisReadModel()
+    return SqlReadModel(uow)
+
+
+def make_async_read_model(
+    uow: async_unit_of_work.AsyncSqlAlchemyUnitOfWork,
+) -> AbstractAsyncReadModel:
+    if config.get_read_model() == "redis":
+        return AsyncRedisReadModel(redis_eventpublisher.get_async_client())
+    return AsyncSqlReadModel(uow)
+
+
+def inject_event_handlers(event_handlers: Dict[type, List[Callable]], dependencies):
+    return {
+        event_type: [
+            inject_dependencies(handler, dependencies) for handler in type_handlers
+        ]
+        for event_type, type_handlers in event_handlers.items()
+    }
+
+
+def inject_command_handlers(command_handlers: Dict[type, Callable], dependencies):
+    return {
+        command_type: inject_dependencies(handler, dependencies)
+        for command_type, handler in command_handlers.items()
+    }
+
+
 def inject_dependencies(handler, dependencies):
+    """
+    handler, with the dependencies it names bound to it, done once here so
+    that calling it costs as little as possible per message: when they're
+    the parameters straight after the message, they're passed positionally,
+    with no dict to build for each call.
+    """
     params = inspect.signature(handler).parameters
     deps = {
         name: dependency
         for name, dependency in dependencies.items()
         if name in params
     }
-    return lambda message: handler(message, **deps)
+    if not deps:
+        return handler
+    leading = [
+        p.name
+        for p in list(params.values())[1 : len(deps) + 1]
+        if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)
+    ]
+    if set(leading) != set(deps):
+        return functools.update_wrapper(functools.partial(handler, **deps), handler)
+    args = tuple(deps[name] for name in leading)
+
+    def shim(message):
+        return handler(message, *args)
+
+    return functools.update_wrapper(shim, handler)
@@ -1,12 +1,18 @@
 import os
 
 
-def get_postgres_uri():
+def get_postgres_uri(driver=None):
     host = os.environ.get("DB_HOST", "localhost")
     port = 54321 if host == "localhost" else 5432
     password = os.environ.get("DB_PASSWORD", "abc123")
     user, db_name = "allocation", "allocation"
-    return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
+    scheme = f"postgresql+{driver}" if driver else "postgresql"
+    return f"{scheme}://{user}:{password}@{host}:{port}/{db_name}"
+
+
+def get_isolation_level():
+    # "READ COMMITTED" relies on the optimistic check on products.version_number
+    return os.environ.get("DB_ISOLATION_LEVEL", "REPEATABLE READ")
 
 
 def get_api_url():
@@ -21,8 +27,71 @@ def get_redis_host_and_port():
     return dict(host=host, port=port)
 
 
+def get_redis_pool_size():
+    return int(os.environ.get("REDIS_POOL_SIZE", "10"))
+
+
+def get_event_transport():
+    # "pubsub", or "streams" for redis streams with consumer groups
+    return os.environ.get("EVENT_TRANSPORT", "pubsub")
+
+
+def get_stream_partitions():
+    return int(os.environ.get("STREAM_PARTITIONS", "8"))
+
+
+def get_consumer_index_and_count():
+    index = int(os.environ.get("CONSUMER_INDEX", "0"))
+    count = int(os.environ.get("CONSUMER_COUNT", "1"))
+    return index, count
+
+
 def get_email_host_and_port():
     host = os.environ.get("EMAIL_HOST", "localhost")
     port = 11025 if host == "localhost" else 1025
     http_port = 18025 if host == "localhost" else 8025
     return dict(host=host, port=port, http_port=http_port)
+
+
+def get_notification_digest_window():
+    # seconds to collect notifications for before sending them as one digest;
+    # 0 sends each one straight away, on the thread that raised it
+    return float(os.environ.get("NOTIFICATION_DIGEST_WINDOW", "0"))
+
+
+def get_background_workers():
+    return int(os.environ.get("BACKGROUND_WORKERS", "0"))
+
+
+def get_load_strategy():
+    # see SqlAlchemyRepository for the choices
+    return os.environ.get("LOAD_STRATEGY", "selectin")
+
+
+def get_command_workers():
+    return int(os.environ.get("COMMAND_WORKERS", "0"))
+
+
+def get_product_cache_size_and_validate():
+    # only used with COMMAND_WORKERS; off by default. Cached products are
+    # checked against the database unless PRODUCT_CACHE_VALIDATE=0, which is
+    # only safe if nothing but the workers writes to products
+    size = int(os.environ.get("PRODUCT_CACHE_SIZE", "0"))
+    validate = os.environ.get("PRODUCT_CACHE_VALIDATE", "1") != "0"
+    return size, validate
+
+
+def get_view_cache_size_and_ttl():
+    # off by default: other processes' writes are only seen once entries expire
+    size = int(os.environ.get("VIEW_CACHE_SIZE", "0"))
+    ttl = float(os.environ.get("VIEW_CACHE_TTL", "30"))
+    return size, ttl
+
+
+def get_read_model():
+    # "sql" for the allocations_view table, or "redis"
+    return os.environ.get("READ_MODEL", "sql")
+
+
+def get_use_outbox():
+    return os.environ.get("USE_OUTBOX", "") == "1"
@@ -1,13 +1,15 @@
 # pylint: disable=too-few-public-methods
 from datetime import date
-from typing import Optional
+from typing import List, Optional
 from dataclasses import dataclass
+from .slots import slotted
 
 
 class Command:
-    pass
+    __slots__ = ()
 
 
+@slotted
 @dataclass
 class Allocate(Command):
     orderid: str
@@ -15,6 +17,13 @@ class Allocate(Command):
     qty: int
 
 
+@slotted
+@dataclass
+class AllocateMany(Command):
+    lines: List[Allocate]
+
+
+@slotted
 @dataclass
 class CreateBatch(Command):
     ref: str
@@ -23,7 +32,20 @@ class CreateBatch(Command):
     eta: Optional[date] = None
 
 
+@slotted
 @dataclass
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
+
+
+@slotted
+@dataclass
+class ChangeBatchQuantities(Command):
+    changes: List[ChangeBatchQuantity]
+
+
+@slotted
+@dataclass
+class ImportBatches(Command):
+    batches: List[CreateBatch]
@@ -1,11 +1,13 @@
 # pylint: disable=too-few-public-methods
 from dataclasses import dataclass
+from .slots import slotted
 
 
 class Event:
-    pass
+    __slots__ = ()
 
 
+@slotted
 @dataclass
 class Allocated(Event):
     orderid: str
@@ -14,13 +16,16 @@ class Allocated(Event):
     batchref: str
 
 
+@slotted
 @dataclass
 class Deallocated(Event):
     orderid: str
     sku: str
     qty: int
+    batchref: str
 
 
+@slotted
 @dataclass
 class OutOfStock(Event):
     sku: str
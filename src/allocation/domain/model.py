@@ -1,7 +1,8 @@
 from __future__ import annotations
+import bisect
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List, Set
+from typing import Callable, Optional, List, Set
 from . import commands, events
 
 
@@ -11,31 +12,115 @@ class Product:
         self.batches = batches
         self.version_number = version_number
         self.events = []  # type: List[events.Event]
+        self._batch_index = None  # type: Optional[BatchIndex]
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        if self._batch_index is not None:
+            self._batch_index.add(batch)
 
     def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1
-            self.events.append(
-                events.Allocated(
-                    orderid=line.orderid,
-                    sku=line.sku,
-                    qty=line.qty,
-                    batchref=batch.reference,
-                )
-            )
-            return batch.reference
-        except StopIteration:
+        batch = self._first_batch_that_can_allocate(line)
+        if batch is None:
             self.events.append(events.OutOfStock(line.sku))
             return None
+        batch.allocate(line)
+        if batch.available_quantity <= 0:
+            self._batch_index.remove(batch)
+        self.version_number += 1
+        self.events.append(
+            events.Allocated(
+                orderid=line.orderid,
+                sku=line.sku,
+                qty=line.qty,
+                batchref=batch.reference,
+            )
+        )
+        return batch.reference
 
     def change_batch_quantity(self, ref: str, qty: int):
         batch = next(b for b in self.batches if b.reference == ref)
         batch._purchased_quantity = qty
+        self.version_number += 1
         while batch.available_quantity < 0:
             line = batch.deallocate_one()
-            self.events.append(events.Deallocated(line.orderid, line.sku, line.qty))
+            self.events.append(
+                events.Deallocated(line.orderid, line.sku, line.qty, batch.reference)
+            )
+        index = self._get_batch_index()
+        if batch.available_quantity > 0 and batch not in index:
+            index.reopen(batch)
+        elif batch.available_quantity <= 0 and batch in index:
+            index.remove(batch)
+
+    def _get_batch_index(self) -> BatchIndex:
+        # rebuild if someone has appended to self.batches behind our back
+        index = self._batch_index
+        if index is None or index.batch_count != len(self.batches):
+            self._batch_index = index = BatchIndex(self.batches)
+        return index
+
+    def _first_batch_that_can_allocate(self, line: OrderLine) -> Optional[Batch]:
+        # full batches are only noticed when we get to them, so that building
+        # the index doesn't need to know the allocations of every batch
+        index = self._get_batch_index()
+        full, found = [], None
+        for batch in index:
+            if batch.available_quantity <= 0:
+                full.append(batch)
+            elif batch.can_allocate(line):
+                found = batch
+                break
+        for batch in full:
+            index.remove(batch)
+        return found
+
+
+class BatchIndex:
+    """
+    The batches of a product that may still have room, in allocation order:
+    warehouse stock first, then shipments by eta.
+    """
+
+    def __init__(self, batches: List[Batch]):
+        self._batches = sorted(batches, key=allocation_order)
+        self._keys = [allocation_order(b) for b in self._batches]
+        self.batch_count = len(batches)  # including the ones removed for being full
+
+    def __iter__(self):
+        return iter(self._batches)
+
+    def __contains__(self, batch: Batch):
+        return self._position(batch) is not None
+
+    def add(self, batch: Batch):
+        self.reopen(batch)
+        self.batch_count += 1
+
+    def reopen(self, batch: Batch):
+        key = allocation_order(batch)
+        position = bisect.bisect_right(self._keys, key)
+        self._keys.insert(position, key)
+        self._batches.insert(position, batch)
+
+    def remove(self, batch: Batch):
+        position = self._position(batch)
+        if position is not None:
+            del self._keys[position]
+            del self._batches[position]
+
+    def _position(self, batch: Batch) -> Optional[int]:
+        key = allocation_order(batch)
+        start = bisect.bisect_left(self._keys, key)
+        end = bisect.bisect_right(self._keys, key)
+        for position in range(start, end):
+            if self._batches[position] is batch:
+                return position
+        return None
+
+
+def allocation_order(batch: Batch):
+    return (batch.eta is not None, batch.eta or date.min)
 
 
 @dataclass(unsafe_hash=True)
@@ -52,6 +137,10 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        self._allocated_quantity = 0  # type: Optional[int]
+        # set by a repository that didn't load the lines allocated so far, to
+        # look for one among them
+        self._find_unloaded_line = None  # type: Optional[UnloadedLineFinder]
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -72,15 +161,28 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and not self.has_allocated(line):
             self._allocations.add(line)
+            self._allocated_quantity = self.allocated_quantity + line.qty
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated_quantity = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated_quantity - line.qty
+        return line
+
+    def has_allocated(self, line: OrderLine) -> bool:
+        if line in self._allocations:
+            return True
+        find = self._find_unloaded_line
+        return find is not None and find(self, line)
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # None means "not counted yet", eg for a batch freshly loaded by the ORM
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -88,3 +190,6 @@ class Batch:
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
+
+
+UnloadedLineFinder = Callable[[Batch, OrderLine], bool]
@@ -0,0 +1,21 @@
+from dataclasses import fields
+from typing import Type, TypeVar
+
+T = TypeVar("T")
+
+
+def slotted(cls: Type[T]) -> Type[T]:
+    """
+    cls, a dataclass, remade with __slots__ for its fields and so without a
+    __dict__ per instance, as dataclass(slots=True) does from Python 3.10.
+    Its bases need empty __slots__ for this to save anything.
+    """
+    names = tuple(field.name for field in fields(cls))
+    namespace = {
+        key: value
+        for key, value in cls.__dict__.items()
+        # defaults are already bound into __init__
+        if key not in names and key not in ("__dict__", "__weakref__")
+    }
+    namespace["__slots__"] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
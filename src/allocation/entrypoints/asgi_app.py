@@ -0,0 +1,88 @@
+import asyncio
+import functools
+from datetime import datetime
+from quart import Quart, jsonify, request
+from allocation.domain import commands
+from allocation.service_layer import async_unit_of_work
+from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.unit_of_work import ConcurrencyError
+from allocation import bootstrap, views
+
+app = Quart(__name__)
+uow = async_unit_of_work.AsyncSqlAlchemyUnitOfWork()
+notifications = bootstrap.make_notifications()
+
+
+@functools.lru_cache(maxsize=None)
+def get_read_model():
+    # whichever store READ_MODEL names, which the flask app writes to too
+    return bootstrap.make_async_read_model(uow)
+
+
+def make_bus():
+    return bootstrap.bootstrap_async(
+        uow=uow, notifications=notifications, read_model=get_read_model()
+    )
+
+
+# wired up when the first request arrives, so that starting up is quick
+bus = bootstrap.DeferredBus(make_bus)
+
+
+@app.after_serving
+async def close_notifications():
+    # sends any pending digests, which takes a while, so off the event loop
+    await asyncio.to_thread(notifications.close)
+
+
+@app.route("/add_batch", methods=["POST"])
+async def add_batch():
+    data = await request.get_json()
+    eta = data["eta"]
+    if eta is not None:
+        eta = datetime.fromisoformat(eta).date()
+    cmd = commands.CreateBatch(data["ref"], data["sku"], data["qty"], eta)
+    await bus.handle(cmd)
+    return "OK", 201
+
+
+@app.route("/allocate", methods=["POST"])
+async def allocate_endpoint():
+    data = await request.get_json()
+    try:
+        cmd = commands.Allocate(data["orderid"], data["sku"], data["qty"])
+        await bus.handle(cmd)
+    except InvalidSku as e:
+        return {"message": str(e)}, 400
+    except ConcurrencyError:
+        # still conflicting after the bus's retries
+        return {"message": "Too many concurrent changes, try again"}, 409
+
+    return "OK", 202
+
+
+@app.route("/allocate/batch", methods=["POST"])
+async def allocate_batch_endpoint():
+    lines = (await request.get_json())["lines"]
+    cmd = commands.AllocateMany(
+        [commands.Allocate(l["orderid"], l["sku"], l["qty"]) for l in lines]
+    )
+    results = await bus.handle(cmd)
+
+    response = []
+    for line, result in zip(lines, results):
+        line_result = {"orderid": line["orderid"], "sku": line["sku"]}
+        if isinstance(result, Exception):
+            line_result["message"] = str(result)
+        else:
+            line_result["batchref"] = result
+        response.append(line_result)
+    return jsonify(response), 202
+
+
+@app.route("/allocations/<orderid>", methods=["GET"])
+async def allocations_view_endpoint(orderid):
+    result = await views.allocations_async(orderid, uow, read_model=get_read_model())
+    if not result:
+        return "not found", 404
+    return jsonify(result), 200
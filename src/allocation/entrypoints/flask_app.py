@@ -1,11 +1,74 @@
+import atexit
 from datetime import datetime
 from flask import Flask, jsonify, request
+from allocation.adapters.view_cache import LRUViewCache
 from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.background import BackgroundEventDispatcher
 from allocation.service_layer.handlers import InvalidSku
-from allocation import bootstrap, views
+from allocation.service_layer.unit_of_work import ConcurrencyError
+from allocation import bootstrap, config, views
 
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+background = None
+if config.get_background_workers():
+    background = BackgroundEventDispatcher(workers=config.get_background_workers())
+    atexit.register(background.shutdown)
+notifications = bootstrap.make_notifications()
+atexit.register(notifications.close)
+view_cache = None
+cache_size, cache_ttl = config.get_view_cache_size_and_ttl()
+if cache_size:
+    view_cache = LRUViewCache(max_size=cache_size, ttl=cache_ttl)
+
+
+def make_uow():
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        use_outbox=config.get_use_outbox(),
+        load_strategy=config.get_load_strategy(),
+    )
+
+
+def make_worker_uow():
+    # each worker is the only writer for its skus, so may keep them in memory
+    product_cache_size, validate = config.get_product_cache_size_and_validate()
+    if not product_cache_size:
+        return make_uow()
+    return unit_of_work.CachingSqlAlchemyUnitOfWork(
+        use_outbox=config.get_use_outbox(),
+        load_strategy=config.get_load_strategy(),
+        cache_size=product_cache_size,
+        validate=validate,
+    )
+
+
+uow = make_uow()
+
+
+def make_bus():
+    if not config.get_command_workers():
+        return bootstrap.bootstrap(
+            uow=uow,
+            notifications=notifications,
+            background=background,
+            view_cache=view_cache,
+        )
+    # commands for different skus are handled in parallel, see sharding.py
+    dispatcher = bootstrap.bootstrap_sharded(
+        workers=config.get_command_workers(),
+        make_uow=make_uow,
+        make_worker_uow=make_worker_uow,
+        notifications=notifications,
+        background=background,
+        view_cache=view_cache,
+    )
+    atexit.register(dispatcher.shutdown)
+    return dispatcher
+
+
+# wired up when the first command arrives, so that starting up is quick
+bus = bootstrap.DeferredBus(make_bus)
+read_model = bootstrap.make_read_model(uow)
 
 
 @app.route("/add_batch", methods=["POST"])
@@ -29,13 +92,35 @@ def allocate_endpoint():
         bus.handle(cmd)
     except InvalidSku as e:
         return {"message": str(e)}, 400
+    except ConcurrencyError:
+        # still conflicting after the bus's retries
+        return {"message": "Too many concurrent changes, try again"}, 409
 
     return "OK", 202
 
 
+@app.route("/allocate/batch", methods=["POST"])
+def allocate_batch_endpoint():
+    lines = request.json["lines"]
+    cmd = commands.AllocateMany(
+        [commands.Allocate(l["orderid"], l["sku"], l["qty"]) for l in lines]
+    )
+    results = bus.handle(cmd)
+
+    response = []
+    for line, result in zip(lines, results):
+        line_result = {"orderid": line["orderid"], "sku": line["sku"]}
+        if isinstance(result, Exception):
+            line_result["message"] = str(result)
+        else:
+            line_result["batchref"] = result
+        response.append(line_result)
+    return jsonify(response), 202
+
+
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
+    result = views.allocations(orderid, uow, cache=view_cache, read_model=read_model)
     if not result:
         return "not found", 404
     return jsonify(result), 200
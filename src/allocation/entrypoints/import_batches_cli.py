@@ -0,0 +1,130 @@
+"""
+Bulk import of new batches, eg the week's purchase orders.
+
+    python -m allocation.entrypoints.import_batches_cli batches.csv
+    python -m allocation.entrypoints.import_batches_cli --format jsonl - < in.jsonl
+
+CSV files need a header row naming the ref, sku, qty and eta columns; JSONL
+files have an object per line with the same keys. eta is optional, as an ISO
+date. Every row is checked, and every batchref looked up, before anything is
+imported; then the batches go in chunk_size at a time, a transaction each.
+"""
+import argparse
+import csv
+import json
+import logging
+import sys
+from collections import Counter
+from datetime import date
+from typing import IO, Iterable, Iterator, List, Set, Tuple
+from allocation import bootstrap
+from allocation.adapters.read_model import chunked
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 10_000
+FORMATS = ("csv", "jsonl")
+
+
+class InvalidRow(Exception):
+    pass
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("path", help="file to import, or - for stdin")
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    file_format = args.format or args.path.rpartition(".")[2]
+    if file_format not in FORMATS:
+        parser.error("can't tell the format from the path, use --format")
+
+    if args.path == "-":
+        batches, errors = read_batches(sys.stdin, file_format)
+    else:
+        with open(args.path, newline="") as f:
+            batches, errors = read_batches(f, file_format)
+    bus = bootstrap.bootstrap()
+    errors += [
+        f"batchref {ref} is repeated or already in use"
+        for ref in sorted(duplicate_batchrefs(batches, bus.uow, args.chunk_size))
+    ]
+    for error in errors:
+        print(error, file=sys.stderr)
+    if errors:
+        return 1
+
+    import_batches(bus, batches, args.chunk_size)
+    return 0
+
+
+def read_batches(
+    lines: IO[str], file_format: str
+) -> Tuple[List[commands.CreateBatch], List[str]]:
+    """every batch that could be read, and an error for every row that couldn't"""
+    if file_format == "csv":
+        rows = enumerate(csv.DictReader(lines), start=2)
+    else:
+        rows = _json_rows(lines)
+    batches, errors = [], []
+    for line_number, row in rows:
+        try:
+            batches.append(_create_batch(row))
+        except InvalidRow as e:
+            errors.append(f"line {line_number}: {e}")
+    return batches, errors
+
+
+def duplicate_batchrefs(
+    batches: List[commands.CreateBatch],
+    uow: unit_of_work.AbstractUnitOfWork,
+    chunk_size: int = CHUNK_SIZE,
+) -> Set[str]:
+    """batchrefs that are repeated among batches, or already in use"""
+    refs = [batch.ref for batch in batches]
+    duplicates = {ref for ref, count in Counter(refs).items() if count > 1}
+    with uow:
+        for chunk in chunked(refs, chunk_size):
+            duplicates |= uow.products.existing_batchrefs(chunk)
+    return duplicates
+
+
+def import_batches(
+    bus: messagebus.MessageBus,
+    batches: List[commands.CreateBatch],
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    imported = 0
+    for chunk in chunked(batches, chunk_size):
+        imported += bus.handle(commands.ImportBatches(chunk))
+        logger.info("imported %s of %s batches", imported, len(batches))
+    return imported
+
+
+def _json_rows(lines: Iterable[str]) -> Iterator[Tuple[int, dict]]:
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, {}
+
+
+def _create_batch(row: dict) -> commands.CreateBatch:
+    try:
+        ref, sku, qty = row["ref"], row["sku"], int(row["qty"])
+        eta = date.fromisoformat(row["eta"]) if row.get("eta") else None
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise InvalidRow(f"can't read a batch from {row!r}") from e
+    if not ref or not sku or qty < 0:
+        raise InvalidRow(f"can't read a batch from {row!r}")
+    return commands.CreateBatch(ref, sku, qty, eta)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import json
+import logging
+import time
+import redis
+
+from allocation import config
+from allocation.adapters import outbox, redis_eventpublisher
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+POLL_INTERVAL = 0.1
+
+
+def main():
+    logger.info("Outbox relay starting")
+    r = redis.Redis(**config.get_redis_host_and_port())
+    streams = config.get_event_transport() == "streams"
+    while True:
+        session = unit_of_work.default_session_factory()()
+        try:
+            relayed = relay(session, r, streams=streams)
+        finally:
+            session.close()
+        if relayed < BATCH_SIZE:
+            time.sleep(POLL_INTERVAL)
+
+
+def relay(session, client, batch_size=BATCH_SIZE, streams=False) -> int:
+    """
+    Publishes the oldest messages in the outbox and then deletes them. If we
+    die in between they'll be published again: delivery is at least once.
+    """
+    rows = outbox.fetch(session, batch_size)
+    if rows:
+        pipe = client.pipeline(transaction=False)
+        for row in rows:
+            if streams:
+                sku = json.loads(row.message)["sku"]
+                stream = redis_eventpublisher.stream_for(row.channel, sku)
+                pipe.xadd(
+                    stream,
+                    {"data": row.message},
+                    maxlen=redis_eventpublisher.STREAM_MAXLEN,
+                    approximate=True,
+                )
+            else:
+                pipe.publish(row.channel, row.message)
+        pipe.execute()
+        outbox.remove(session, [row.id for row in rows])
+        logger.info("relayed %s messages from the outbox", len(rows))
+    session.commit()
+    return len(rows)
+
+
+if __name__ == "__main__":
+    main()
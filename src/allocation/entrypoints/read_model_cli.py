@@ -0,0 +1,213 @@
+"""
+Maintenance for the read model that serves views.allocations, whichever
+backend READ_MODEL selects.
+
+    python -m allocation.entrypoints.read_model_cli rebuild
+    python -m allocation.entrypoints.read_model_cli verify [--sku SKU ...]
+    python -m allocation.entrypoints.read_model_cli reconcile [--sku SKU ...]
+
+Allocations are streamed from the write side's tables through a server-side
+cursor and written in chunks, so memory use doesn't grow with the data.
+verify and reconcile go one sku at a time, every sku unless some are given.
+"""
+import argparse
+import logging
+import sys
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+from allocation import bootstrap, config
+from allocation.adapters.read_model import (
+    AbstractReadModel,
+    AllocationRow,
+    CHUNK_SIZE,
+)
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+SessionFactory = Callable[[], Session]
+
+SOURCE_QUERY = """
+    SELECT order_lines.orderid, order_lines.sku, batches.reference
+    FROM allocations
+    JOIN order_lines ON allocations.orderline_id = order_lines.id
+    JOIN batches ON allocations.batch_id = batches.id
+"""
+
+
+class Difference(NamedTuple):
+    """an allocation in only one of the write side's tables and the read model"""
+
+    orderid: str
+    sku: str
+    expected: Optional[str]  # batchref in the write side's tables only
+    actual: Optional[str]  # batchref in the read model only
+
+    def __str__(self):
+        return (
+            f"{self.orderid} {self.sku}: "
+            f"expected {self.expected or '-'}, found {self.actual or '-'}"
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser(
+        "rebuild", help="repopulate the read model from the allocations tables"
+    )
+    for name, help_text in [
+        ("verify", "report rows where the read model differs from the tables"),
+        ("reconcile", "fix rows where the read model differs from the tables"),
+    ]:
+        subcommand = subcommands.add_parser(name, help=help_text)
+        subcommand.add_argument("--sku", action="append", dest="skus")
+    args = parser.parse_args(argv)
+
+    session_factory = make_session_factory()
+    read_model = bootstrap.make_read_model(
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    )
+    if args.command == "rebuild":
+        rebuild(session_factory, read_model, args.chunk_size)
+        return 0
+    if args.command == "verify":
+        differences = 0
+        for difference in verify(session_factory, read_model, args.skus):
+            print(difference)
+            differences += 1
+        return 1 if differences else 0
+    for difference in reconcile(session_factory, read_model, args.skus):
+        print("fixed", difference)
+    return 0
+
+
+def make_session_factory() -> SessionFactory:
+    # send executemany()s to postgres a page of rows at a time,
+    # rather than a round trip per row
+    engine = create_engine(
+        config.get_postgres_uri(),
+        executemany_mode="values_plus_batch",
+        executemany_batch_page_size=1000,
+    )
+    return sessionmaker(bind=engine)
+
+
+def rebuild(
+    session_factory: SessionFactory,
+    read_model: AbstractReadModel,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """returns how many allocations the read model was rebuilt from"""
+    progress = _Progress(chunk_size)
+    rows = allocations_from_source(session_factory, chunk_size=chunk_size)
+    read_model.rebuild(progress.count(rows), chunk_size)
+    logger.info("rebuilt the read model from %s allocations", progress.rows)
+    return progress.rows
+
+
+def verify(
+    session_factory: SessionFactory,
+    read_model: AbstractReadModel,
+    skus: Iterable[str] = None,
+) -> Iterator[Difference]:
+    if skus is None:
+        skus = all_skus(session_factory)
+    for sku in skus:
+        yield from differences_for_sku(session_factory, read_model, sku)
+
+
+def reconcile(
+    session_factory: SessionFactory,
+    read_model: AbstractReadModel,
+    skus: Iterable[str] = None,
+) -> Iterator[Difference]:
+    """
+    fixes each difference as it's found, and yields it. An allocation that
+    changes while its sku is being reconciled may be undone, until the next
+    event for it or the next reconcile.
+    """
+    for difference in verify(session_factory, read_model, skus):
+        if difference.expected is None:
+            read_model.remove(difference.orderid, difference.sku, difference.actual)
+        else:
+            read_model.add(difference.orderid, difference.sku, difference.expected)
+        yield difference
+
+
+def differences_for_sku(
+    session_factory: SessionFactory, read_model: AbstractReadModel, sku: str
+) -> List[Difference]:
+    expected = {
+        (orderid, batchref)
+        for orderid, _, batchref in allocations_from_source(session_factory, sku)
+    }
+    actual = read_model.allocations_for_sku(sku)
+    missing = [Difference(o, sku, b, None) for o, b in expected - actual]
+    unexpected = [Difference(o, sku, None, b) for o, b in actual - expected]
+    return sorted(
+        missing + unexpected, key=lambda d: (d.orderid, d.expected or d.actual)
+    )
+
+
+def allocations_from_source(
+    session_factory: SessionFactory,
+    sku: str = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[AllocationRow]:
+    """
+    every allocation, or every allocation of sku, oldest first, straight from
+    the write side's tables, fetched chunk_size rows at a time
+    """
+    if sku is None:
+        query, params = SOURCE_QUERY, {}
+    else:
+        query, params = SOURCE_QUERY + "WHERE batches.sku = :sku", dict(sku=sku)
+    yield from _stream(
+        session_factory, query + " ORDER BY order_lines.id", params, chunk_size
+    )
+
+
+def all_skus(
+    session_factory: SessionFactory, chunk_size: int = CHUNK_SIZE
+) -> Iterator[str]:
+    for (sku,) in _stream(
+        session_factory, "SELECT sku FROM products ORDER BY sku", {}, chunk_size
+    ):
+        yield sku
+
+
+def _stream(
+    session_factory: SessionFactory, query: str, params: dict, chunk_size: int
+) -> Iterator[tuple]:
+    # a session of its own, so the cursor stays open while the caller writes
+    session = session_factory()
+    try:
+        results = session.execute(
+            query, params, execution_options={"stream_results": True}
+        )
+        for partition in results.partitions(chunk_size):
+            for row in partition:
+                yield tuple(row)
+    finally:
+        session.close()
+
+
+class _Progress:
+    def __init__(self, every: int):
+        self.every = every
+        self.rows = 0
+
+    def count(self, rows: Iterable[AllocationRow]) -> Iterator[AllocationRow]:
+        for row in rows:
+            self.rows += 1
+            if self.rows % self.every == 0:
+                logger.info("read %s allocations so far", self.rows)
+            yield row
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
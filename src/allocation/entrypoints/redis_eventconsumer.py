@@ -1,23 +1,276 @@
+import atexit
 import json
 import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
 import redis
 
-from allocation import bootstrap, config
+from allocation import bootstrap, config, views
+from allocation.adapters.redis_eventpublisher import stream_for
 from allocation.domain import commands
+from allocation.service_layer import unit_of_work
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+BATCH_SIZE = 500
+BATCH_WINDOW = 0.05
+
+CHANNEL = "change_batch_quantity"
+GROUP = "allocation"
+# a consumer that hasn't renewed its leases for this long is taken to be dead,
+# and the others take over its partitions
+LEASE_MS = 30_000
+# well within LEASE_MS, so that a live consumer's leases never lapse
+LEASE_RENEW_INTERVAL = 5.0
 
 
 def main():
+    if config.get_event_transport() == "streams":
+        main_streams(*config.get_consumer_index_and_count())
+    else:
+        main_pubsub()
+
+
+def make_bus():
+    uow = unit_of_work.SqlAlchemyUnitOfWork(load_strategy=config.get_load_strategy())
+    notifications = bootstrap.make_notifications()
+    atexit.register(notifications.close)
+    return bootstrap.bootstrap(uow=uow, notifications=notifications)
+
+
+def main_pubsub():
     logger.info("Redis pubsub starting")
-    bus = bootstrap.bootstrap()
+    bus = make_bus()
+    r = redis.Redis(**config.get_redis_host_and_port())
     pubsub = r.pubsub(ignore_subscribe_messages=True)
-    pubsub.subscribe("change_batch_quantity")
+    pubsub.subscribe(CHANNEL)
+
+    while True:
+        messages = drain(pubsub)
+        if messages:
+            handle_change_batch_quantities(messages, bus)
+
+
+def drain(pubsub, max_messages=BATCH_SIZE, window=BATCH_WINDOW, wait=1.0) -> List:
+    """
+    Waits up to `wait` seconds for a message, then gathers whatever else
+    arrives within `window` seconds of it, up to max_messages.
+    """
+    first = pubsub.get_message(timeout=wait)
+    if first is None:
+        return []
+    messages = [first]
+    deadline = time.monotonic() + window
+    while len(messages) < max_messages:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        message = pubsub.get_message(timeout=remaining)
+        if message is not None:
+            messages.append(message)
+    return messages
+
+
+def coalesce(messages) -> List[commands.ChangeBatchQuantity]:
+    # only the last quantity sent for a batch matters
+    latest = {}
+    for m in messages:
+        data = json.loads(m["data"])
+        latest[data["batchref"]] = data["qty"]
+    return [
+        commands.ChangeBatchQuantity(ref=ref, qty=qty) for ref, qty in latest.items()
+    ]
+
+
+def handle_change_batch_quantities(messages, bus):
+    changes = coalesce(messages)
+    logger.info("handling %s changes from %s messages", len(changes), len(messages))
+    bus.handle(commands.ChangeBatchQuantities(changes))
+
+
+def main_streams(consumer_index, consumer_count):
+    """
+    Only the consumer holding a partition's lease reads it, so a product's
+    changes are always handled by one consumer, in order, while different
+    partitions are handled in parallel. Each of the consumer_count consumers
+    holds its own share of the leases, and a dead consumer's share too until
+    it comes back, see renew_leases. Entries are acknowledged once handled;
+    anything left unacknowledged, eg by a consumer that crashed, is handled
+    again by whoever takes the partition's lease next.
+    """
+    consumer = consumer_name(consumer_index)
+    logger.info("Redis streams consumer %s starting", consumer)
+    bus = make_bus()
+    r = redis.Redis(**config.get_redis_host_and_port())
+    create_groups(r, all_streams())
+
+    held = []  # type: List[str]
+    last_renewal = 0.0
+    while True:
+        if time.monotonic() - last_renewal > LEASE_RENEW_INTERVAL:
+            last_renewal = time.monotonic()
+            previously_held = held
+            held = renew_leases(r, consumer_index, consumer_count)
+            acquired = [s for s in held if s not in previously_held]
+            if acquired:
+                logger.info("%s now reads %s", consumer, acquired)
+                reclaimed = reclaim_stream_entries(r, acquired, consumer)
+                if reclaimed:
+                    handle_stream_entries(r, reclaimed, bus)
+        if not held:
+            time.sleep(LEASE_RENEW_INTERVAL)
+            continue
+        entries = read_stream_entries(r, held, consumer)
+        if entries:
+            handle_stream_entries(r, entries, bus)
+
+
+def consumer_name(consumer_index) -> str:
+    return f"consumer-{consumer_index}"
+
+
+def all_streams(partitions=None) -> List[str]:
+    if partitions is None:
+        partitions = config.get_stream_partitions()
+    return [f"{CHANNEL}:{p}" for p in range(partitions)]
+
+
+def owned_streams(consumer_index, consumer_count, partitions=None) -> List[str]:
+    return [
+        stream
+        for p, stream in enumerate(all_streams(partitions))
+        if p % consumer_count == consumer_index
+    ]
+
+
+def renew_leases(
+    client, consumer_index, consumer_count, partitions=None
+) -> List[str]:
+    """
+    Renews, or takes if they're free, the leases on the consumer's own
+    partitions, and on those of any other consumer that isn't alive, ie that
+    hasn't renewed its leases within LEASE_MS. Hands back any it holds of a
+    live consumer's, for it to take at its next renewal. Returns the streams
+    whose leases it now holds.
+
+    A lease is only taken once it's free and only renewed by its holder, so
+    a partition is read by one consumer at a time, as long as each renews
+    more often than LEASE_MS.
+    """
+    consumer = consumer_name(consumer_index)
+    client.set(_alive_key(consumer), 1, px=LEASE_MS)
+    alive = {consumer_index: True}
+    held = []
+    for p, stream in enumerate(all_streams(partitions)):
+        owner = p % consumer_count
+        if owner not in alive:
+            alive[owner] = bool(client.exists(_alive_key(consumer_name(owner))))
+        key = _lease_key(stream)
+        holder = _decode(client.get(key))
+        if owner != consumer_index and alive[owner]:
+            if holder == consumer:
+                client.delete(key)
+            continue
+        if holder == consumer:
+            client.pexpire(key, LEASE_MS)
+            held.append(stream)
+        elif client.set(key, consumer, nx=True, px=LEASE_MS):
+            held.append(stream)
+    return held
+
+
+def _lease_key(stream: str) -> str:
+    return f"{stream}:lease"
+
+
+def _alive_key(consumer: str) -> str:
+    return f"{CHANNEL}:{consumer}:alive"
+
+
+def partition_stream(
+    data: dict, resolve_sku: Callable[[str], Optional[str]] = None
+) -> str:
+    """
+    where producers should XADD a change_batch_quantity message: the stream
+    for the batch's product, so that every change to that product's batches
+    goes to the same consumer, in order. Without a sku in the message, it's
+    looked up with resolve_sku, by default in the database; only a batch that
+    doesn't exist falls back to a stream by batchref.
+    """
+    sku = data.get("sku")
+    if sku is None:
+        sku = (resolve_sku or _sku_for_batchref)(data["batchref"])
+    return stream_for(CHANNEL, sku or data["batchref"])
+
+
+def _sku_for_batchref(batchref: str) -> Optional[str]:
+    return views.sku_for_batchref(batchref, unit_of_work.SqlAlchemyUnitOfWork())
+
+
+def create_groups(client, streams):
+    for stream in streams:
+        try:
+            client.xgroup_create(stream, GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+
+StreamEntry = Tuple[str, bytes, Dict[bytes, bytes]]
+
+
+def read_stream_entries(
+    client, streams, consumer, new=True, count=BATCH_SIZE, block_ms=1000
+) -> List[StreamEntry]:
+    """new=False re-reads entries delivered to us but not yet acknowledged"""
+    response = client.xreadgroup(
+        GROUP,
+        consumer,
+        {stream: ">" if new else "0" for stream in streams},
+        count=count,
+        block=block_ms if new else None,
+    )
+    return [
+        (_decode(stream), entry_id, fields)
+        for stream, stream_entries in response or []
+        for entry_id, fields in stream_entries
+        if fields
+    ]
+
+
+def reclaim_stream_entries(client, streams, consumer) -> List[StreamEntry]:
+    """
+    Claims every entry of streams that was delivered, to any consumer, us
+    included, but not acknowledged, in order. Meant for streams whose leases
+    we've just taken: whoever held them before has stopped reading them.
+    """
+    entries = []  # type: List[StreamEntry]
+    for stream in streams:
+        start = "0-0"
+        while True:
+            start, claimed = client.xautoclaim(
+                stream, GROUP, consumer, 0, start_id=start, count=BATCH_SIZE
+            )[:2]
+            # entries deleted or trimmed from the stream come back without fields
+            entries.extend(
+                (stream, entry_id, fields) for entry_id, fields in claimed if fields
+            )
+            if _decode(start) == "0-0":
+                break
+    return entries
+
+
+def handle_stream_entries(client, entries: List[StreamEntry], bus):
+    handle_change_batch_quantities([{"data": f[b"data"]} for _, _, f in entries], bus)
+    ids_by_stream = {}  # type: Dict[str, List[bytes]]
+    for stream, entry_id, _ in entries:
+        ids_by_stream.setdefault(stream, []).append(entry_id)
+    for stream, ids in ids_by_stream.items():
+        client.xack(stream, GROUP, *ids)
+
 
-    for m in pubsub.listen():
-        handle_change_batch_quantity(m, bus)
+def _decode(stream):
+    return stream.decode() if isinstance(stream, bytes) else stream
 
 
 def handle_change_batch_quantity(m, bus):
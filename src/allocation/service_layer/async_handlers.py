@@ -0,0 +1,144 @@
+# pylint: disable=unused-argument
+from __future__ import annotations
+import asyncio
+from typing import List, Dict, Callable, Type, TYPE_CHECKING
+from allocation.domain import commands, events, model
+from allocation.domain.model import OrderLine
+from . import handlers
+from .handlers import InvalidSku
+from .unit_of_work import ConcurrencyError
+
+if TYPE_CHECKING:
+    from allocation.adapters import notifications, read_model as read_models
+    from . import async_unit_of_work
+
+
+async def add_batch(
+    cmd: commands.CreateBatch,
+    uow: async_unit_of_work.AbstractAsyncUnitOfWork,
+):
+    async with uow:
+        product = await uow.products.get(sku=cmd.sku)
+        if product is None:
+            product = model.Product(cmd.sku, batches=[])
+            uow.products.add(product)
+        product.add_batch(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        await uow.commit()
+
+
+async def allocate(
+    cmd: commands.Allocate,
+    uow: async_unit_of_work.AbstractAsyncUnitOfWork,
+):
+    line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
+    async with uow:
+        product = await uow.products.get(sku=line.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        product.allocate(line)
+        await uow.commit()
+
+
+async def allocate_many(
+    cmd: commands.AllocateMany,
+    uow: async_unit_of_work.AbstractAsyncUnitOfWork,
+) -> List[Union[Optional[str], Exception]]:
+    results = [None] * len(cmd.lines)  # type: handlers.AllocationResults
+    async with uow:
+        for sku, positions in handlers.positions_by_sku(cmd.lines).items():
+            product = await uow.products.get(sku=sku)
+            if product is None:
+                handlers.fail(results, positions, InvalidSku(f"Invalid sku {sku}"))
+                continue
+            handlers.allocate_lines(product, cmd.lines, positions, results)
+            try:
+                await uow.commit()
+            except ConcurrencyError as e:
+                # as in handlers.allocate_many, don't let the bus retry it all
+                await uow.rollback()
+                product.events.clear()
+                handlers.fail(results, positions, e)
+    return results
+
+
+async def reallocate(
+    event: events.Deallocated,
+    uow: async_unit_of_work.AbstractAsyncUnitOfWork,
+):
+    await allocate(commands.Allocate(event.orderid, event.sku, event.qty), uow=uow)
+
+
+async def change_batch_quantity(
+    cmd: commands.ChangeBatchQuantity,
+    uow: async_unit_of_work.AbstractAsyncUnitOfWork,
+):
+    async with uow:
+        product = await uow.products.get_by_batchref(batchref=cmd.ref)
+        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
+        await uow.commit()
+
+
+async def change_batch_quantities(
+    cmd: commands.ChangeBatchQuantities,
+    uow: async_unit_of_work.AbstractAsyncUnitOfWork,
+):
+    async with uow:
+        found = [
+            (await uow.products.get_by_batchref(batchref=c.ref), c)
+            for c in cmd.changes
+        ]
+        for product, changes in handlers.changes_by_product(found):
+            for change in changes:
+                product.change_batch_quantity(ref=change.ref, qty=change.qty)
+            await uow.commit()
+
+
+# pylint: disable=unused-argument
+
+
+async def send_out_of_stock_notification(
+    event: events.OutOfStock,
+    notifications: notifications.AbstractNotifications,
+):
+    # the notifications adapters are blocking, so keep them off the event loop
+    await asyncio.to_thread(
+        notifications.send,
+        "stock@made.com",
+        f"Out of stock for {event.sku}",
+    )
+
+
+async def publish_allocated_event(
+    event: events.Allocated,
+    publish: Callable,
+):
+    await publish("line_allocated", event)
+
+
+async def add_allocation_to_read_model(
+    event: events.Allocated,
+    read_model: read_models.AbstractAsyncReadModel,
+):
+    await read_model.add(event.orderid, event.sku, event.batchref)
+
+
+async def remove_allocation_from_read_model(
+    event: events.Deallocated,
+    read_model: read_models.AbstractAsyncReadModel,
+):
+    await read_model.remove(event.orderid, event.sku, event.batchref)
+
+
+EVENT_HANDLERS = {
+    events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
+    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.OutOfStock: [send_out_of_stock_notification],
+}  # type: Dict[Type[events.Event], List[Callable]]
+
+COMMAND_HANDLERS = {
+    commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.CreateBatch: add_batch,
+    commands.ChangeBatchQuantity: change_batch_quantity,
+    commands.ChangeBatchQuantities: change_batch_quantities,
+}  # type: Dict[Type[commands.Command], Callable]
@@ -0,0 +1,96 @@
+# pylint: disable=attribute-defined-outside-init
+from __future__ import annotations
+import abc
+import contextvars
+import functools
+from typing import Optional, Tuple
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import exc as orm_exc, sessionmaker
+
+from allocation import config
+from allocation.adapters import repository
+from allocation.service_layer.unit_of_work import ConcurrencyError, is_conflict
+
+Repository = repository.AsyncSqlAlchemyRepository
+
+
+class AbstractAsyncUnitOfWork(abc.ABC):
+    products: repository.AbstractAsyncRepository
+
+    async def __aenter__(self) -> AbstractAsyncUnitOfWork:
+        return self
+
+    async def __aexit__(self, *args):
+        await self.rollback()
+
+    async def commit(self):
+        await self._commit()
+
+    def collect_new_events(self):
+        for product in self.products.seen:
+            while product.events:
+                yield product.events.pop(0)
+
+    @abc.abstractmethod
+    async def _commit(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+@functools.lru_cache(maxsize=None)
+def default_session_factory():
+    return sessionmaker(
+        bind=create_async_engine(
+            config.get_postgres_uri(driver="asyncpg"),
+            isolation_level=config.get_isolation_level(),
+        ),
+        class_=AsyncSession,
+        expire_on_commit=False,
+    )
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractAsyncUnitOfWork):
+    """
+    One instance is shared by every request, so the session lives in a
+    context variable: each asyncio task gets its own.
+    """
+
+    def __init__(self, session_factory=None):
+        self.session_factory = session_factory
+        self._current = contextvars.ContextVar(
+            f"uow-{id(self)}", default=None
+        )  # type: contextvars.ContextVar[Optional[Tuple[AsyncSession, Repository]]]
+
+    @property
+    def session(self) -> AsyncSession:
+        return self._current.get()[0]
+
+    @property
+    def products(self) -> Repository:
+        return self._current.get()[1]
+
+    async def __aenter__(self):
+        session_factory = self.session_factory or default_session_factory()
+        # like SqlAlchemyUnitOfWork's, so conflicts only come from commit()
+        session = session_factory(autoflush=False)  # type: AsyncSession
+        self._current.set((session, repository.AsyncSqlAlchemyRepository(session)))
+        return await super().__aenter__()
+
+    async def __aexit__(self, *args):
+        await super().__aexit__(*args)
+        await self.session.close()
+
+    async def _commit(self):
+        try:
+            await self.session.commit()
+        except (orm_exc.StaleDataError, exc.DBAPIError) as e:
+            if not is_conflict(e):
+                raise
+            raise ConcurrencyError(str(e)) from e
+
+    async def rollback(self):
+        await self.session.rollback()
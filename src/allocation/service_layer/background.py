@@ -0,0 +1,128 @@
+# pylint: disable=broad-except
+from __future__ import annotations
+import itertools
+import logging
+import queue
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Set, Type
+from allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+EventHandlers = Dict[Type[events.Event], List[Callable]]
+
+_STOP = object()
+
+
+class BackgroundEventDispatcher:
+    """
+    Runs event handlers on a pool of worker threads, so that whoever raised
+    the event doesn't wait for them.
+
+    Each worker has its own queue and its own set of handlers (and so its
+    own dependencies, eg unit of work). With order_by_sku, all the events for
+    one sku go to the same worker and are handled in the order they were
+    submitted. Queues are bounded: submit() blocks when a worker falls behind,
+    and raises queue.Full if it is still full after submit_timeout seconds.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_queue_size: int = 1000,
+        max_attempts: int = 3,
+        retry_delay: float = 0.1,
+        order_by_sku: bool = True,
+        submit_timeout: Optional[float] = None,
+    ):
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.order_by_sku = order_by_sku
+        self.submit_timeout = submit_timeout
+        self.event_types = set()  # type: Set[Type[events.Event]]
+        self._queues = []  # type: List[queue.Queue]
+        self._threads = []  # type: List[threading.Thread]
+        self._round_robin = itertools.count()
+
+    @property
+    def started(self) -> bool:
+        return bool(self._threads)
+
+    def start(self, make_handlers: Callable[[], EventHandlers]):
+        """make_handlers is called once per worker"""
+        if self.started:
+            raise RuntimeError("background dispatcher already started")
+        for i in range(self.workers):
+            handlers = make_handlers()
+            self.event_types.update(t for t, hs in handlers.items() if hs)
+            worker_queue = queue.Queue(self.max_queue_size)  # type: queue.Queue
+            thread = threading.Thread(
+                target=self._work,
+                args=(worker_queue, handlers),
+                name=f"background-events-{i}",
+                daemon=True,
+            )
+            thread.start()
+            self._queues.append(worker_queue)
+            self._threads.append(thread)
+
+    def submit(self, event: events.Event):
+        # read once, as shutdown() may empty it meanwhile
+        queues = self._queues
+        if not queues:
+            raise RuntimeError("background dispatcher isn't running")
+        if type(event) not in self.event_types:
+            return
+        self._queue_for(event, queues).put(event, timeout=self.submit_timeout)
+
+    def drain(self):
+        """wait until everything submitted so far has been handled"""
+        for worker_queue in self._queues:
+            worker_queue.join()
+
+    def shutdown(self):
+        self.drain()
+        for worker_queue in self._queues:
+            worker_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._queues, self._threads = [], []
+
+    def _queue_for(
+        self, event: events.Event, queues: List[queue.Queue]
+    ) -> queue.Queue:
+        sku = getattr(event, "sku", None)
+        if self.order_by_sku and sku is not None:
+            i = zlib.crc32(sku.encode())
+        else:
+            i = next(self._round_robin)
+        return queues[i % len(queues)]
+
+    def _work(self, worker_queue: queue.Queue, handlers: EventHandlers):
+        while True:
+            event = worker_queue.get()
+            try:
+                if event is _STOP:
+                    return
+                for handler in handlers.get(type(event), []):
+                    self._handle_with_retries(handler, event)
+            finally:
+                worker_queue.task_done()
+
+    def _handle_with_retries(self, handler: Callable, event: events.Event):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                handler(event)
+                return
+            except Exception:
+                if attempt == self.max_attempts:
+                    logger.exception("Giving up handling event %s", event)
+                    return
+                logger.warning(
+                    "Exception handling event %s, attempt %s", event, attempt
+                )
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
@@ -1,19 +1,43 @@
 # pylint: disable=unused-argument
 from __future__ import annotations
-from dataclasses import asdict
-from typing import List, Dict, Callable, Type, TYPE_CHECKING
+import logging
+from collections import Counter, defaultdict
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union,
+    TYPE_CHECKING,
+)
 from allocation.domain import commands, events, model
 from allocation.domain.model import OrderLine
+from allocation.service_layer.unit_of_work import ConcurrencyError
 
 if TYPE_CHECKING:
-    from allocation.adapters import notifications
+    from allocation.adapters import (
+        notifications,
+        read_model as read_models,
+        view_cache as cache,
+    )
     from . import unit_of_work
 
+logger = logging.getLogger(__name__)
+
 
 class InvalidSku(Exception):
     pass
 
 
+class DuplicateBatch(Exception):
+    pass
+
+
 def add_batch(
     cmd: commands.CreateBatch,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -23,8 +47,31 @@ def add_batch(
         if product is None:
             product = model.Product(cmd.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        product.add_batch(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        uow.commit()
+
+
+def import_batches(
+    cmd: commands.ImportBatches,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> int:
+    """
+    Adds all of the batches, and products for any new skus, in a single
+    transaction; or none of them, if any batchref is repeated or already in
+    use. Returns how many were added.
+    """
+    refs = [batch.ref for batch in cmd.batches]
+    with uow:
+        duplicates = {ref for ref, count in Counter(refs).items() if count > 1}
+        duplicates |= uow.products.existing_batchrefs(refs)
+        if duplicates:
+            listed = ", ".join(sorted(duplicates))
+            raise DuplicateBatch(f"Duplicate batchrefs {listed}")
+        uow.products.add_batches(
+            [model.Batch(b.ref, b.sku, b.qty, b.eta) for b in cmd.batches]
+        )
         uow.commit()
+    return len(cmd.batches)
 
 
 def allocate(
@@ -33,18 +80,73 @@ def allocate(
 ):
     line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
     with uow:
-        product = uow.products.get(sku=line.sku)
+        product = uow.products.get_for_allocation(sku=line.sku)
         if product is None:
             raise InvalidSku(f"Invalid sku {line.sku}")
         product.allocate(line)
         uow.commit()
 
 
+def allocate_many(
+    cmd: commands.AllocateMany,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> List[Union[Optional[str], Exception]]:
+    """
+    Allocates each sku's lines in a single transaction. Returns, for each line,
+    the batchref it was allocated to, None if it was out of stock, or an
+    InvalidSku or ConcurrencyError error.
+    """
+    results = [None] * len(cmd.lines)  # type: AllocationResults
+    with uow:
+        for sku, positions in positions_by_sku(cmd.lines).items():
+            product = uow.products.get_for_allocation(sku=sku)
+            if product is None:
+                fail(results, positions, InvalidSku(f"Invalid sku {sku}"))
+                continue
+            allocate_lines(product, cmd.lines, positions, results)
+            try:
+                uow.commit()
+            except ConcurrencyError as e:
+                # other skus may be committed already, so the bus mustn't retry
+                # the whole command: report this sku's lines as failed instead
+                uow.rollback()
+                product.events.clear()
+                fail(results, positions, e)
+    return results
+
+
+AllocationResults = List[Union[Optional[str], Exception]]
+
+
+def positions_by_sku(lines: Sequence[commands.Allocate]) -> Dict[str, List[int]]:
+    """where each sku's lines are in lines, in order"""
+    positions = defaultdict(list)  # type: Dict[str, List[int]]
+    for i, line in enumerate(lines):
+        positions[line.sku].append(i)
+    return positions
+
+
+def allocate_lines(
+    product: model.Product,
+    lines: Sequence[commands.Allocate],
+    positions: List[int],
+    results: AllocationResults,
+):
+    for i in positions:
+        line = lines[i]
+        results[i] = product.allocate(OrderLine(line.orderid, product.sku, line.qty))
+
+
+def fail(results: AllocationResults, positions: List[int], error: Exception):
+    for i in positions:
+        results[i] = error
+
+
 def reallocate(
     event: events.Deallocated,
     uow: unit_of_work.AbstractUnitOfWork,
 ):
-    allocate(commands.Allocate(**asdict(event)), uow=uow)
+    allocate(commands.Allocate(event.orderid, event.sku, event.qty), uow=uow)
 
 
 def change_batch_quantity(
@@ -57,6 +159,42 @@ def change_batch_quantity(
         uow.commit()
 
 
+def change_batch_quantities(
+    cmd: commands.ChangeBatchQuantities,
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    """
+    Applies each product's changes in a single transaction. Unknown batchrefs
+    are logged and skipped rather than failing everyone else's changes.
+    """
+    with uow:
+        found = [
+            (uow.products.get_by_batchref(batchref=c.ref), c) for c in cmd.changes
+        ]
+        for product, changes in changes_by_product(found):
+            for change in changes:
+                product.change_batch_quantity(ref=change.ref, qty=change.qty)
+            uow.commit()
+
+
+def changes_by_product(
+    found: Iterable[Tuple[Optional[model.Product], commands.ChangeBatchQuantity]]
+) -> List[Tuple[model.Product, List[commands.ChangeBatchQuantity]]]:
+    """
+    each change with the product its batch was found in, grouped by product;
+    changes to batches that weren't found are logged and left out
+    """
+    products = {}  # type: Dict[str, model.Product]
+    changes_by_sku = defaultdict(list)  # type: Dict[str, List]
+    for product, change in found:
+        if product is None:
+            logger.warning("Unknown batchref %s, ignoring change", change.ref)
+            continue
+        products[product.sku] = product
+        changes_by_sku[product.sku].append(change)
+    return [(products[sku], changes) for sku, changes in changes_by_sku.items()]
+
+
 # pylint: disable=unused-argument
 
 
@@ -79,32 +217,20 @@ def publish_allocated_event(
 
 def add_allocation_to_read_model(
     event: events.Allocated,
-    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    read_model: read_models.AbstractReadModel,
+    view_cache: cache.AbstractViewCache,
 ):
-    with uow:
-        uow.session.execute(
-            """
-            INSERT INTO allocations_view (orderid, sku, batchref)
-            VALUES (:orderid, :sku, :batchref)
-            """,
-            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
-        )
-        uow.commit()
+    read_model.add(event.orderid, event.sku, event.batchref)
+    view_cache.invalidate(event.orderid)
 
 
 def remove_allocation_from_read_model(
     event: events.Deallocated,
-    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    read_model: read_models.AbstractReadModel,
+    view_cache: cache.AbstractViewCache,
 ):
-    with uow:
-        uow.session.execute(
-            """
-            DELETE FROM allocations_view
-            WHERE orderid = :orderid AND sku = :sku
-            """,
-            dict(orderid=event.orderid, sku=event.sku),
-        )
-        uow.commit()
+    read_model.remove(event.orderid, event.sku, event.batchref)
+    view_cache.invalidate(event.orderid)
 
 
 EVENT_HANDLERS = {
@@ -115,6 +241,18 @@ EVENT_HANDLERS = {
 
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.CreateBatch: add_batch,
+    commands.ImportBatches: import_batches,
     commands.ChangeBatchQuantity: change_batch_quantity,
+    commands.ChangeBatchQuantities: change_batch_quantities,
 }  # type: Dict[Type[commands.Command], Callable]
+
+# handlers that only have effects outside the write model, and so don't need
+# to finish before the command that raised their event can return
+SIDE_EFFECT_HANDLERS = {
+    publish_allocated_event,
+    add_allocation_to_read_model,
+    remove_allocation_from_read_model,
+    send_out_of_stock_notification,
+}  # type: Set[Callable]
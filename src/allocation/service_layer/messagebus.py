@@ -1,55 +1,251 @@
 # pylint: disable=broad-except, attribute-defined-outside-init
 from __future__ import annotations
+import asyncio
+import inspect
 import logging
-from typing import Callable, Dict, List, Union, Type, TYPE_CHECKING
+import random
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Sequence, Union, Type, TYPE_CHECKING
+from allocation.adapters import metrics as bus_metrics
 from allocation.domain import commands, events
+from allocation.service_layer.unit_of_work import ConcurrencyError
 
 if TYPE_CHECKING:
-    from . import unit_of_work
+    from . import async_unit_of_work, unit_of_work
+    from .background import BackgroundEventDispatcher
 
 logger = logging.getLogger(__name__)
 
 Message = Union[commands.Command, events.Event]
 
 
+def conflict_backoff(attempt: int, retry_delay: float) -> float:
+    # full jitter, so that the handlers that collided don't collide again
+    return random.uniform(0, retry_delay * 2 ** (attempt - 1))
+
+
 class MessageBus:
+    """
+    Handlers that fail with a ConcurrencyError are retried, up to
+    max_attempts times in all, after a randomised exponential backoff.
+
+    Several threads can handle messages on one bus at once, as long as the
+    unit of work keeps its state per thread, as SqlAlchemyUnitOfWork does.
+    """
+
     def __init__(
         self,
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        metrics: bus_metrics.AbstractMetrics = None,
+        background: BackgroundEventDispatcher = None,
+        flushers: Sequence[Callable[[], None]] = (),
+        max_attempts: int = 3,
+        retry_delay: float = 0.01,
     ):
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.metrics = metrics if metrics is not None else bus_metrics.NoMetrics()
+        self.background = background
+        # called once a message and everything it led to have been handled
+        self.flushers = flushers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
 
     def handle(self, message: Message):
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
-            if isinstance(message, events.Event):
-                self.handle_event(message)
-            elif isinstance(message, commands.Command):
-                self.handle_command(message)
-            else:
-                raise Exception(f"{message} was not an Event or Command")
-
-    def handle_event(self, event: events.Event):
+        result = None
+        top_message = message
+        handled = 0
+        max_depth = 1
+        # a local queue, because other threads may be handling messages too
+        queue = deque([message])
+        try:
+            while queue:
+                message = queue.popleft()
+                handled += 1
+                if isinstance(message, events.Event):
+                    self.handle_event(message, queue)
+                elif isinstance(message, commands.Command):
+                    result = self.handle_command(message, queue)
+                else:
+                    raise Exception(f"{message} was not an Event or Command")
+                max_depth = max(max_depth, len(queue))
+        finally:
+            for flush in self.flushers:
+                flush()
+            if self.metrics.enabled:
+                top = type(top_message).__name__
+                self.metrics.observe("bus.cascade_length", handled, message=top)
+                self.metrics.observe("bus.queue_depth_max", max_depth, message=top)
+        return result
+
+    def handle_event(self, event: events.Event, queue: Deque[Message]):
+        if self.background is not None:
+            try:
+                self.background.submit(event)
+            except Exception:
+                # whatever led to the event is done already, so carry on
+                # without its side effects rather than fail it
+                logger.exception("Exception submitting event %s", event)
+        debug = logger.isEnabledFor(logging.DEBUG)
         for handler in self.event_handlers[type(event)]:
             try:
-                logger.debug("handling event %s with handler %s", event, handler)
-                handler(event)
-                self.queue.extend(self.uow.collect_new_events())
+                if debug:
+                    logger.debug("handling event %s with handler %s", event, handler)
+                self._with_retries(handler, event, "event")
+                queue.extend(self.uow.collect_new_events())
             except Exception:
                 logger.exception("Exception handling event %s", event)
                 continue
 
-    def handle_command(self, command: commands.Command):
-        logger.debug("handling command %s", command)
+    def handle_command(self, command: commands.Command, queue: Deque[Message]):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("handling command %s", command)
         try:
             handler = self.command_handlers[type(command)]
-            handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            result = self._with_retries(handler, command, "command")
+            queue.extend(self.uow.collect_new_events())
+            return result
         except Exception:
             logger.exception("Exception handling command %s", command)
             raise
+
+    def _with_retries(self, handler: Callable, message: Message, kind: str):
+        attempt = 1
+        while True:
+            try:
+                return self._timed(handler, message, kind)
+            except ConcurrencyError:
+                message_type = type(message).__name__
+                self.metrics.increment("bus.conflicts", message=message_type)
+                if attempt >= self.max_attempts:
+                    raise
+                self.metrics.increment("bus.retries", message=message_type)
+                time.sleep(conflict_backoff(attempt, self.retry_delay))
+                attempt += 1
+
+    def _timed(self, handler: Callable, message: Message, kind: str):
+        if not self.metrics.enabled:
+            return handler(message)
+        start = time.perf_counter()
+        try:
+            return handler(message)
+        finally:
+            self.metrics.observe(
+                "bus.handler_seconds",
+                time.perf_counter() - start,
+                kind=kind,
+                message=type(message).__name__,
+                handler=getattr(handler, "__name__", repr(handler)),
+            )
+
+
+class AsyncMessageBus:
+    """
+    Like MessageBus, but awaits handlers that return awaitables, so the same
+    bus can be handling several messages at once on one event loop. Plain
+    synchronous handlers still work, but they block the loop while they run.
+    """
+
+    def __init__(
+        self,
+        uow: async_unit_of_work.AbstractAsyncUnitOfWork,
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+        metrics: bus_metrics.AbstractMetrics = None,
+        max_attempts: int = 3,
+        retry_delay: float = 0.01,
+    ):
+        self.uow = uow
+        self.event_handlers = event_handlers
+        self.command_handlers = command_handlers
+        self.metrics = metrics if metrics is not None else bus_metrics.NoMetrics()
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    async def handle(self, message: Message):
+        result = None
+        top_message = message
+        handled = 0
+        max_depth = 1
+        # a local queue, because other messages are being handled concurrently
+        queue = deque([message])
+        try:
+            while queue:
+                message = queue.popleft()
+                handled += 1
+                if isinstance(message, events.Event):
+                    await self.handle_event(message, queue)
+                elif isinstance(message, commands.Command):
+                    result = await self.handle_command(message, queue)
+                else:
+                    raise Exception(f"{message} was not an Event or Command")
+                max_depth = max(max_depth, len(queue))
+        finally:
+            if self.metrics.enabled:
+                top = type(top_message).__name__
+                self.metrics.observe("bus.cascade_length", handled, message=top)
+                self.metrics.observe("bus.queue_depth_max", max_depth, message=top)
+        return result
+
+    async def handle_event(self, event: events.Event, queue: Deque[Message]):
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for handler in self.event_handlers[type(event)]:
+            try:
+                if debug:
+                    logger.debug("handling event %s with handler %s", event, handler)
+                await self._with_retries(handler, event, "event")
+                queue.extend(self.uow.collect_new_events())
+            except Exception:
+                logger.exception("Exception handling event %s", event)
+                continue
+
+    async def handle_command(self, command: commands.Command, queue: Deque[Message]):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("handling command %s", command)
+        try:
+            handler = self.command_handlers[type(command)]
+            result = await self._with_retries(handler, command, "command")
+            queue.extend(self.uow.collect_new_events())
+            return result
+        except Exception:
+            logger.exception("Exception handling command %s", command)
+            raise
+
+    async def _with_retries(self, handler: Callable, message: Message, kind: str):
+        attempt = 1
+        while True:
+            try:
+                return await self._timed(handler, message, kind)
+            except ConcurrencyError:
+                message_type = type(message).__name__
+                self.metrics.increment("bus.conflicts", message=message_type)
+                if attempt >= self.max_attempts:
+                    raise
+                self.metrics.increment("bus.retries", message=message_type)
+                await asyncio.sleep(conflict_backoff(attempt, self.retry_delay))
+                attempt += 1
+
+    async def _timed(self, handler: Callable, message: Message, kind: str):
+        if not self.metrics.enabled:
+            result = handler(message)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        start = time.perf_counter()
+        try:
+            result = handler(message)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        finally:
+            self.metrics.observe(
+                "bus.handler_seconds",
+                time.perf_counter() - start,
+                kind=kind,
+                message=type(message).__name__,
+                handler=getattr(handler, "__name__", repr(handler)),
+            )
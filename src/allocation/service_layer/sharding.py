@@ -0,0 +1,146 @@
+# pylint: disable=broad-except
+from __future__ import annotations
+import queue
+import threading
+import zlib
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, TYPE_CHECKING
+from allocation.domain import commands
+
+if TYPE_CHECKING:
+    from . import messagebus, unit_of_work
+
+_STOP = object()
+
+
+class ShardedCommandDispatcher:
+    """
+    Routes each command to a worker thread by product, so that the commands
+    for one sku are handled one at a time and in order, while different skus
+    are handled in parallel without fighting over the same rows.
+
+    Each worker has its own message bus, and so its own unit of work and
+    session; events a command leads to are handled by the same worker.
+    ChangeBatchQuantity only has a batchref, so resolve_sku looks up its sku.
+    Commands that span skus are split per worker and their results merged,
+    except ImportBatches, which is all or nothing and so is handled whole by
+    one worker; the other workers' cached products notice the new batches
+    by their version.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_queue_size: int = 1000,
+        submit_timeout: Optional[float] = None,
+    ):
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.submit_timeout = submit_timeout
+        # for the read side, which isn't routed through the workers
+        self.uow = None  # type: Optional[unit_of_work.AbstractUnitOfWork]
+        self._resolve_sku = None  # type: Optional[Callable[[str], Optional[str]]]
+        self._skus_by_batchref = {}  # type: Dict[str, str]
+        self._queues = []  # type: List[queue.Queue]
+        self._threads = []  # type: List[threading.Thread]
+
+    def start(
+        self,
+        make_bus: Callable[[], messagebus.MessageBus],
+        resolve_sku: Callable[[str], Optional[str]],
+    ):
+        """make_bus is called once per worker"""
+        self._resolve_sku = resolve_sku
+        for i in range(self.workers):
+            worker_queue = queue.Queue(self.max_queue_size)  # type: queue.Queue
+            thread = threading.Thread(
+                target=self._work,
+                args=(worker_queue, make_bus()),
+                name=f"command-shard-{i}",
+                daemon=True,
+            )
+            thread.start()
+            self._queues.append(worker_queue)
+            self._threads.append(thread)
+
+    def handle(self, command: commands.Command):
+        """handles command on the right worker(s) and returns its result"""
+        if isinstance(command, commands.AllocateMany):
+            return self._allocate_many(command)
+        if isinstance(command, commands.ChangeBatchQuantities):
+            return self._change_batch_quantities(command)
+        return self.submit(command).result()
+
+    def submit(self, command: commands.Command) -> Future:
+        return self._submit_to(self._shard_for(command), command)
+
+    def shutdown(self):
+        for worker_queue in self._queues:
+            worker_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._queues, self._threads = [], []
+
+    def shard_for_sku(self, sku: Optional[str]) -> int:
+        if sku is None:
+            return 0
+        return zlib.crc32(sku.encode()) % len(self._queues)
+
+    def _shard_for(self, command: commands.Command) -> int:
+        if isinstance(command, commands.ChangeBatchQuantity):
+            return self.shard_for_sku(self._sku_for_batchref(command.ref))
+        return self.shard_for_sku(getattr(command, "sku", None))
+
+    def _sku_for_batchref(self, batchref: str) -> Optional[str]:
+        # a batch never changes product, so there's no need to look it up twice
+        sku = self._skus_by_batchref.get(batchref)
+        if sku is None:
+            sku = self._resolve_sku(batchref)
+            if sku is not None:
+                self._skus_by_batchref[batchref] = sku
+        return sku
+
+    def _allocate_many(self, command: commands.AllocateMany):
+        positions_by_shard = defaultdict(list)  # type: Dict[int, List[int]]
+        for i, line in enumerate(command.lines):
+            positions_by_shard[self.shard_for_sku(line.sku)].append(i)
+        futures = []
+        for shard, positions in positions_by_shard.items():
+            lines = commands.AllocateMany([command.lines[i] for i in positions])
+            futures.append((positions, self._submit_to(shard, lines)))
+        results = [None] * len(command.lines)
+        for positions, future in futures:
+            for i, result in zip(positions, future.result()):
+                results[i] = result
+        return results
+
+    def _change_batch_quantities(self, command: commands.ChangeBatchQuantities):
+        changes_by_shard = defaultdict(list)  # type: Dict[int, List]
+        for change in command.changes:
+            changes_by_shard[self._shard_for(change)].append(change)
+        futures = [
+            self._submit_to(shard, commands.ChangeBatchQuantities(changes))
+            for shard, changes in changes_by_shard.items()
+        ]
+        for future in futures:
+            future.result()
+
+    def _submit_to(self, shard: int, command: commands.Command) -> Future:
+        future = Future()  # type: Future
+        self._queues[shard].put((command, future), timeout=self.submit_timeout)
+        return future
+
+    @staticmethod
+    def _work(worker_queue: queue.Queue, bus: messagebus.MessageBus):
+        while True:
+            item = worker_queue.get()
+            if item is _STOP:
+                return
+            command, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(bus.handle(command))
+            except Exception as e:
+                future.set_exception(e)
@@ -1,17 +1,41 @@
 # pylint: disable=attribute-defined-outside-init
 from __future__ import annotations
 import abc
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import functools
+import threading
+from typing import Optional, Set
+from sqlalchemy import create_engine, exc
+from sqlalchemy.orm import exc as orm_exc, sessionmaker
 from sqlalchemy.orm.session import Session
 
 
 from allocation import config
-from allocation.adapters import repository
+from allocation.adapters import outbox, repository
+
+
+# postgres' serialization_failure and deadlock_detected
+CONFLICT_SQLSTATES = {"40001", "40P01"}
+
+
+class ConcurrencyError(Exception):
+    """
+    Someone else changed the same aggregate first. Nothing was committed, so
+    the work can be retried from scratch.
+    """
+
+
+def is_conflict(error: Exception) -> bool:
+    if isinstance(error, orm_exc.StaleDataError):
+        return True
+    orig = getattr(error, "orig", None)
+    sqlstate = getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+    return sqlstate in CONFLICT_SQLSTATES
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
+    # whether commit() also records events in the outbox table, for the relay
+    uses_outbox = False
 
     def __enter__(self) -> AbstractUnitOfWork:
         return self
@@ -36,21 +60,61 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
+@functools.lru_cache(maxsize=None)
+def default_session_factory():
+    # created on first use, so that importing this doesn't set up the engine
+    return sessionmaker(
+        bind=create_engine(
+            config.get_postgres_uri(),
+            isolation_level=config.get_isolation_level(),
+        )
     )
-)
+
+
+class _ThreadState(threading.local):
+    session = None  # type: Optional[Session]
+    products = None  # type: Optional[repository.SqlAlchemyRepository]
+    in_outbox = None  # type: Optional[Set[int]]
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    """
+    One instance is shared by every handler, and by every thread handling
+    messages, so the session and repository are thread locals: each thread
+    gets its own.
+
+    Its sessions don't autoflush, so changes are only written by commit(),
+    which raises a conflict as ConcurrencyError, and not by whichever lookup
+    or lazy load happens to come next, which would raise it as a bare
+    SQLAlchemy error.
+    """
+
+    def __init__(
+        self,
+        session_factory=None,
+        use_outbox=False,
+        load_strategy="selectin",
+    ):
         self.session_factory = session_factory
+        self.uses_outbox = use_outbox
+        self.load_strategy = load_strategy
+        self._local = _ThreadState()
+
+    @property
+    def session(self) -> Session:
+        return self._local.session
+
+    @property
+    def products(self) -> repository.SqlAlchemyRepository:
+        return self._local.products
 
     def __enter__(self):
-        self.session = self.session_factory()  # type: Session
-        self.products = repository.SqlAlchemyRepository(self.session)
+        session = self._make_session()
+        self._local.session = session
+        self._local.products = repository.SqlAlchemyRepository(
+            session, load_strategy=self.load_strategy
+        )
+        self._local.in_outbox = set()
         return super().__enter__()
 
     def __exit__(self, *args):
@@ -58,7 +122,88 @@ class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
         self.session.close()
 
     def _commit(self):
-        self.session.commit()
+        if self.uses_outbox:
+            outbox.add(self.session, self._events_not_in_outbox())
+        try:
+            self.session.commit()
+        except (orm_exc.StaleDataError, exc.DBAPIError) as e:
+            if not is_conflict(e):
+                raise
+            raise ConcurrencyError(str(e)) from e
+
+    def _make_session(self, **kwargs) -> Session:
+        session_factory = self.session_factory or default_session_factory()
+        return session_factory(autoflush=False, **kwargs)
+
+    def collect_new_events(self):
+        # this thread may not have used the unit of work yet
+        if self._local.products is not None:
+            yield from super().collect_new_events()
+
+    def _events_not_in_outbox(self):
+        # a handler may commit more than once before the bus collects events
+        in_outbox = self._local.in_outbox
+        for product in self.products.seen:
+            for event in product.events:
+                if id(event) not in in_outbox:
+                    in_outbox.add(id(event))
+                    yield event
+
+    def rollback(self):
+        self.session.rollback()
+
+
+class CachingSqlAlchemyUnitOfWork(SqlAlchemyUnitOfWork):
+    """
+    Keeps its session, and up to cache_size products in a CachingRepository,
+    from one unit of work to the next, so a command for a hot sku can skip
+    loading it. Meant for a ShardedCommandDispatcher worker, the only one
+    handling commands for its skus; see CachingRepository for validate, and
+    why it should stay on while anything else writes to products.
+    """
+
+    def __init__(
+        self,
+        session_factory=None,
+        use_outbox=False,
+        load_strategy="selectin",
+        cache_size=1000,
+        validate=True,
+    ):
+        super().__init__(session_factory, use_outbox, load_strategy)
+        self.cache_size = cache_size
+        self.validate = validate
+
+    @property
+    def products(self) -> repository.CachingRepository:
+        return self._local.products
+
+    def __enter__(self):
+        if self._local.session is None:
+            # committed objects stay usable without being loaded again
+            session = self._make_session(expire_on_commit=False)
+            self._local.session = session
+            self._local.products = repository.CachingRepository(
+                session,
+                load_strategy=self.load_strategy,
+                max_size=self.cache_size,
+                validate=self.validate,
+            )
+        # the bus has collected the last unit of work's events already
+        self.products.seen = set()
+        self._local.in_outbox = set()
+        return AbstractUnitOfWork.__enter__(self)
+
+    def __exit__(self, *args):
+        # keep the session open for next time
+        AbstractUnitOfWork.__exit__(self, *args)
 
     def rollback(self):
+        if not self.session.in_transaction():
+            return
+        # rolling back expires everything in the session, including the cached
+        # products, whose batch indexes would then be out of date, so start
+        # again from the database
         self.session.rollback()
+        self.session.expunge_all()
+        self.products.clear()
@@ -1,12 +1,40 @@
-from allocation.service_layer import unit_of_work
+from allocation.adapters.read_model import (
+    AbstractAsyncReadModel,
+    AbstractReadModel,
+    AsyncSqlReadModel,
+    SqlReadModel,
+)
+from allocation.adapters.view_cache import AbstractViewCache
+from allocation.service_layer import async_unit_of_work, unit_of_work
 
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+def allocations(
+    orderid: str,
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    cache: AbstractViewCache = None,
+    read_model: AbstractReadModel = None,
+):
+    if read_model is None:
+        read_model = SqlReadModel(uow)
+    if cache is not None:
+        return cache.get_or_load(orderid, lambda: read_model.get(orderid))
+    return read_model.get(orderid)
+
+
+def sku_for_batchref(batchref: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
     with uow:
-        results = uow.session.execute(
-            """
-            SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid
-            """,
-            dict(orderid=orderid),
-        )
-    return [dict(r) for r in results]
+        row = uow.session.execute(
+            "SELECT sku FROM batches WHERE reference = :batchref",
+            dict(batchref=batchref),
+        ).first()
+    return row.sku if row else None
+
+
+async def allocations_async(
+    orderid: str,
+    uow: async_unit_of_work.AsyncSqlAlchemyUnitOfWork,
+    read_model: AbstractAsyncReadModel = None,
+):
+    if read_model is None:
+        read_model = AsyncSqlReadModel(uow)
+    return await read_model.get(orderid)
@@ -25,6 +25,13 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
+def post_to_allocate_batch(lines):
+    url = config.get_api_url()
+    r = requests.post(f"{url}/allocate/batch", json={"lines": lines})
+    assert r.status_code == 202
+    return r
+
+
 def get_allocation(orderid):
     url = config.get_api_url()
     return requests.get(f"{url}/allocations/{orderid}")
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 from ..random_refs import random_batchref, random_orderid, random_sku
 from . import api_client
@@ -37,3 +38,58 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_batch_allocation_returns_a_result_per_line():
+    order1, order2 = random_orderid(1), random_orderid(2)
+    sku, unknown_sku = random_sku(), random_sku("unknown")
+    batch = random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+
+    r = api_client.post_to_allocate_batch(
+        [
+            {"orderid": order1, "sku": sku, "qty": 3},
+            {"orderid": order2, "sku": unknown_sku, "qty": 3},
+        ]
+    )
+
+    assert r.json() == [
+        {"orderid": order1, "sku": sku, "batchref": batch},
+        {
+            "orderid": order2,
+            "sku": unknown_sku,
+            "message": f"Invalid sku {unknown_sku}",
+        },
+    ]
+    r = api_client.get_allocation(order1)
+    assert r.json() == [{"sku": sku, "batchref": batch}]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_concurrent_allocations_never_overallocate():
+    sku, batch = random_sku(), random_batchref()
+    api_client.post_to_add_batch(batch, sku, 50, None)
+    orderids = [random_orderid(str(i)) for i in range(80)]
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        responses = list(
+            pool.map(
+                lambda orderid: api_client.post_to_allocate(
+                    orderid, sku, qty=1, expect_success=False
+                ),
+                orderids,
+            )
+        )
+
+    # 409 is what a request gets if it keeps losing the race for the product
+    statuses = [r.status_code for r in responses]
+    assert set(statuses) <= {202, 409}
+    allocated = [o for o in orderids if api_client.get_allocation(o).ok]
+    assert len(allocated) == min(50, statuses.count(202))
+    for orderid in allocated:
+        assert api_client.get_allocation(orderid).json() == [
+            {"sku": sku, "batchref": batch}
+        ]
@@ -0,0 +1,18 @@
+"""counting the queries a test makes"""
+from contextlib import contextmanager
+from sqlalchemy import event
+
+
+@contextmanager
+def counting_selects(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
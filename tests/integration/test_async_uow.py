@@ -0,0 +1,74 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from allocation import views
+from allocation.adapters.orm import metadata
+from allocation.domain import model
+from allocation.service_layer import async_unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def async_sqlite_session_factory(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+
+    asyncio.run(create_tables())
+    yield sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def test_async_uow_can_retrieve_a_batch_and_allocate_to_it(
+    async_sqlite_session_factory,
+):
+    uow = async_unit_of_work.AsyncSqlAlchemyUnitOfWork(async_sqlite_session_factory)
+
+    async def add_and_allocate():
+        async with uow:
+            batch = model.Batch("batch1", "HIPSTER-WORKBENCH", 100, eta=None)
+            uow.products.add(model.Product("HIPSTER-WORKBENCH", [batch]))
+            await uow.commit()
+        async with uow:
+            product = await uow.products.get(sku="HIPSTER-WORKBENCH")
+            product.allocate(model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+            await uow.commit()
+        async with uow:
+            product = await uow.products.get_by_batchref("batch1")
+            return product.batches[0].available_quantity
+
+    assert asyncio.run(add_and_allocate()) == 90
+
+
+def test_concurrent_tasks_get_their_own_sessions(async_sqlite_session_factory):
+    uow = async_unit_of_work.AsyncSqlAlchemyUnitOfWork(async_sqlite_session_factory)
+
+    async def session_in_task():
+        async with uow:
+            await asyncio.sleep(0.01)
+            return uow.session
+
+    async def run_two_tasks():
+        return await asyncio.gather(session_in_task(), session_in_task())
+
+    session1, session2 = asyncio.run(run_two_tasks())
+    assert session1 is not session2
+
+
+def test_async_allocations_view(async_sqlite_session_factory):
+    uow = async_unit_of_work.AsyncSqlAlchemyUnitOfWork(async_sqlite_session_factory)
+
+    async def insert_and_query():
+        async with uow:
+            await uow.session.execute(
+                "INSERT INTO allocations_view (orderid, sku, batchref)"
+                " VALUES ('order1', 'sku1', 'batch1')"
+            )
+            await uow.commit()
+        return await views.allocations_async("order1", uow)
+
+    assert asyncio.run(insert_and_query()) == [{"sku": "sku1", "batchref": "batch1"}]
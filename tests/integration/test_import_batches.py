@@ -0,0 +1,62 @@
+# pylint: disable=redefined-outer-name
+import io
+from datetime import date
+from unittest import mock
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.entrypoints import import_batches_cli
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    yield bus
+    clear_mappers()
+
+
+def test_reads_csv_and_jsonl_and_reports_bad_rows():
+    csv_batches, csv_errors = import_batches_cli.read_batches(
+        io.StringIO("ref,sku,qty,eta\nb1,sku1,10,2011-01-02\nb2,sku1,lots,\n"),
+        "csv",
+    )
+    jsonl_batches, jsonl_errors = import_batches_cli.read_batches(
+        io.StringIO(
+            '{"ref": "b1", "sku": "sku1", "qty": 10, "eta": "2011-01-02"}\n{'
+        ),
+        "jsonl",
+    )
+
+    assert csv_batches == jsonl_batches == [
+        commands.CreateBatch("b1", "sku1", 10, date(2011, 1, 2))
+    ]
+    assert [e.split(":")[0] for e in csv_errors] == ["line 3"]
+    assert [e.split(":")[0] for e in jsonl_errors] == ["line 2"]
+
+
+def test_imports_in_chunks_after_checking_for_duplicates(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("existing", "sku1", 10, None))
+    batches = [commands.CreateBatch(f"b{i}", f"sku{i % 3}", 10) for i in range(5)]
+
+    assert import_batches_cli.duplicate_batchrefs(
+        batches + [commands.CreateBatch("existing", "sku1", 10), batches[0]],
+        sqlite_bus.uow,
+        chunk_size=2,
+    ) == {"existing", "b0"}
+
+    imported = import_batches_cli.import_batches(sqlite_bus, batches, chunk_size=2)
+
+    assert imported == 5
+    assert import_batches_cli.duplicate_batchrefs(batches, sqlite_bus.uow) == {
+        f"b{i}" for i in range(5)
+    }
+    with sqlite_bus.uow:
+        products = [sqlite_bus.uow.products.get(f"sku{i}") for i in range(3)]
+        assert sorted(len(p.batches) for p in products) == [1, 2, 3]
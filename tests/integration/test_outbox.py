@@ -0,0 +1,97 @@
+# pylint: disable=redefined-outer-name
+import json
+from unittest import mock
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.entrypoints import outbox_relay
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def outbox_bus(sqlite_session_factory):
+    publish = mock.Mock()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, use_outbox=True)
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=uow,
+        notifications=mock.Mock(),
+        publish=publish,
+    )
+    yield bus, publish
+    clear_mappers()
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.buffered = []
+
+    def publish(self, channel, message):
+        self.buffered.append((channel, message))
+
+    def execute(self):
+        self.redis.published.extend(self.buffered)
+
+
+def test_events_are_written_to_outbox_instead_of_published(
+    outbox_bus, sqlite_session_factory
+):
+    bus, publish = outbox_bus
+    bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    bus.handle(commands.CreateBatch("b2", "sku1", 10, None))
+    bus.handle(commands.Allocate("o1", "sku1", 10))
+
+    assert not publish.called
+    session = sqlite_session_factory()
+    [(channel, message)] = session.execute("SELECT channel, message FROM outbox")
+    assert channel == "line_allocated"
+    assert json.loads(message)["orderid"] == "o1"
+
+
+def test_every_event_is_written_once_when_a_handler_commits_twice(
+    outbox_bus, sqlite_session_factory
+):
+    bus, _ = outbox_bus
+    bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    bus.handle(commands.CreateBatch("b2", "sku2", 10, None))
+    bus.handle(
+        commands.AllocateMany(
+            [commands.Allocate("o1", "sku1", 1), commands.Allocate("o1", "sku2", 1)]
+        )
+    )
+
+    session = sqlite_session_factory()
+    rows = list(session.execute("SELECT message FROM outbox"))
+    assert sorted(json.loads(m)["sku"] for m, in rows) == ["sku1", "sku2"]
+
+
+def test_relay_publishes_in_order_and_empties_outbox(
+    outbox_bus, sqlite_session_factory
+):
+    bus, _ = outbox_bus
+    bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    bus.handle(commands.CreateBatch("b2", "sku1", 10, None))
+    bus.handle(commands.Allocate("o1", "sku1", 10))
+    bus.handle(commands.ChangeBatchQuantity("b1", 5))
+    fake_redis = FakeRedis()
+
+    relayed = outbox_relay.relay(sqlite_session_factory(), fake_redis, batch_size=10)
+
+    assert relayed == 3
+    assert [channel for channel, _ in fake_redis.published] == [
+        "line_allocated",
+        "line_deallocated",
+        "line_allocated",
+    ]
+    session = sqlite_session_factory()
+    assert list(session.execute("SELECT * FROM outbox")) == []
@@ -0,0 +1,101 @@
+# pylint: disable=redefined-outer-name
+from unittest import mock
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from allocation import bootstrap, views
+from allocation.adapters.orm import metadata
+from allocation.adapters.read_model import SqlReadModel
+from allocation.domain import commands
+from allocation.entrypoints import read_model_cli
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def sqlite_bus(tmp_path):
+    # a file rather than :memory:, so the cli's streaming reads get their own
+    # connection instead of sharing the one being written through
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    yield bus
+    clear_mappers()
+
+
+def test_rebuild_repopulates_the_read_model_from_the_allocations(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku2", 10, None))
+    sqlite_bus.handle(commands.Allocate("o1", "sku1", 5))
+    sqlite_bus.handle(commands.Allocate("o1", "sku2", 5))
+    sqlite_bus.handle(commands.Allocate("o2", "sku1", 5))
+    read_model = SqlReadModel(sqlite_bus.uow)
+    read_model.rebuild([("stale-order", "sku1", "b1")])
+    assert views.allocations("o1", sqlite_bus.uow) == []
+
+    rebuilt = read_model_cli.rebuild(
+        sqlite_bus.uow.session_factory, read_model, chunk_size=2
+    )
+
+    assert rebuilt == 3
+
+    assert views.allocations("stale-order", sqlite_bus.uow) == []
+    assert views.allocations("o1", sqlite_bus.uow) == [
+        {"sku": "sku1", "batchref": "b1"},
+        {"sku": "sku2", "batchref": "b2"},
+    ]
+    assert views.allocations("o2", sqlite_bus.uow) == [
+        {"sku": "sku1", "batchref": "b1"}
+    ]
+
+
+def test_verify_reports_rows_that_differ_and_reconcile_fixes_them(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 10, None))
+    sqlite_bus.handle(commands.CreateBatch("b3", "sku2", 10, None))
+    sqlite_bus.handle(commands.Allocate("o1", "sku1", 10))
+    sqlite_bus.handle(commands.Allocate("o2", "sku1", 10))
+    sqlite_bus.handle(commands.Allocate("o3", "sku2", 10))
+    read_model = SqlReadModel(sqlite_bus.uow)
+    read_model.remove("o1", "sku1", "b1")
+    read_model.add("o2", "sku1", "b1")
+    read_model.add("stale-order", "sku2", "b3")
+    session_factory = sqlite_bus.uow.session_factory
+
+    assert list(read_model_cli.verify(session_factory, read_model, ["sku2"])) == [
+        read_model_cli.Difference("stale-order", "sku2", None, "b3"),
+    ]
+    assert list(read_model_cli.verify(session_factory, read_model)) == [
+        read_model_cli.Difference("o1", "sku1", "b1", None),
+        read_model_cli.Difference("o2", "sku1", None, "b1"),
+        read_model_cli.Difference("stale-order", "sku2", None, "b3"),
+    ]
+
+    fixed = list(read_model_cli.reconcile(session_factory, read_model))
+
+    assert len(fixed) == 3
+    assert list(read_model_cli.verify(session_factory, read_model)) == []
+    assert views.allocations("o1", sqlite_bus.uow) == [
+        {"sku": "sku1", "batchref": "b1"}
+    ]
+    assert views.allocations("o2", sqlite_bus.uow) == [
+        {"sku": "sku1", "batchref": "b2"}
+    ]
+    assert views.allocations("stale-order", sqlite_bus.uow) == []
+
+
+def test_allocations_from_source_streams_rows_in_chunks(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 100, None))
+    for i in range(5):
+        sqlite_bus.handle(commands.Allocate(f"o{i}", "sku1", 1))
+
+    rows = read_model_cli.allocations_from_source(
+        sqlite_bus.uow.session_factory, chunk_size=2
+    )
+
+    assert next(rows) == ("o0", "sku1", "b1")
+    assert list(rows) == [(f"o{i}", "sku1", "b1") for i in range(1, 5)]
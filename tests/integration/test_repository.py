@@ -1,6 +1,9 @@
+from datetime import date
 import pytest
+from sqlalchemy import exc
 from allocation.adapters import repository
 from allocation.domain import model
+from .counting import counting_selects
 
 pytestmark = pytest.mark.usefixtures("mappers")
 
@@ -17,3 +20,250 @@ def test_get_by_batchref(sqlite_session_factory):
     repo.add(p2)
     assert repo.get_by_batchref("b2") == p1
     assert repo.get_by_batchref("b3") == p2
+
+
+def test_loaded_batches_count_their_existing_allocations(sqlite_session_factory):
+    session = sqlite_session_factory()
+    batch = model.Batch(ref="b1", sku="sku1", qty=100, eta=None)
+    batch.allocate(model.OrderLine("o1", "sku1", 10))
+    batch.allocate(model.OrderLine("o2", "sku1", 20))
+    session.add(model.Product(sku="sku1", batches=[batch]))
+    session.commit()
+
+    session = sqlite_session_factory()
+    [batch] = repository.SqlAlchemyRepository(session).get("sku1").batches
+    assert batch.allocated_quantity == 30
+    batch.allocate(model.OrderLine("o3", "sku1", 5))
+    assert batch.available_quantity == 65
+    assert batch.allocated_quantity == sum(l.qty for l in batch._allocations)
+
+
+def insert_product_with_batches(session_factory, sku, batch_count):
+    session = session_factory()
+    batches = []
+    for i in range(batch_count):
+        # every batch but the last has less room than a line of 6 needs
+        qty = 100 if i == batch_count - 1 else 10
+        batch = model.Batch(ref=f"{sku}-batch{i}", sku=sku, qty=qty, eta=None)
+        batch.allocate(model.OrderLine(f"{sku}-order{i}", sku, 10 if i % 2 else 5))
+        batches.append(batch)
+    session.add(model.Product(sku=sku, batches=batches))
+    session.commit()
+
+
+def selects_to_allocate(
+    session_factory, sku, strategy="selectin", get_for_allocation=False
+):
+    session = session_factory()
+    repo = repository.SqlAlchemyRepository(session, load_strategy=strategy)
+    with counting_selects(session.get_bind()) as statements:
+        if get_for_allocation:
+            product = repo.get_for_allocation(sku)
+        else:
+            product = repo.get(sku)
+        batchref = product.allocate(model.OrderLine("new-order", sku, 6))
+        session.flush()
+    assert batchref == product.batches[-1].reference
+    return len(statements)
+
+
+@pytest.mark.parametrize("strategy", ["selectin", "joined"])
+def test_eager_strategies_allocate_in_constant_selects(
+    sqlite_session_factory, strategy
+):
+    insert_product_with_batches(sqlite_session_factory, "few", 2)
+    insert_product_with_batches(sqlite_session_factory, "many", 40)
+    few = selects_to_allocate(sqlite_session_factory, "few", strategy)
+    many = selects_to_allocate(sqlite_session_factory, "many", strategy)
+    assert few == many
+
+
+def test_lazy_strategy_selects_per_batch(sqlite_session_factory):
+    insert_product_with_batches(sqlite_session_factory, "few", 2)
+    insert_product_with_batches(sqlite_session_factory, "many", 40)
+    few = selects_to_allocate(sqlite_session_factory, "few", "lazy")
+    many = selects_to_allocate(sqlite_session_factory, "many", "lazy")
+    assert many > few
+
+
+def test_get_for_allocation_allocates_in_constant_selects(sqlite_session_factory):
+    insert_product_with_batches(sqlite_session_factory, "few", 2)
+    insert_product_with_batches(sqlite_session_factory, "many", 40)
+    for_allocation = dict(get_for_allocation=True)
+    few = selects_to_allocate(sqlite_session_factory, "few", **for_allocation)
+    many = selects_to_allocate(sqlite_session_factory, "many", **for_allocation)
+    assert few == many
+
+
+def test_get_for_allocation_only_loads_batches_with_room(sqlite_session_factory):
+    insert_product_with_batches(sqlite_session_factory, "sku1", 6)
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+
+    product = repo.get_for_allocation("sku1")
+
+    assert sorted(b.reference for b in product.batches) == [
+        "sku1-batch0",
+        "sku1-batch2",
+        "sku1-batch4",
+        "sku1-batch5",
+    ]
+    assert [b.allocated_quantity for b in product.batches].count(5) == 3
+
+
+@pytest.mark.parametrize("strategy", ["selectin", "joined", "lazy", "capacity"])
+def test_get_returns_the_whole_product_after_get_for_allocation(
+    sqlite_session_factory, strategy
+):
+    insert_product_with_batches(sqlite_session_factory, "sku1", 3)
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session, load_strategy=strategy)
+    product = repo.get_for_allocation("sku1")
+    product.allocate(model.OrderLine("new-order", "sku1", 5))
+
+    assert repo.get_by_batchref("sku1-batch1") is product
+    assert repo.get("sku1") is product
+    assert sorted(b.reference for b in product.batches) == [
+        "sku1-batch0",
+        "sku1-batch1",
+        "sku1-batch2",
+    ]
+    product.change_batch_quantity("sku1-batch1", 5)
+    assert [e.orderid for e in product.events[1:]] == ["sku1-order1"]
+    session.commit()
+
+    session = sqlite_session_factory()
+    batches = repository.SqlAlchemyRepository(session).get("sku1").batches
+    assert [b.allocated_quantity for b in batches] == [10, 0, 5]
+
+
+def loaded_lines(session):
+    objects = session.identity_map.values()
+    return [obj for obj in objects if isinstance(obj, model.OrderLine)]
+
+
+def test_capacity_strategy_allocates_without_loading_lines(sqlite_session_factory):
+    insert_product_with_batches(sqlite_session_factory, "sku1", 4)
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session, load_strategy="capacity")
+
+    product = repo.get_for_allocation("sku1")
+    assert [b.allocated_quantity for b in product.batches] == [5, 5, 10]
+    assert product.allocate(model.OrderLine("new-order", "sku1", 5)) == "sku1-batch0"
+    session.flush()
+    assert [l.orderid for l in loaded_lines(session)] == ["new-order"]
+    session.commit()
+
+    session = sqlite_session_factory()
+    [batch, *_] = repository.SqlAlchemyRepository(session).get("sku1").batches
+    assert batch.allocated_quantity == 10
+    assert {l.orderid for l in batch._allocations} == {"sku1-order0", "new-order"}
+
+
+def test_capacity_strategy_allocates_a_line_only_once(sqlite_session_factory):
+    insert_product_with_batches(sqlite_session_factory, "sku1", 2)
+    for _ in range(2):
+        session = sqlite_session_factory()
+        repo = repository.SqlAlchemyRepository(session, load_strategy="capacity")
+        line = model.OrderLine("new-order", "sku1", 1)
+        repo.get_for_allocation("sku1").allocate(line)
+        session.commit()
+
+    session = sqlite_session_factory()
+    [batch, _] = repository.SqlAlchemyRepository(
+        session, load_strategy="capacity"
+    ).get("sku1").batches
+    # summed in SQL, so a line allocated twice would be counted twice
+    assert batch.allocated_quantity == 6
+
+
+def test_capacity_strategy_can_deallocate_after_allocating(sqlite_session_factory):
+    insert_product_with_batches(sqlite_session_factory, "sku1", 2)
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session, load_strategy="capacity")
+    product = repo.get_for_allocation("sku1")
+    product.allocate(model.OrderLine("new-order", "sku1", 1))
+
+    # the same product, from the session's identity map
+    assert repo.get_by_batchref("sku1-batch0") is product
+    product.change_batch_quantity("sku1-batch0", 0)
+    deallocated = {e.orderid for e in product.events[1:]}
+    assert deallocated == {"sku1-order0", "new-order"}
+    session.commit()
+
+    session = sqlite_session_factory()
+    batches = repository.SqlAlchemyRepository(session).get("sku1").batches
+    assert [b.allocated_quantity for b in batches] == [0, 10]
+
+
+def test_capacity_strategy_loads_lines_only_to_deallocate(sqlite_session_factory):
+    insert_product_with_batches(sqlite_session_factory, "sku1", 3)
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session, load_strategy="capacity")
+
+    product = repo.get_by_batchref("sku1-batch0")
+    product.change_batch_quantity("sku1-batch0", 5)
+    assert loaded_lines(session) == []
+    product.change_batch_quantity("sku1-batch1", 5)
+    assert [l.orderid for l in loaded_lines(session)] == ["sku1-order1"]
+    assert [e.orderid for e in product.events] == ["sku1-order1"]
+    session.commit()
+
+    session = sqlite_session_factory()
+    batches = repository.SqlAlchemyRepository(session).get("sku1").batches
+    assert [b.allocated_quantity for b in batches] == [5, 0, 5]
+
+
+def test_batch_references_are_unique(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    repo.add(model.Product("sku1", [model.Batch("b1", "sku1", 10, None)]))
+    repo.add(model.Product("sku2", [model.Batch("b1", "sku2", 10, None)]))
+    with pytest.raises(exc.IntegrityError):
+        session.commit()
+
+
+def test_add_batches_inserts_batches_and_missing_products(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    repo.add(model.Product("sku1", [model.Batch("b1", "sku1", 10, None)]))
+    session.commit()
+
+    repo.add_batches(
+        [
+            model.Batch("b2", "sku1", 20, date(2011, 1, 2)),
+            model.Batch("b3", "sku2", 30, None),
+        ]
+    )
+    session.commit()
+
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    assert [(b.reference, b.eta) for b in repo.get("sku1").batches] == [
+        ("b1", None),
+        ("b2", date(2011, 1, 2)),
+    ]
+    [batch] = repo.get("sku2").batches
+    assert batch.available_quantity == 30
+    assert repo.existing_batchrefs(["b1", "b3", "b4"]) == {"b1", "b3"}
+
+
+def test_caching_repository_keeps_the_most_recently_used_products(
+    sqlite_session_factory,
+):
+    for sku in ("sku1", "sku2", "sku3"):
+        insert_product_with_batches(sqlite_session_factory, sku, 2)
+    session = sqlite_session_factory()
+    repo = repository.CachingRepository(session, max_size=2)
+    for sku in ("sku1", "sku2", "sku1", "sku3"):
+        repo.get(sku)
+
+    with counting_selects(session.get_bind()) as statements:
+        repo.get("sku1")
+        repo.get("sku3")
+        repo.get_by_batchref("sku1-batch0")
+    assert statements == []
+
+    with counting_selects(session.get_bind()) as statements:
+        repo.get("sku2")
+    assert statements != []
@@ -5,9 +5,14 @@ import traceback
 from typing import List
 from unittest.mock import Mock
 import pytest
-from allocation.domain import model
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from allocation import bootstrap, views
+from allocation.adapters.orm import metadata
+from allocation.domain import commands, model
 from allocation.service_layer import unit_of_work
 from ..random_refs import random_sku, random_batchref, random_orderid
+from .counting import counting_selects
 
 pytestmark = pytest.mark.usefixtures("mappers")
 
@@ -130,3 +135,225 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     assert orders.rowcount == 1
     with unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory) as uow:
         uow.session.execute("select 1")
+
+
+def test_stale_product_version_raises_concurrency_error(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 100, None)
+    session.commit()
+
+    uow1 = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    uow2 = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow1:
+        product = uow1.products.get(sku="HIPSTER-WORKBENCH")
+        product.allocate(model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+        with uow2:
+            product = uow2.products.get(sku="HIPSTER-WORKBENCH")
+            product.allocate(model.OrderLine("o2", "HIPSTER-WORKBENCH", 10))
+            uow2.commit()
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            uow1.commit()
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='HIPSTER-WORKBENCH'"
+    )
+    assert version == 2
+
+
+@pytest.mark.parametrize("load_strategy", ["selectin", "capacity"])
+def test_stale_product_version_raises_concurrency_error_from_commit_only(
+    tmp_path, load_strategy
+):
+    session_factory = sqlite_file_session_factory(tmp_path)
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 100, None)
+    insert_batch(session, "batch2", "HIPSTER-STOOL", 100, None)
+    session.commit()
+    other_uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    allocate_with(other_uow, "o1", "HIPSTER-WORKBENCH")
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, load_strategy=load_strategy
+    )
+    with uow:
+        product = uow.products.get(sku="HIPSTER-WORKBENCH")
+        allocate_with(other_uow, "o2", "HIPSTER-WORKBENCH")
+        # with "capacity", deallocating lazy loads the batch's lines
+        product.change_batch_quantity("batch1", 5)
+        # and a lookup queries; neither may flush the stale product
+        uow.products.get(sku="HIPSTER-STOOL")
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            uow.commit()
+
+
+def test_concurrent_updates_at_read_committed_conflict_on_version(postgres_db):
+    session_factory = sessionmaker(
+        bind=postgres_db.execution_options(isolation_level="READ COMMITTED")
+    )
+    sku, batch = random_sku(), random_batchref()
+    session = session_factory()
+    insert_batch(session, batch, sku, 100, eta=None, product_version=1)
+    session.commit()
+
+    exceptions = []  # type: List[Exception]
+    threads = [
+        threading.Thread(
+            target=try_to_allocate,
+            args=(random_orderid(i), sku, exceptions, session_factory),
+        )
+        for i in (1, 2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    [exception] = exceptions
+    assert isinstance(exception, unit_of_work.ConcurrencyError)
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku=:sku",
+        dict(sku=sku),
+    )
+    assert version == 2
+
+
+def test_threads_sharing_a_uow_get_their_own_sessions(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    sessions = {}
+    entered = threading.Barrier(2)
+
+    def use_uow(name):
+        with uow:
+            entered.wait()
+            sessions[name] = (uow.session, uow.products)
+
+    threads = [threading.Thread(target=use_uow, args=(n,)) for n in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    (session_a, products_a), (session_b, products_b) = sessions.values()
+    assert session_a is not session_b
+    assert products_a is not products_b
+
+
+def test_concurrent_handlers_on_a_shared_bus(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'allocation.db'}",
+        connect_args=dict(timeout=30),
+    )
+    metadata.create_all(engine)
+    clear_mappers()  # bootstrap starts them again
+    bus = bootstrap.bootstrap(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        notifications=Mock(),
+        publish=lambda *args: None,
+    )
+    skus = [random_sku(str(i)) for i in range(8)]
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 100, None))
+    errors = []  # type: List[Exception]
+
+    def allocate_lots(sku):
+        try:
+            for i in range(10):
+                bus.handle(commands.Allocate(f"{sku}-order{i}", sku, 1))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=allocate_lots, args=(sku,)) for sku in skus]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for sku in skus:
+        for i in range(10):
+            assert views.allocations(f"{sku}-order{i}", bus.uow) == [
+                {"sku": sku, "batchref": f"{sku}-batch"}
+            ]
+
+
+def sqlite_file_session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def allocate_with(uow, orderid, sku, qty=10):
+    with uow:
+        product = uow.products.get_for_allocation(sku=sku)
+        batchref = product.allocate(model.OrderLine(orderid, sku, qty))
+        uow.commit()
+    return batchref
+
+
+def test_caching_uow_allocates_a_cached_product_without_selecting_it(tmp_path):
+    session_factory = sqlite_file_session_factory(tmp_path)
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 100, None)
+    session.commit()
+    uow = unit_of_work.CachingSqlAlchemyUnitOfWork(session_factory, validate=False)
+    allocate_with(uow, "o1", "HIPSTER-WORKBENCH")
+
+    with counting_selects(session.get_bind()) as statements:
+        allocate_with(uow, "o2", "HIPSTER-WORKBENCH")
+
+    assert statements == []
+    assert get_allocated_batch_ref(session, "o2", "HIPSTER-WORKBENCH") == "batch1"
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='HIPSTER-WORKBENCH'"
+    )
+    assert version == 3
+
+
+def test_caching_uow_reloads_a_product_changed_elsewhere(tmp_path):
+    session_factory = sqlite_file_session_factory(tmp_path)
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 20, None)
+    session.commit()
+    uow = unit_of_work.CachingSqlAlchemyUnitOfWork(session_factory)
+    allocate_with(uow, "o1", "HIPSTER-WORKBENCH")
+    other_uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    allocate_with(other_uow, "o2", "HIPSTER-WORKBENCH")
+
+    assert allocate_with(uow, "o3", "HIPSTER-WORKBENCH") is None  # out of stock
+
+
+def test_unvalidated_caching_uow_reloads_a_product_changed_elsewhere_on_conflict(
+    tmp_path,
+):
+    session_factory = sqlite_file_session_factory(tmp_path)
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 20, None)
+    session.commit()
+    uow = unit_of_work.CachingSqlAlchemyUnitOfWork(session_factory, validate=False)
+    allocate_with(uow, "o1", "HIPSTER-WORKBENCH")
+    other_uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    allocate_with(other_uow, "o2", "HIPSTER-WORKBENCH")
+
+    with pytest.raises(unit_of_work.ConcurrencyError):
+        allocate_with(uow, "o3", "HIPSTER-WORKBENCH")
+    assert allocate_with(uow, "o3", "HIPSTER-WORKBENCH") is None  # out of stock
+
+
+def test_caching_uow_sees_batches_added_elsewhere(tmp_path):
+    session_factory = sqlite_file_session_factory(tmp_path)
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 10, None)
+    session.commit()
+    uow = unit_of_work.CachingSqlAlchemyUnitOfWork(session_factory)
+    allocate_with(uow, "o1", "HIPSTER-WORKBENCH")
+    other_uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with other_uow:
+        other_uow.products.add_batches(
+            [model.Batch("batch2", "HIPSTER-WORKBENCH", 10, None)]
+        )
+        other_uow.commit()
+
+    assert allocate_with(uow, "o2", "HIPSTER-WORKBENCH") == "batch2"
@@ -4,6 +4,7 @@ from sqlalchemy.orm import clear_mappers
 from unittest import mock
 import pytest
 from allocation import bootstrap, views
+from allocation.adapters.view_cache import LRUViewCache
 from allocation.domain import commands
 from allocation.service_layer import unit_of_work
 
@@ -11,12 +12,18 @@ today = date.today()
 
 
 @pytest.fixture
-def sqlite_bus(sqlite_session_factory):
+def view_cache():
+    return LRUViewCache()
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory, view_cache):
     bus = bootstrap.bootstrap(
         start_orm=True,
         uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
         notifications=mock.Mock(),
         publish=lambda *args: None,
+        view_cache=view_cache,
     )
     yield bus
     clear_mappers()
@@ -47,3 +54,51 @@ def test_deallocation(sqlite_bus):
     assert views.allocations("o1", sqlite_bus.uow) == [
         {"sku": "sku1", "batchref": "b2"},
     ]
+
+
+def test_allocations_view_keeps_a_row_per_batch_of_an_orders_sku(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    sqlite_bus.handle(commands.Allocate("order1", "sku1", 40))
+    sqlite_bus.handle(commands.Allocate("order1", "sku1", 20))
+    sqlite_bus.handle(commands.Allocate("order1", "sku1", 5))
+
+    assert views.allocations("order1", sqlite_bus.uow) == [
+        {"sku": "sku1", "batchref": "b1"},
+        {"sku": "sku1", "batchref": "b2"},
+    ]
+
+
+def test_deallocating_one_of_an_orders_lines_keeps_the_others_rows(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    sqlite_bus.handle(commands.Allocate("order1", "sku1", 40))
+    sqlite_bus.handle(commands.Allocate("order1", "sku1", 20))
+    sqlite_bus.handle(commands.ChangeBatchQuantity("b2", 10))
+
+    assert views.allocations("order1", sqlite_bus.uow) == [
+        {"sku": "sku1", "batchref": "b1"},
+    ]
+
+
+def test_sku_for_batchref(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    assert views.sku_for_batchref("b1", sqlite_bus.uow) == "sku1"
+    assert views.sku_for_batchref("nonesuch", sqlite_bus.uow) is None
+
+
+def test_cached_allocations_view_is_invalidated_by_the_read_model(
+    sqlite_bus, view_cache
+):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    sqlite_bus.handle(commands.Allocate("o1", "sku1", 20))
+    cached = lambda: views.allocations("o1", sqlite_bus.uow, cache=view_cache)
+
+    assert cached() == [{"sku": "sku1", "batchref": "b1"}]
+    assert cached() == [{"sku": "sku1", "batchref": "b1"}]
+    assert view_cache.hits == 1
+
+    sqlite_bus.handle(commands.ChangeBatchQuantity("b1", 10))
+
+    assert cached() == [{"sku": "sku1", "batchref": "b2"}]
@@ -0,0 +1,127 @@
+"""fakes shared by the unit tests, and the benchmarks"""
+from __future__ import annotations
+from collections import defaultdict
+from typing import Dict, List
+from allocation import bootstrap
+from allocation.adapters import notifications, repository
+from allocation.service_layer import unit_of_work
+
+
+class FakeRepository(repository.AbstractRepository):
+    def __init__(self, products):
+        super().__init__()
+        self._products = set(products)
+
+    def _add(self, product):
+        self._products.add(product)
+
+    def _get(self, sku):
+        return next((p for p in self._products if p.sku == sku), None)
+
+    def _get_by_batchref(self, batchref):
+        return next(
+            (p for p in self._products for b in p.batches if b.reference == batchref),
+            None,
+        )
+
+
+class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    def __init__(self):
+        self.products = FakeRepository([])
+        self.committed = False
+
+    def _commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+
+class FakeNotifications(notifications.AbstractNotifications):
+    def __init__(self):
+        self.sent = defaultdict(list)  # type: Dict[str, List[str]]
+
+    def send(self, destination, message):
+        self.sent[destination].append(message)
+
+
+def bootstrap_test_app():
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+    )
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = defaultdict(dict)
+        self.sets = defaultdict(set)
+
+    def hset(self, key, field, value):
+        self.hashes[key][field.encode()] = value.encode()
+
+    def hdel(self, key, field):
+        self.hashes[key].pop(field.encode(), None)
+        if not self.hashes[key]:
+            del self.hashes[key]
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field.encode())
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def sadd(self, key, member):
+        self.sets[key].add(member.encode())
+
+    def srem(self, key, member):
+        self.sets[key].discard(member.encode())
+        if not self.sets[key]:
+            del self.sets[key]
+
+    def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+    def scan_iter(self, match, count=None):
+        keys = list(self.hashes) + list(self.sets)
+        return [k.encode() for k in keys if k.startswith(match.rstrip("*"))]
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key.decode(), None)
+            self.sets.pop(key.decode(), None)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args) for name, args in self.commands]
+
+
+class FakeAsyncRedis:
+    def __init__(self, client: FakeRedis):
+        self.client = client
+
+    async def hgetall(self, key):
+        return self.client.hgetall(key)
+
+    def pipeline(self, transaction=True):
+        pipe = FakePipeline(self.client)
+        execute = pipe.execute
+
+        async def execute_async():
+            return execute()
+
+        pipe.execute = execute_async
+        return pipe
@@ -0,0 +1,177 @@
+# pylint: disable=no-self-use
+import asyncio
+from datetime import date
+from typing import Set, Tuple
+import pytest
+from allocation import bootstrap, views
+from allocation.adapters.read_model import AbstractAsyncReadModel
+from allocation.domain import commands
+from allocation.service_layer import handlers
+from allocation.adapters import repository
+from allocation.service_layer import async_unit_of_work
+from .fakes import FakeNotifications
+
+
+class FakeAsyncRepository(repository.AbstractAsyncRepository):
+    def __init__(self, products):
+        super().__init__()
+        self._products = set(products)
+
+    def _add(self, product):
+        self._products.add(product)
+
+    async def _get(self, sku):
+        await asyncio.sleep(0)
+        return next((p for p in self._products if p.sku == sku), None)
+
+    async def _get_by_batchref(self, batchref):
+        await asyncio.sleep(0)
+        return next(
+            (p for p in self._products for b in p.batches if b.reference == batchref),
+            None,
+        )
+
+
+class FakeAsyncUnitOfWork(async_unit_of_work.AbstractAsyncUnitOfWork):
+    def __init__(self):
+        self.products = FakeAsyncRepository([])
+        self.committed = False
+
+    async def _commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        pass
+
+
+class FakeAsyncReadModel(AbstractAsyncReadModel):
+    def __init__(self):
+        self.allocations = set()  # type: Set[Tuple[str, str, str]]
+
+    async def add(self, orderid, sku, batchref):
+        self.allocations.add((orderid, sku, batchref))
+
+    async def remove(self, orderid, sku, batchref):
+        self.allocations.discard((orderid, sku, batchref))
+
+    async def get(self, orderid):
+        return [
+            {"sku": sku, "batchref": batchref}
+            for o, sku, batchref in sorted(self.allocations)
+            if o == orderid
+        ]
+
+
+def bootstrap_test_app(notifications=None, publish=None):
+    async def no_publish(*args):
+        pass
+
+    return bootstrap.bootstrap_async(
+        start_orm=False,
+        uow=FakeAsyncUnitOfWork(),
+        notifications=notifications or FakeNotifications(),
+        publish=publish or no_publish,
+        read_model=FakeAsyncReadModel(),
+    )
+
+
+def run(bus, *messages):
+    async def handle_all():
+        return [await bus.handle(m) for m in messages]
+
+    return asyncio.run(handle_all())
+
+
+class TestAllocate:
+    def test_allocates(self):
+        bus = bootstrap_test_app()
+        run(
+            bus,
+            commands.CreateBatch("batch1", "COMPLICATED-LAMP", 100, None),
+            commands.Allocate("o1", "COMPLICATED-LAMP", 10),
+        )
+        [batch] = bus.uow.products._products.pop().batches
+        assert batch.available_quantity == 90
+        assert bus.uow.committed
+
+    def test_errors_for_invalid_sku(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            run(bus, commands.Allocate("o1", "NONEXISTENTSKU", 10))
+
+    def test_publishes_and_sends_email_on_out_of_stock(self):
+        published = []
+
+        async def publish(channel, event):
+            published.append((channel, event.orderid))
+
+        fake_notifs = FakeNotifications()
+        bus = bootstrap_test_app(notifications=fake_notifs, publish=publish)
+        run(
+            bus,
+            commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None),
+            commands.Allocate("o1", "POPULAR-CURTAINS", 5),
+            commands.Allocate("o2", "POPULAR-CURTAINS", 5),
+        )
+        assert published == [("line_allocated", "o1")]
+        assert fake_notifs.sent["stock@made.com"] == [
+            "Out of stock for POPULAR-CURTAINS",
+        ]
+
+
+def test_reallocates_if_necessary():
+    bus = bootstrap_test_app()
+    run(
+        bus,
+        commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+        commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+        commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
+        commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
+        commands.ChangeBatchQuantity("batch1", 25),
+    )
+    [product] = bus.uow.products._products
+    batch1, batch2 = sorted(product.batches, key=lambda b: b.reference)
+    assert batch1.available_quantity == 5
+    assert batch2.available_quantity == 30
+
+
+def test_maintains_the_read_model_it_is_given():
+    read_model = FakeAsyncReadModel()
+    bus = bootstrap.bootstrap_async(
+        start_orm=False,
+        uow=FakeAsyncUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: asyncio.sleep(0),
+        read_model=read_model,
+    )
+    run(
+        bus,
+        commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+        commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+        commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
+        commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
+        commands.ChangeBatchQuantity("batch1", 25),
+    )
+
+    allocations = [
+        asyncio.run(views.allocations_async(orderid, bus.uow, read_model=read_model))
+        for orderid in ["order1", "order2"]
+    ]
+    assert sorted(a[0]["batchref"] for a in allocations) == ["batch1", "batch2"]
+
+
+def test_handles_messages_concurrently():
+    bus = bootstrap_test_app()
+    run(bus, commands.CreateBatch("b1", "RICKETY-SHELF", 100, None))
+
+    async def allocate_concurrently():
+        await asyncio.gather(
+            *(
+                bus.handle(commands.Allocate(f"o{i}", "RICKETY-SHELF", 1))
+                for i in range(10)
+            )
+        )
+
+    asyncio.run(allocate_concurrently())
+    [product] = bus.uow.products._products
+    assert product.batches[0].available_quantity == 90
@@ -0,0 +1,169 @@
+import threading
+from datetime import date
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands, events
+from allocation.service_layer.background import BackgroundEventDispatcher
+from .fakes import FakeNotifications, FakeUnitOfWork
+
+
+def test_handles_events_for_a_sku_in_order():
+    handled = []
+    dispatcher = BackgroundEventDispatcher(workers=4)
+    dispatcher.start(lambda: {events.Deallocated: [handled.append]})
+
+    for i in range(100):
+        event = events.Deallocated(orderid=i, sku=f"sku{i % 3}", qty=1, batchref="b1")
+        dispatcher.submit(event)
+    dispatcher.drain()
+
+    assert len(handled) == 100
+    for sku in ["sku0", "sku1", "sku2"]:
+        orderids = [e.orderid for e in handled if e.sku == sku]
+        assert orderids == sorted(orderids)
+    dispatcher.shutdown()
+
+
+def test_retries_failing_handlers():
+    attempts = []
+
+    def flaky_handler(event):
+        attempts.append(event)
+        if len(attempts) < 3:
+            raise ConnectionError("try again")
+
+    dispatcher = BackgroundEventDispatcher(workers=1, retry_delay=0)
+    dispatcher.start(lambda: {events.OutOfStock: [flaky_handler]})
+    dispatcher.submit(events.OutOfStock(sku="FLAKY-SKU"))
+    dispatcher.drain()
+
+    assert len(attempts) == 3
+    dispatcher.shutdown()
+
+
+def test_gives_up_after_max_attempts():
+    attempts = []
+
+    def broken_handler(event):
+        attempts.append(event)
+        raise ConnectionError("never works")
+
+    dispatcher = BackgroundEventDispatcher(workers=1, max_attempts=2, retry_delay=0)
+    dispatcher.start(lambda: {events.OutOfStock: [broken_handler]})
+    dispatcher.submit(events.OutOfStock(sku="BROKEN-SKU"))
+    dispatcher.drain()
+
+    assert len(attempts) == 2
+    dispatcher.shutdown()
+
+
+def test_cannot_submit_once_shut_down():
+    dispatcher = BackgroundEventDispatcher(workers=2)
+    dispatcher.start(lambda: {events.OutOfStock: [lambda event: None]})
+    dispatcher.shutdown()
+
+    with pytest.raises(RuntimeError, match="isn't running"):
+        dispatcher.submit(events.OutOfStock(sku="LATE-SKU"))
+
+
+def test_bus_carries_on_without_a_dispatcher_that_has_stopped():
+    dispatcher = BackgroundEventDispatcher(workers=1)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        background=dispatcher,
+        background_uow=FakeUnitOfWork,
+    )
+    bus.handle(commands.CreateBatch("b1", "LATE-LAMP", 10, None))
+    bus.handle(commands.CreateBatch("b2", "LATE-LAMP", 10, date.today()))
+    dispatcher.shutdown()
+
+    bus.handle(commands.Allocate("o1", "LATE-LAMP", 10))
+    batches = {b.reference: b for b in bus.uow.products.get("LATE-LAMP").batches}
+    assert batches["b1"].allocated_quantity == 10
+    # Deallocated's reallocation still happens inline
+    bus.handle(commands.ChangeBatchQuantity("b1", 5))
+    assert batches["b2"].allocated_quantity == 10
+
+
+def test_bus_does_not_wait_for_side_effects():
+    release = threading.Event()
+    fake_notifs = FakeNotifications()
+    send = fake_notifs.send
+    fake_notifs.send = lambda *args: release.wait(timeout=5) and send(*args)
+    dispatcher = BackgroundEventDispatcher(workers=2)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=fake_notifs,
+        publish=lambda *args: None,
+        background=dispatcher,
+        background_uow=FakeUnitOfWork,
+    )
+    bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+    bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
+    assert fake_notifs.sent["stock@made.com"] == []
+
+    release.set()
+    dispatcher.drain()
+    assert fake_notifs.sent["stock@made.com"] == [
+        "Out of stock for POPULAR-CURTAINS",
+    ]
+    dispatcher.shutdown()
+
+
+def test_sharded_buses_share_one_background_dispatcher():
+    background = BackgroundEventDispatcher(workers=2)
+    background_uows = []
+
+    def background_uow():
+        background_uows.append(FakeUnitOfWork())
+        return background_uows[-1]
+
+    def background_threads():
+        return [
+            t for t in threading.enumerate() if t.name.startswith("background-events")
+        ]
+
+    before = len(background_threads())
+    dispatcher = bootstrap.bootstrap_sharded(
+        workers=4,
+        make_uow=FakeUnitOfWork,
+        start_orm=False,
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        background=background,
+        background_uow=background_uow,
+    )
+    try:
+        assert len(background_threads()) - before == 2
+        assert len(background_uows) == 2
+    finally:
+        dispatcher.shutdown()
+        background.shutdown()
+
+
+def test_background_workers_get_a_read_model_on_their_own_uow(monkeypatch):
+    read_model_uows = []
+    monkeypatch.setattr(bootstrap, "make_read_model", read_model_uows.append)
+    background_uows = []
+
+    def background_uow():
+        background_uows.append(FakeUnitOfWork())
+        return background_uows[-1]
+
+    dispatcher = BackgroundEventDispatcher(workers=2)
+    uow = FakeUnitOfWork()
+    bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        background=dispatcher,
+        background_uow=background_uow,
+    )
+    dispatcher.shutdown()
+
+    assert read_model_uows == [uow] + background_uows
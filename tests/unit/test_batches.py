@@ -44,3 +44,24 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+
+def test_allocation_is_idempotent_for_lines_that_were_not_loaded():
+    batch, line = make_batch_and_line("ANGULAR-DESK", 20, 2)
+    batch._find_unloaded_line = lambda b, l: l == line
+    batch.allocate(line)
+    batch.allocate(OrderLine("order-456", "ANGULAR-DESK", 2))
+    assert batch.available_quantity == 18
+
+
+def test_allocated_quantity_is_kept_in_step_with_allocations():
+    batch = Batch("batch-001", "SHINY-KETTLE", qty=100, eta=None)
+    lines = [OrderLine(f"order-{i}", "SHINY-KETTLE", i) for i in range(1, 10)]
+    for line in lines:
+        batch.allocate(line)
+        batch.allocate(line)
+    batch.deallocate_one()
+    batch.allocate(OrderLine("too-big", "SHINY-KETTLE", 1000))
+    batch.deallocate_one()
+
+    assert batch.allocated_quantity == sum(l.qty for l in batch._allocations)
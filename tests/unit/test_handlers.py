@@ -1,61 +1,11 @@
 # pylint: disable=no-self-use
 from __future__ import annotations
-from collections import defaultdict
 from datetime import date
-from typing import Dict, List
 import pytest
 from allocation import bootstrap
 from allocation.domain import commands
 from allocation.service_layer import handlers
-from allocation.adapters import notifications, repository
-from allocation.service_layer import unit_of_work
-
-
-class FakeRepository(repository.AbstractRepository):
-    def __init__(self, products):
-        super().__init__()
-        self._products = set(products)
-
-    def _add(self, product):
-        self._products.add(product)
-
-    def _get(self, sku):
-        return next((p for p in self._products if p.sku == sku), None)
-
-    def _get_by_batchref(self, batchref):
-        return next(
-            (p for p in self._products for b in p.batches if b.reference == batchref),
-            None,
-        )
-
-
-class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
-    def __init__(self):
-        self.products = FakeRepository([])
-        self.committed = False
-
-    def _commit(self):
-        self.committed = True
-
-    def rollback(self):
-        pass
-
-
-class FakeNotifications(notifications.AbstractNotifications):
-    def __init__(self):
-        self.sent = defaultdict(list)  # type: Dict[str, List[str]]
-
-    def send(self, destination, message):
-        self.sent[destination].append(message)
-
-
-def bootstrap_test_app():
-    return bootstrap.bootstrap(
-        start_orm=False,
-        uow=FakeUnitOfWork(),
-        notifications=FakeNotifications(),
-        publish=lambda *args: None,
-    )
+from .fakes import FakeNotifications, FakeUnitOfWork, bootstrap_test_app
 
 
 class TestAddBatch:
@@ -74,6 +24,49 @@ class TestAddBatch:
         ]
 
 
+class TestImportBatches:
+    def test_adds_batches_and_any_new_products(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "GARISH-RUG", 100, None))
+
+        imported = bus.handle(
+            commands.ImportBatches(
+                [
+                    commands.CreateBatch("b2", "GARISH-RUG", 10, None),
+                    commands.CreateBatch("b3", "CRUNCHY-ARMCHAIR", 20, None),
+                ]
+            )
+        )
+
+        assert imported == 2
+        assert {b.reference for b in bus.uow.products.get("GARISH-RUG").batches} == {
+            "b1",
+            "b2",
+        }
+        assert bus.uow.products.get("CRUNCHY-ARMCHAIR").batches[0].reference == "b3"
+        assert bus.uow.committed
+
+    def test_rejects_repeated_or_existing_batchrefs_without_adding_any(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "GARISH-RUG", 100, None))
+        bus.uow.committed = False
+
+        with pytest.raises(handlers.DuplicateBatch, match="b1, b2"):
+            bus.handle(
+                commands.ImportBatches(
+                    [
+                        commands.CreateBatch("b1", "GARISH-RUG", 10, None),
+                        commands.CreateBatch("b2", "SHINY-RUG", 10, None),
+                        commands.CreateBatch("b2", "SHINY-RUG", 10, None),
+                        commands.CreateBatch("b3", "SHINY-RUG", 10, None),
+                    ]
+                )
+            )
+
+        assert bus.uow.products.get("SHINY-RUG") is None
+        assert not bus.uow.committed
+
+
 class TestAllocate:
     def test_allocates(self):
         bus = bootstrap_test_app()
@@ -110,6 +103,61 @@ class TestAllocate:
         ]
 
 
+class TestAllocateMany:
+    def test_allocates_every_line_and_returns_batchrefs(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("batch1", "CUDDLY-SOFA", 10, None))
+        bus.handle(commands.CreateBatch("batch2", "CUDDLY-SOFA", 10, date.today()))
+        bus.handle(commands.CreateBatch("batch3", "SPIKY-CACTUS", 10, None))
+
+        results = bus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "CUDDLY-SOFA", 8),
+                    commands.Allocate("o2", "SPIKY-CACTUS", 5),
+                    commands.Allocate("o3", "CUDDLY-SOFA", 8),
+                    commands.Allocate("o4", "CUDDLY-SOFA", 8),
+                ]
+            )
+        )
+
+        assert results == ["batch1", "batch3", "batch2", None]
+        assert bus.uow.committed
+
+    def test_reports_invalid_skus_without_failing_other_lines(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "REAL-SKU", 100, None))
+
+        bad, good = bus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "NONEXISTENTSKU", 10),
+                    commands.Allocate("o1", "REAL-SKU", 10),
+                ]
+            )
+        )
+
+        assert isinstance(bad, handlers.InvalidSku)
+        assert str(bad) == "Invalid sku NONEXISTENTSKU"
+        assert good == "b1"
+
+    def test_sends_email_on_out_of_stock_lines(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+        )
+        bus.handle(commands.CreateBatch("b1", "POPULAR-CUSHION", 9, None))
+        bus.handle(
+            commands.AllocateMany([commands.Allocate("o1", "POPULAR-CUSHION", 10)])
+        )
+        assert fake_notifs.sent["stock@made.com"] == [
+            f"Out of stock for POPULAR-CUSHION",
+        ]
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         bus = bootstrap_test_app()
@@ -140,3 +188,50 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+
+class TestChangeBatchQuantities:
+    def test_applies_every_change(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("batch1", "FLUFFY-RUG", 100, None))
+        bus.handle(commands.CreateBatch("batch2", "FLUFFY-RUG", 100, None))
+        bus.handle(commands.CreateBatch("batch3", "SPIKY-RUG", 100, None))
+
+        bus.handle(
+            commands.ChangeBatchQuantities(
+                [
+                    commands.ChangeBatchQuantity("batch1", 10),
+                    commands.ChangeBatchQuantity("batch3", 30),
+                    commands.ChangeBatchQuantity("batch2", 20),
+                    commands.ChangeBatchQuantity("no-such-batch", 40),
+                ]
+            )
+        )
+
+        batches = [
+            b
+            for sku in ["FLUFFY-RUG", "SPIKY-RUG"]
+            for b in bus.uow.products.get(sku=sku).batches
+        ]
+        assert {b.reference: b.available_quantity for b in batches} == {
+            "batch1": 10,
+            "batch2": 20,
+            "batch3": 30,
+        }
+        assert bus.uow.committed
+
+    def test_reallocates_if_necessary(self):
+        bus = bootstrap_test_app()
+        for msg in [
+            commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+            commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+            commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
+        ]:
+            bus.handle(msg)
+
+        change = commands.ChangeBatchQuantity("batch1", 5)
+        bus.handle(commands.ChangeBatchQuantities([change]))
+
+        [batch1, batch2] = bus.uow.products.get(sku="INDIFFERENT-TABLE").batches
+        assert batch1.available_quantity == 5
+        assert batch2.available_quantity == 30
@@ -0,0 +1,143 @@
+import functools
+from datetime import date
+import pytest
+from allocation import bootstrap
+from allocation.adapters import metrics
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from .fakes import FakeNotifications, FakeUnitOfWork
+
+
+def bootstrap_with_metrics(sink):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        metrics=sink,
+    )
+
+
+def test_records_handler_latency_per_message_type_and_handler():
+    sink = metrics.InMemoryMetrics()
+    bus = bootstrap_with_metrics(sink)
+    bus.handle(commands.CreateBatch("b1", "SHABBY-CHAIR", 100, None))
+    bus.handle(commands.Allocate("o1", "SHABBY-CHAIR", 10))
+
+    [latency] = sink.values(
+        "bus.handler_seconds", kind="command", message="Allocate", handler="allocate"
+    )
+    assert latency >= 0
+    assert sink.values(
+        "bus.handler_seconds",
+        kind="event",
+        message="Allocated",
+        handler="publish_allocated_event",
+    )
+
+
+def test_records_cascade_length_and_queue_depth():
+    sink = metrics.InMemoryMetrics()
+    bus = bootstrap_with_metrics(sink)
+    for msg in [
+        commands.CreateBatch("batch1", "WONKY-TABLE", 50, None),
+        commands.CreateBatch("batch2", "WONKY-TABLE", 50, date.today()),
+        commands.Allocate("order1", "WONKY-TABLE", 20),
+        commands.Allocate("order2", "WONKY-TABLE", 20),
+    ]:
+        bus.handle(msg)
+
+    bus.handle(commands.ChangeBatchQuantity("batch1", 10))
+
+    # two Deallocated, each reallocated to an Allocated
+    assert sink.values("bus.cascade_length", message="ChangeBatchQuantity") == [5]
+    assert sink.values("bus.queue_depth_max", message="ChangeBatchQuantity") == [2]
+    assert sink.values("bus.cascade_length", message="Allocate") == [2, 2]
+
+
+class ConflictingUnitOfWork(FakeUnitOfWork):
+    def __init__(self, conflicts):
+        super().__init__()
+        self.conflicts = conflicts
+
+    def _commit(self):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise unit_of_work.ConcurrencyError("version_number changed")
+        super()._commit()
+
+
+def bootstrap_with_conflicts(sink, conflicts):
+    uow = ConflictingUnitOfWork(conflicts=0)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        metrics=sink,
+    )
+    bus.retry_delay = 0
+    bus.handle(commands.CreateBatch("b1", "HOT-SOFA", 100, None))
+    uow.conflicts = conflicts
+    return bus
+
+
+def test_retries_commands_that_conflict():
+    sink = metrics.InMemoryMetrics()
+    bus = bootstrap_with_conflicts(sink, conflicts=2)
+
+    bus.handle(commands.ChangeBatchQuantity("b1", 50))
+
+    assert bus.uow.products.get("HOT-SOFA").batches[0].available_quantity == 50
+    assert sink.count("bus.conflicts", message="ChangeBatchQuantity") == 2
+    assert sink.count("bus.retries", message="ChangeBatchQuantity") == 2
+
+
+def test_gives_up_after_max_attempts():
+    sink = metrics.InMemoryMetrics()
+    bus = bootstrap_with_conflicts(sink, conflicts=5)
+
+    with pytest.raises(unit_of_work.ConcurrencyError):
+        bus.handle(commands.ChangeBatchQuantity("b1", 50))
+
+    assert sink.count("bus.conflicts", message="ChangeBatchQuantity") == 3
+    assert sink.count("bus.retries", message="ChangeBatchQuantity") == 2
+
+
+def test_deferred_bus_is_only_wired_up_by_the_first_message():
+    made = []
+
+    def make_bus():
+        made.append(bootstrap_with_metrics(metrics.NoMetrics()))
+        return made[-1]
+
+    bus = bootstrap.DeferredBus(make_bus)
+    assert not bus.started and made == []
+
+    bus.handle(commands.CreateBatch("b1", "LAMP", 100))
+    bus.handle(commands.Allocate("o1", "LAMP", 10))
+
+    assert bus.started and len(made) == 1
+    assert bus.uow is made[0].uow
+    [batch] = bus.uow.products.get("LAMP").batches
+    assert batch.available_quantity == 90
+
+
+@pytest.mark.parametrize(
+    "handler, bound_by_partial",
+    [
+        # straight after the message, in any order: passed positionally
+        (lambda message, uow, publish: (message, uow, publish), False),
+        (lambda message, publish, uow: (message, uow, publish), False),
+        # after another parameter, or keyword-only: passed by name
+        (lambda message, extra=0, uow=0, publish=0: (message, uow, publish), True),
+        (lambda message, *, uow, publish: (message, uow, publish), True),
+    ],
+)
+def test_inject_dependencies_binds_what_the_handler_names(handler, bound_by_partial):
+    injected = bootstrap.inject_dependencies(
+        handler, dict(uow="uow", publish="publish", notifications="notifications")
+    )
+    assert injected("message") == ("message", "uow", "publish")
+    assert isinstance(injected, functools.partial) == bound_by_partial
+    assert injected.__wrapped__ is handler
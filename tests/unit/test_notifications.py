@@ -0,0 +1,152 @@
+import smtplib
+import threading
+import time
+from typing import List
+import pytest
+from allocation.adapters.notifications import (
+    DigestingNotifications,
+    EmailNotifications,
+    SMTPConnectionPool,
+)
+from .fakes import FakeNotifications
+
+
+class FakeSMTP:
+    def __init__(self, connections: List["FakeSMTP"], fail_first: int = 0):
+        self.sent = []  # type: List[str]
+        self.closed = False
+        self.fail_first = fail_first
+        connections.append(self)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.fail_first:
+            self.fail_first -= 1
+            raise smtplib.SMTPServerDisconnected("went away")
+        self.sent.append(msg)
+
+    def quit(self):
+        self.closed = True
+
+
+def test_email_notifications_reuse_a_connection():
+    connections = []  # type: List[FakeSMTP]
+    pool = SMTPConnectionPool(connect=lambda *args, **kwargs: FakeSMTP(connections))
+    notifications = EmailNotifications(pool=pool)
+
+    notifications.send("stock@made.com", "one")
+    notifications.send("stock@made.com", "two")
+
+    [connection] = connections
+    assert [m.splitlines()[-1] for m in connection.sent] == ["one", "two"]
+
+
+def test_email_notifications_reconnect_when_a_connection_has_gone_away():
+    connections = []  # type: List[FakeSMTP]
+    pool = SMTPConnectionPool(
+        # only the first connection fails
+        connect=lambda *args, **kwargs: FakeSMTP(connections, int(not connections))
+    )
+    notifications = EmailNotifications(pool=pool)
+
+    notifications.send("stock@made.com", "one")
+
+    dropped, reconnected = connections
+    assert dropped.closed and dropped.sent == []
+    assert len(reconnected.sent) == 1
+
+
+def test_closes_a_connection_whatever_the_send_raises():
+    connections = []  # type: List[FakeSMTP]
+    pool = SMTPConnectionPool(connect=lambda *args, **kwargs: FakeSMTP(connections))
+
+    with pytest.raises(ValueError):
+        with pool.connection():
+            raise ValueError("not an SMTP error")
+    with pool.connection():
+        pass
+
+    dropped, reopened = connections
+    assert dropped.closed and not reopened.closed
+
+
+def test_digests_messages_per_destination():
+    sent = FakeNotifications()
+    notifications = DigestingNotifications(sent, window=60)
+    for _ in range(1000):
+        notifications.send("stock@made.com", "Out of stock for RED-LAMP")
+    notifications.send("stock@made.com", "Out of stock for BLUE-LAMP")
+    notifications.send("ops@made.com", "Out of stock for RED-LAMP")
+    assert sent.sent == {}
+
+    notifications.flush()
+
+    assert sent.sent == {
+        "stock@made.com": [
+            "Out of stock for RED-LAMP (1000 times)\nOut of stock for BLUE-LAMP"
+        ],
+        "ops@made.com": ["Out of stock for RED-LAMP"],
+    }
+    notifications.close()
+
+
+def test_sends_digests_in_the_background_once_their_window_is_up():
+    sent = FakeNotifications()
+    notifications = DigestingNotifications(sent, window=0.01)
+    notifications.send("stock@made.com", "Out of stock for RED-LAMP")
+
+    for _ in range(100):
+        if sent.sent:
+            break
+        time.sleep(0.01)
+
+    assert sent.sent == {"stock@made.com": ["Out of stock for RED-LAMP"]}
+    notifications.close()
+
+
+def test_send_doesnt_wait_for_a_slow_server_and_close_sends_the_rest():
+    unblock = threading.Event()
+
+    class SlowNotifications(FakeNotifications):
+        def send(self, destination, message):
+            unblock.wait()
+            super().send(destination, message)
+
+    sent = SlowNotifications()
+    notifications = DigestingNotifications(sent, window=0)
+    notifications.send("stock@made.com", "first")
+    notifications.send("ops@made.com", "second")
+    assert sent.sent == {}
+
+    unblock.set()
+    notifications.close()
+
+    assert sent.sent == {"stock@made.com": ["first"], "ops@made.com": ["second"]}
+
+
+def test_logs_and_carries_on_when_a_digest_cant_be_sent(caplog):
+    class BrokenNotifications(FakeNotifications):
+        def send(self, destination, message):
+            if destination == "broken@made.com":
+                raise smtplib.SMTPRecipientsRefused({})
+            super().send(destination, message)
+
+    sent = BrokenNotifications()
+    notifications = DigestingNotifications(sent, window=60)
+    notifications.send("broken@made.com", "first")
+    notifications.send("stock@made.com", "second")
+
+    notifications.close()
+
+    assert sent.sent == {"stock@made.com": ["second"]}
+    assert "broken@made.com" in caplog.text
+
+
+@pytest.mark.parametrize("window", [0, 60])
+def test_sends_straight_through_once_closed(window):
+    sent = FakeNotifications()
+    notifications = DigestingNotifications(sent, window=window)
+    notifications.close()
+
+    notifications.send("stock@made.com", "late")
+
+    assert sent.sent == {"stock@made.com": ["late"]}
@@ -72,3 +72,36 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_changing_batch_quantity_increments_version_number():
+    product = Product(
+        sku="SCANDI-PEN", batches=[Batch("b1", "SCANDI-PEN", 100, eta=None)]
+    )
+    product.change_batch_quantity("b1", 50)
+    assert product.version_number == 1
+
+
+def test_allocates_to_batches_added_after_the_first_allocation():
+    later_batch = Batch("later-batch", "FANCY-BENCH", 10, eta=later)
+    product = Product(sku="FANCY-BENCH", batches=[later_batch])
+    product.allocate(OrderLine("order1", "FANCY-BENCH", 10))
+
+    earlier_batch = Batch("earlier-batch", "FANCY-BENCH", 10, eta=tomorrow)
+    product.add_batch(earlier_batch)
+    product.batches.append(Batch("in-stock-batch", "FANCY-BENCH", 10, eta=None))
+
+    assert product.allocate(OrderLine("order2", "FANCY-BENCH", 5)) == "in-stock-batch"
+    assert product.allocate(OrderLine("order3", "FANCY-BENCH", 6)) == "earlier-batch"
+
+
+def test_skips_full_batches_until_their_quantity_goes_up():
+    full_batch = Batch("full-batch", "SQUEAKY-STOOL", 10, eta=None)
+    other_batch = Batch("other-batch", "SQUEAKY-STOOL", 100, eta=tomorrow)
+    product = Product(sku="SQUEAKY-STOOL", batches=[full_batch, other_batch])
+    assert product.allocate(OrderLine("order1", "SQUEAKY-STOOL", 10)) == "full-batch"
+    assert product.allocate(OrderLine("order2", "SQUEAKY-STOOL", 1)) == "other-batch"
+
+    product.change_batch_quantity("full-batch", 20)
+
+    assert product.allocate(OrderLine("order3", "SQUEAKY-STOOL", 1)) == "full-batch"
@@ -0,0 +1,87 @@
+import asyncio
+from allocation import bootstrap, views
+from allocation.adapters.read_model import AsyncRedisReadModel, RedisReadModel
+from allocation.domain import commands
+from .fakes import (
+    FakeAsyncRedis,
+    FakeNotifications,
+    FakeRedis,
+    FakeUnitOfWork,
+)
+
+
+def test_redis_read_model_is_maintained_by_the_event_handlers():
+    read_model = RedisReadModel(FakeRedis())
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        read_model=read_model,
+    )
+    bus.handle(commands.CreateBatch("b1", "RED-LAMP", 10, None))
+    bus.handle(commands.CreateBatch("b2", "BLUE-LAMP", 10, None))
+    bus.handle(commands.Allocate("o1", "RED-LAMP", 10))
+    bus.handle(commands.Allocate("o1", "BLUE-LAMP", 10))
+
+    assert views.allocations("o1", bus.uow, read_model=read_model) == [
+        {"sku": "BLUE-LAMP", "batchref": "b2"},
+        {"sku": "RED-LAMP", "batchref": "b1"},
+    ]
+
+    bus.handle(commands.ChangeBatchQuantity("b1", 5))
+    assert read_model.get("o1") == [{"sku": "BLUE-LAMP", "batchref": "b2"}]
+
+
+def test_redis_rebuild_replaces_everything():
+    read_model = RedisReadModel(FakeRedis())
+    read_model.add("stale-order", "RED-LAMP", "b1")
+
+    read_model.rebuild(
+        [
+            ("o1", "RED-LAMP", "b1"),
+            ("o2", "RED-LAMP", "b1"),
+            ("o1", "RED-LAMP", "b2"),
+        ],
+        chunk_size=2,
+    )
+
+    assert read_model.get("stale-order") == []
+    assert read_model.get("o1") == [
+        {"sku": "RED-LAMP", "batchref": "b1"},
+        {"sku": "RED-LAMP", "batchref": "b2"},
+    ]
+    assert read_model.get("o2") == [{"sku": "RED-LAMP", "batchref": "b1"}]
+    assert read_model.allocations_for_sku("RED-LAMP") == {
+        ("o1", "b1"),
+        ("o1", "b2"),
+        ("o2", "b1"),
+    }
+
+
+def test_redis_allocations_for_sku_follow_adds_and_removes():
+    read_model = RedisReadModel(FakeRedis())
+    read_model.add("o1", "RED-LAMP", "b1")
+    read_model.add("o2", "RED-LAMP", "b2")
+    read_model.add("o2", "BLUE-LAMP", "b3")
+
+    read_model.add("o2", "RED-LAMP", "b4")
+    read_model.remove("o1", "RED-LAMP", "b1")
+
+    assert read_model.allocations_for_sku("RED-LAMP") == {("o2", "b2"), ("o2", "b4")}
+    assert read_model.allocations_for_sku("BLUE-LAMP") == {("o2", "b3")}
+    assert read_model.allocations_for_sku("GREEN-LAMP") == set()
+
+
+def test_async_redis_read_model_shares_the_sync_ones_keys():
+    client = FakeRedis()
+    read_model = RedisReadModel(client)
+    async_read_model = AsyncRedisReadModel(FakeAsyncRedis(client))
+
+    asyncio.run(async_read_model.add("o1", "RED-LAMP", "b1"))
+    read_model.add("o1", "BLUE-LAMP", "b2")
+    asyncio.run(async_read_model.remove("o1", "BLUE-LAMP", "b2"))
+
+    assert read_model.get("o1") == [{"sku": "RED-LAMP", "batchref": "b1"}]
+    assert read_model.allocations_for_sku("BLUE-LAMP") == set()
+    assert asyncio.run(async_read_model.get("o1")) == read_model.get("o1")
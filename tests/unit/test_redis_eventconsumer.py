@@ -0,0 +1,252 @@
+import json
+from collections import defaultdict, deque
+from unittest import mock
+import pytest
+import redis
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+from .fakes import bootstrap_test_app
+
+
+class FakePubSub:
+    def __init__(self, payloads):
+        self.messages = deque(
+            {"type": "message", "data": json.dumps(p)} for p in payloads
+        )
+
+    def get_message(self, timeout=0.0):
+        return self.messages.popleft() if self.messages else None
+
+
+def test_drains_up_to_max_messages():
+    pubsub = FakePubSub([{"batchref": f"b{i}", "qty": i} for i in range(10)])
+
+    first = redis_eventconsumer.drain(pubsub, max_messages=4, window=1)
+    rest = redis_eventconsumer.drain(pubsub, max_messages=100, window=0.01)
+
+    assert len(first) == 4
+    assert len(rest) == 6
+    assert redis_eventconsumer.drain(pubsub, wait=0) == []
+
+
+def test_keeps_only_the_latest_quantity_per_batch():
+    pubsub = FakePubSub(
+        [
+            {"batchref": "b1", "qty": 10},
+            {"batchref": "b2", "qty": 20},
+            {"batchref": "b1", "qty": 11},
+            {"batchref": "b1", "qty": 12},
+        ]
+    )
+    messages = redis_eventconsumer.drain(pubsub, window=0.01)
+
+    assert redis_eventconsumer.coalesce(messages) == [
+        commands.ChangeBatchQuantity("b1", 12),
+        commands.ChangeBatchQuantity("b2", 20),
+    ]
+
+
+class FakeStreamsRedis:
+    def __init__(self):
+        self.streams = defaultdict(list)
+        self.groups = {}
+        # keys never expire on their own: a test deletes them instead
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = str(value).encode()
+        return True
+
+    def pexpire(self, key, ms):
+        return key in self.values
+
+    def exists(self, *keys):
+        return sum(key in self.values for key in keys)
+
+    def delete(self, *keys):
+        return sum(self.values.pop(key, None) is not None for key in keys)
+
+    def xadd(self, stream, fields):
+        entry_id = f"{len(self.streams[stream]) + 1}-0".encode()
+        encoded = {k.encode(): v.encode() for k, v in fields.items()}
+        self.streams[stream].append((entry_id, encoded))
+        return entry_id
+
+    def xgroup_create(self, stream, group, id="0", mkstream=False):
+        if (stream, group) in self.groups:
+            raise redis.ResponseError("BUSYGROUP Consumer Group name already exists")
+        self.groups[(stream, group)] = {"delivered": 0, "pending": {}}
+
+    def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        response = []
+        for stream, last_id in streams.items():
+            state = self.groups[(stream, group)]
+            if last_id == ">":
+                entries = self.streams[stream][state["delivered"] :][:count]
+                state["delivered"] += len(entries)
+                for entry_id, _ in entries:
+                    state["pending"][entry_id] = consumer
+            else:
+                entries = [
+                    (entry_id, fields)
+                    for entry_id, fields in self.streams[stream]
+                    if state["pending"].get(entry_id) == consumer
+                ]
+            if entries:
+                response.append((stream.encode(), entries))
+        return response
+
+    def xack(self, stream, group, *ids):
+        for entry_id in ids:
+            self.groups[(stream, group)]["pending"].pop(entry_id)
+
+    def xdel(self, stream, entry_id):
+        # stays pending, like a real entry deleted before it was acknowledged
+        self.streams[stream] = [
+            (i, None if i == entry_id else fields)
+            for i, fields in self.streams[stream]
+        ]
+
+    def xautoclaim(
+        self, stream, group, consumer, min_idle_time, start_id="0-0", count=None
+    ):
+        # every pending entry counts as idle for long enough
+        pending = self.groups[(stream, group)]["pending"]
+        claimable = [
+            (entry_id, fields)
+            for entry_id, fields in self.streams[stream]
+            if entry_id in pending and _seq(entry_id) >= _seq(start_id)
+        ]
+        claimed, rest = claimable[:count], claimable[count:]
+        for entry_id, _ in claimed:
+            pending[entry_id] = consumer
+        return [rest[0][0] if rest else b"0-0", claimed, []]
+
+
+def _seq(entry_id):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    return int(entry_id.split("-")[0])
+
+
+def test_consumers_share_out_every_partition():
+    owned = [redis_eventconsumer.owned_streams(i, 3, partitions=8) for i in range(3)]
+    all_owned = [stream for streams in owned for stream in streams]
+    assert sorted(all_owned) == sorted(f"change_batch_quantity:{p}" for p in range(8))
+
+
+def test_a_dead_consumers_partitions_and_entries_are_taken_over():
+    client = FakeStreamsRedis()
+    streams = redis_eventconsumer.all_streams(partitions=2)
+    redis_eventconsumer.create_groups(client, streams)
+    # whoever starts first reads everything until the others are alive
+    assert redis_eventconsumer.renew_leases(client, 0, 2, partitions=2) == streams
+    assert redis_eventconsumer.renew_leases(client, 1, 2, partitions=2) == []
+    assert redis_eventconsumer.renew_leases(client, 0, 2, partitions=2) == streams[:1]
+    assert redis_eventconsumer.renew_leases(client, 1, 2, partitions=2) == streams[1:]
+    for qty in [5, 6]:
+        client.xadd(streams[1], {"data": json.dumps({"batchref": "b1", "qty": qty})})
+    lost = redis_eventconsumer.read_stream_entries(client, streams[1:], "consumer-1")
+    client.xadd(streams[1], {"data": json.dumps({"batchref": "b1", "qty": 7})})
+
+    # consumer-1 dies, so its leases lapse
+    client.delete(
+        redis_eventconsumer._lease_key(streams[1]),
+        redis_eventconsumer._alive_key("consumer-1"),
+    )
+    assert redis_eventconsumer.renew_leases(client, 0, 2, partitions=2) == streams
+    reclaimed = redis_eventconsumer.reclaim_stream_entries(
+        client, streams[1:], "consumer-0"
+    )
+    unread = redis_eventconsumer.read_stream_entries(client, streams, "consumer-0")
+    assert reclaimed == lost
+    assert [json.loads(f[b"data"])["qty"] for _, _, f in unread] == [7]
+
+    # and once it's back, it gets them back
+    assert redis_eventconsumer.renew_leases(client, 1, 2, partitions=2) == []
+    assert redis_eventconsumer.renew_leases(client, 0, 2, partitions=2) == streams[:1]
+    assert redis_eventconsumer.renew_leases(client, 1, 2, partitions=2) == streams[1:]
+
+
+def test_all_of_a_products_messages_go_to_one_stream():
+    streams = {
+        redis_eventconsumer.partition_stream({"sku": "SKU1", "batchref": ref})
+        for ref in ["b1", "b2", "b3"]
+    }
+    assert len(streams) == 1
+
+
+def test_messages_without_a_sku_go_to_their_products_stream():
+    skus = {"b1": "SKU1", "b2": "SKU1", "b3": "SKU1"}
+    streams = {
+        redis_eventconsumer.partition_stream({"batchref": ref}, skus.get)
+        for ref in ["b1", "b2", "b3"]
+    }
+    assert streams == {redis_eventconsumer.partition_stream({"sku": "SKU1"})}
+
+
+def test_stream_entries_are_handled_and_acknowledged():
+    client = FakeStreamsRedis()
+    bus = bootstrap_test_app()
+    bus.handle(commands.CreateBatch("b1", "STREAMY-SOFA", 100, None))
+    streams = redis_eventconsumer.owned_streams(0, 1)
+    redis_eventconsumer.create_groups(client, streams)
+    redis_eventconsumer.create_groups(client, streams)
+    for qty in [50, 40]:
+        data = {"sku": "STREAMY-SOFA", "batchref": "b1", "qty": qty}
+        stream = redis_eventconsumer.partition_stream(data)
+        client.xadd(stream, {"data": json.dumps(data)})
+
+    entries = redis_eventconsumer.read_stream_entries(client, streams, "consumer-0")
+    redis_eventconsumer.handle_stream_entries(client, entries, bus)
+
+    [batch] = bus.uow.products.get("STREAMY-SOFA").batches
+    assert batch.available_quantity == 40
+    assert not redis_eventconsumer.read_stream_entries(
+        client, streams, "consumer-0", new=False
+    )
+
+
+def test_entries_are_not_acknowledged_if_handling_fails():
+    client = FakeStreamsRedis()
+    bus = mock.Mock()
+    bus.handle.side_effect = ConnectionError("database went away")
+    streams = redis_eventconsumer.owned_streams(0, 1)
+    redis_eventconsumer.create_groups(client, streams)
+    data = {"sku": "BROKEN-SOFA", "batchref": "b1", "qty": 5}
+    stream = redis_eventconsumer.partition_stream(data)
+    client.xadd(stream, {"data": json.dumps(data)})
+
+    entries = redis_eventconsumer.read_stream_entries(client, streams, "consumer-0")
+    with pytest.raises(ConnectionError):
+        redis_eventconsumer.handle_stream_entries(client, entries, bus)
+
+    pending = redis_eventconsumer.read_stream_entries(
+        client, streams, "consumer-0", new=False
+    )
+    assert pending == entries
+
+
+def test_reclaims_other_consumers_entries_but_not_deleted_ones():
+    client = FakeStreamsRedis()
+    streams = redis_eventconsumer.owned_streams(0, 1)
+    redis_eventconsumer.create_groups(client, streams)
+    for ref in ["b1", "b2"]:
+        data = {"sku": "LOST-SOFA", "batchref": ref, "qty": 5}
+        stream = redis_eventconsumer.partition_stream(data)
+        client.xadd(stream, {"data": json.dumps(data)})
+    [(stream, deleted, _), (_, kept, _)] = redis_eventconsumer.read_stream_entries(
+        client, streams, "crashed"
+    )
+    client.xdel(stream, deleted)
+
+    reclaimed = redis_eventconsumer.reclaim_stream_entries(
+        client, streams, "consumer-0"
+    )
+
+    assert [entry_id for _, entry_id, _ in reclaimed] == [kept]
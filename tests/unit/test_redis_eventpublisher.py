@@ -0,0 +1,93 @@
+import json
+import time
+from dataclasses import asdict
+from allocation import bootstrap
+from allocation.adapters import redis_eventpublisher
+from allocation.domain import commands, events
+from .fakes import FakeNotifications, FakeUnitOfWork
+
+
+class FakeRedis:
+    def __init__(self):
+        self.round_trips = 0
+        self.published = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.buffered = []
+
+    def publish(self, channel, message):
+        self.buffered.append((channel, message))
+
+    def execute(self):
+        self.redis.round_trips += 1
+        self.redis.published.extend(self.buffered)
+
+
+def allocated(orderid):
+    return events.Allocated(orderid=orderid, sku="sku", qty=1, batchref="batch")
+
+
+def test_serializes_like_asdict():
+    event = allocated("o1")
+    assert json.loads(redis_eventpublisher.serialize(event)) == asdict(event)
+
+
+def test_sends_buffered_messages_in_one_round_trip_on_flush():
+    fake_redis = FakeRedis()
+    publish = redis_eventpublisher.BufferedPublisher(fake_redis, max_delay=None)
+    publish("line_allocated", allocated("o1"))
+    publish("line_allocated", allocated("o2"))
+    assert fake_redis.published == []
+
+    publish.flush()
+
+    assert fake_redis.round_trips == 1
+    assert [json.loads(m)["orderid"] for _, m in fake_redis.published] == ["o1", "o2"]
+
+
+def test_flushes_when_batch_is_full():
+    fake_redis = FakeRedis()
+    publish = redis_eventpublisher.BufferedPublisher(
+        fake_redis, max_batch=2, max_delay=None
+    )
+    for orderid in ["o1", "o2", "o3"]:
+        publish("line_allocated", allocated(orderid))
+
+    assert fake_redis.round_trips == 1
+    assert len(fake_redis.published) == 2
+
+
+def test_flushes_after_max_delay():
+    fake_redis = FakeRedis()
+    publish = redis_eventpublisher.BufferedPublisher(fake_redis, max_delay=0.01)
+    publish("line_allocated", allocated("o1"))
+
+    deadline = time.time() + 2
+    while not fake_redis.published and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(fake_redis.published) == 1
+
+
+def test_bus_flushes_once_per_message_handled():
+    fake_redis = FakeRedis()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=redis_eventpublisher.BufferedPublisher(fake_redis, max_delay=None),
+    )
+    bus.handle(commands.CreateBatch("b1", "BUSY-SKU", 100, None))
+    bus.handle(
+        commands.AllocateMany(
+            [commands.Allocate(f"o{i}", "BUSY-SKU", 1) for i in range(10)]
+        )
+    )
+
+    assert fake_redis.round_trips == 1
+    assert len(fake_redis.published) == 10
@@ -0,0 +1,99 @@
+import threading
+import pytest
+from allocation.domain import commands
+from allocation.service_layer.sharding import ShardedCommandDispatcher
+
+
+class FakeBus:
+    def __init__(self, handled):
+        self.handled = handled
+
+    def handle(self, command):
+        if getattr(command, "sku", None) == "BROKEN-SKU":
+            raise ValueError("no such thing")
+        self.handled.append((threading.current_thread().name, command))
+        if isinstance(command, commands.AllocateMany):
+            return [f"{l.orderid}-batch" for l in command.lines]
+        if isinstance(command, commands.ImportBatches):
+            return len(command.batches)
+        return f"handled {command}"
+
+
+@pytest.fixture
+def handled():
+    return []
+
+
+@pytest.fixture
+def dispatcher(handled):
+    skus_by_batchref = {"b1": "sku1", "b2": "sku2"}
+    dispatcher = ShardedCommandDispatcher(workers=4)
+    dispatcher.start(lambda: FakeBus(handled), resolve_sku=skus_by_batchref.get)
+    yield dispatcher
+    dispatcher.shutdown()
+
+
+def test_commands_for_one_sku_are_handled_in_order_on_one_worker(dispatcher, handled):
+    futures = [
+        dispatcher.submit(commands.Allocate(f"o{i}", f"sku{i % 5}", 1))
+        for i in range(100)
+    ]
+    for future in futures:
+        future.result()
+
+    for sku in [f"sku{i}" for i in range(5)]:
+        mine = [(worker, cmd) for worker, cmd in handled if cmd.sku == sku]
+        assert len({worker for worker, _ in mine}) == 1
+        orderids = [int(cmd.orderid[1:]) for _, cmd in mine]
+        assert orderids == sorted(orderids)
+    assert len({worker for worker, _ in handled}) > 1
+
+
+def test_batch_quantity_changes_go_to_their_products_worker(dispatcher, handled):
+    dispatcher.handle(commands.CreateBatch("b1", "sku1", 10))
+    dispatcher.handle(commands.ChangeBatchQuantity("b1", 5))
+
+    [(create_worker, _), (change_worker, _)] = handled
+    assert create_worker == change_worker
+
+
+def test_returns_the_result_or_raises(dispatcher):
+    assert dispatcher.handle(commands.Allocate("o1", "sku1", 1)).startswith("handled")
+    with pytest.raises(ValueError):
+        dispatcher.handle(commands.Allocate("o1", "BROKEN-SKU", 1))
+
+
+def test_allocate_many_is_split_per_worker_and_merged_in_order(dispatcher, handled):
+    lines = [commands.Allocate(f"o{i}", f"sku{i % 7}", 1) for i in range(20)]
+
+    results = dispatcher.handle(commands.AllocateMany(lines))
+
+    assert results == [f"o{i}-batch" for i in range(20)]
+    assert len(handled) > 1
+    for _, cmd in handled:
+        shards = {dispatcher.shard_for_sku(l.sku) for l in cmd.lines}
+        assert len(shards) == 1
+
+
+def test_change_batch_quantities_are_split_per_worker(dispatcher, handled):
+    changes = [
+        commands.ChangeBatchQuantity("b1", 5),
+        commands.ChangeBatchQuantity("b2", 5),
+        commands.ChangeBatchQuantity("b1", 3),
+    ]
+
+    dispatcher.handle(commands.ChangeBatchQuantities(changes))
+
+    handled_changes = [c for _, cmd in handled for c in cmd.changes]
+    assert sorted(c.qty for c in handled_changes) == [3, 5, 5]
+    for _, cmd in handled:
+        assert [c.qty for c in cmd.changes if c.ref == "b1"] in ([], [5, 3])
+
+
+def test_imported_batches_are_handled_whole_by_one_worker(dispatcher, handled):
+    batches = [commands.CreateBatch(f"b{i}", f"sku{i % 4 + 1}", 10) for i in range(8)]
+
+    assert dispatcher.handle(commands.ImportBatches(batches)) == 8
+
+    [(_, cmd)] = handled
+    assert cmd == commands.ImportBatches(batches)
@@ -0,0 +1,39 @@
+from dataclasses import asdict, dataclass
+from datetime import date
+from typing import Optional
+import pytest
+from allocation.domain import commands, events
+from allocation.domain.slots import slotted
+
+
+class Base:
+    __slots__ = ()
+
+
+@slotted
+@dataclass
+class Shipment(Base):
+    ref: str
+    eta: Optional[date] = None
+
+
+def test_slotted_dataclasses_keep_their_fields_defaults_and_equality():
+    shipment = Shipment("s1")
+    assert shipment == Shipment("s1", eta=None)
+    assert asdict(shipment) == {"ref": "s1", "eta": None}
+    assert repr(shipment) == "Shipment(ref='s1', eta=None)"
+    with pytest.raises(AttributeError):
+        shipment.unexpected = 1  # pylint: disable=assigning-non-slot
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        commands.Allocate("o1", "LAMP", 10),
+        commands.CreateBatch("b1", "LAMP", 100),
+        events.Allocated("o1", "LAMP", 10, "b1"),
+        events.OutOfStock("LAMP"),
+    ],
+)
+def test_messages_have_no_instance_dict(message):
+    assert not hasattr(message, "__dict__")
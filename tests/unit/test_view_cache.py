@@ -0,0 +1,111 @@
+import pytest
+from allocation.adapters import metrics
+from allocation.adapters.view_cache import LRUViewCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_loads_once_then_hits():
+    cache = LRUViewCache(max_size=10)
+    loads = []
+
+    for _ in range(3):
+        result = cache.get_or_load("order1", lambda: loads.append(1) or ["rows"])
+
+    assert result == ["rows"]
+    assert len(loads) == 1
+    assert cache.stats() == dict(size=1, hits=2, misses=1, evictions=0, expirations=0)
+
+
+def test_evicts_least_recently_used():
+    cache = LRUViewCache(max_size=2)
+    cache.get_or_load("a", lambda: "a1")
+    cache.get_or_load("b", lambda: "b1")
+    cache.get_or_load("a", lambda: "a2")
+    cache.get_or_load("c", lambda: "c1")
+
+    assert cache.get_or_load("a", lambda: "a3") == "a1"
+    assert cache.get_or_load("b", lambda: "b2") == "b2"
+    assert cache.evictions == 2
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = LRUViewCache(ttl=5, clock=clock)
+    cache.get_or_load("order1", lambda: "old")
+    clock.now = 4.9
+    assert cache.get_or_load("order1", lambda: "new") == "old"
+    clock.now = 5.1
+    assert cache.get_or_load("order1", lambda: "new") == "new"
+    assert cache.expirations == 1
+
+
+def test_invalidate_drops_the_entry():
+    cache = LRUViewCache()
+    cache.get_or_load("order1", lambda: "old")
+    cache.invalidate("order1")
+    assert cache.get_or_load("order1", lambda: "new") == "new"
+
+
+def test_invalidate_keeps_other_entries():
+    cache = LRUViewCache()
+    cache.get_or_load("order1", lambda: "old")
+    cache.get_or_load("order2", lambda: "rows")
+    cache.invalidate("order1")
+    assert cache.get_or_load("order2", lambda: "new") == "rows"
+    assert cache.stats()["size"] == 1
+
+
+def test_does_not_keep_empty_results():
+    cache = LRUViewCache()
+    assert cache.get_or_load("order1", lambda: []) == []
+    assert cache.get_or_load("order1", lambda: ["rows"]) == ["rows"]
+
+
+def test_does_not_keep_results_loaded_across_an_invalidation():
+    cache = LRUViewCache()
+
+    def load_while_someone_writes():
+        cache.invalidate("order1")
+        return "maybe stale"
+
+    assert cache.get_or_load("order1", load_while_someone_writes) == "maybe stale"
+    assert cache.get_or_load("order1", lambda: "fresh") == "fresh"
+
+
+def test_keeps_results_loaded_across_another_keys_invalidation():
+    cache = LRUViewCache()
+
+    def load_while_someone_writes_elsewhere():
+        cache.invalidate("order2")
+        return "rows"
+
+    cache.get_or_load("order1", load_while_someone_writes_elsewhere)
+    assert cache.get_or_load("order1", lambda: "new") == "rows"
+
+
+def test_forgets_loads_that_fail():
+    cache = LRUViewCache()
+
+    def broken_load():
+        raise ConnectionError("database is down")
+
+    with pytest.raises(ConnectionError):
+        cache.get_or_load("order1", broken_load)
+    assert not cache._loading
+    assert cache.get_or_load("order1", lambda: "rows") == "rows"
+
+
+def test_counts_go_to_metrics():
+    sink = metrics.InMemoryMetrics()
+    cache = LRUViewCache(metrics=sink)
+    cache.get_or_load("order1", lambda: "rows")
+    cache.get_or_load("order1", lambda: "rows")
+    assert sink.count("view_cache.misses") == 1
+    assert sink.count("view_cache.hits") == 1